@@ -1,24 +1,84 @@
 # Function to standardize inference output of AIY models
 import json                             # Format API output
+import importlib
+from collections import namedtuple
+
+# AIY requirements are imported on first use so the rest of the pipeline can run without a Vision Kit
+
+
+# Hardware-independent detections with the same fields the AIY model helpers return
+Face = namedtuple('Face', ['bounding_box', 'face_score', 'joy_score'])
+Object = namedtuple('Object', ['bounding_box', 'label', 'score'])
+
+
+# Inference output that has already been decoded from the raw tensors.
+# Produced by the synthetic and replay backends, or by decode_result() for live AIY results
+class DecodedResult(object):
+    def __init__(self, model, detections):
+        self.model = model
+        self.detections = detections
+
+    def to_dict(self):
+        return {'model': self.model, 'detections': [list(d) for d in self.detections]}
+
+    @classmethod
+    def from_dict(cls, data):
+        item_type = {'face': Face, 'object': Object}.get(data['model'])
+        detections = [item_type(*d) if item_type else tuple(d) for d in data['detections']]
+        return cls(data['model'], detections)
+
+
+# model name -> aiy.vision.models module that describes it
+model_modules = {
+    "object": "object_detection",
+    "face": "face_detection",
+    "class": "image_classification"
+}
+_models = {}    # model descriptors, built the first time each one is asked for
 
-# AIY requirements
-from aiy.vision.models import object_detection, face_detection, image_classification
 
 # return the appropriate model
 def model_selector(argument):
-    options = {
-        "object": object_detection.model(),
-        "face": face_detection.model(),
-        "class": image_classification.model()
-    }
-    return options.get(argument, "nothing")
+    model = _models.get(argument)
+    if model is None:
+        if argument not in model_modules:
+            return "nothing"
+        module = importlib.import_module('aiy.vision.models.' + model_modules[argument])
+        model = _models[argument] = module.model()
+    return model
+
+
+# Convert a raw AIY result into model-independent detections
+def decode_result(model, result, threshold=0.3):
+    if isinstance(result, DecodedResult):
+        return result
+
+    if model == "object":
+        from aiy.vision.models import object_detection
+        detections = [Object(tuple(obj.bounding_box), obj._LABELS[obj.kind], obj.score)
+                      for obj in object_detection.get_objects(result, threshold)]
+    elif model == "face":
+        from aiy.vision.models import face_detection
+        detections = [Face(tuple(face.bounding_box), face.face_score, face.joy_score)
+                      for face in face_detection.get_faces(result)]
+    elif model == "class":
+        from aiy.vision.models import image_classification
+        detections = [(obj, prob) for (obj, prob) in image_classification.get_classes(result)]
+    else:
+        detections = []
+
+    return DecodedResult(model, detections)
+
+
+API_NAME = "webrtcHacks AIY Vision Server REST API"
+API_VERSION = "0.2.1"
 
 
 # helper class to convert inference output to JSON
 class ApiObject(object):
     def __init__(self):
-        self.name = "webrtcHacks AIY Vision Server REST API"
-        self.version = "0.2.1"
+        self.name = API_NAME
+        self.version = API_VERSION
         self.numObjects = 0
         self.objects = []
 
@@ -26,68 +86,186 @@ class ApiObject(object):
         return json.dumps(self.__dict__)
 
 
-def process_inference(model, result, params):
+# Precompiled JSON pieces so to_json() only formats the numbers that change every frame
+_ENVELOPE = '{"name": %s, "version": %s, "numObjects": ' % (json.dumps(API_NAME), json.dumps(API_VERSION))
+_FACE = '{"name": "face", "score": %r, "joy": %r, "x": %r, "y": %r, "width": %r, "height": %r}'
+_OBJECT = '{"name": "object", "class_name": %s, "score": %r, "x": %r, "y": %r, "width": %r, "height": %r}'
+_CLASS = '{"name": "class", "class_name": %s, "score": %r}'
+_TRAILER = ('threshold', 'seq', 'timeStamp', 'inferenceTime')
+
+_quoted_labels = {}
+
+
+def _quote(label):
+    quoted = _quoted_labels.get(label)
+    if quoted is None:
+        quoted = _quoted_labels[label] = json.dumps(label)
+    return quoted
+
 
-    output = ApiObject()
+# Columnar inference result with the same JSON output as ApiObject.
+# Detections are kept as columns (boxes as normalized (x, y, width, height) tuples) and only turned
+# into per-object dicts if something asks for .objects
+class InferenceResult(object):
+    __slots__ = ('kind', 'numObjects', 'scores', 'joy', 'labels', 'boxes',
+                 'threshold', 'seq', 'timeStamp', 'inferenceTime', 'model', '_objects')
 
-    # handler for the AIY Vision object detection model
+    name = API_NAME
+    version = API_VERSION
+
+    def __init__(self, kind, scores, boxes=None, joy=None, labels=None, threshold=None):
+        self.kind = kind
+        self.numObjects = len(scores)
+        self.scores = scores
+        self.boxes = boxes
+        self.joy = joy
+        self.labels = labels
+        self.threshold = threshold
+        self.seq = None
+        self.timeStamp = None
+        self.inferenceTime = None
+        self.model = None       # set when several models share the stream
+        self._objects = None
+
+    def _rows(self):
+        if self.kind == 'face':
+            return [(score, joy) + box for score, joy, box in zip(self.scores, self.joy, self.boxes)]
+        elif self.kind == 'object':
+            return [(label, score) + box for label, score, box in zip(self.labels, self.scores, self.boxes)]
+        return list(zip(self.labels, self.scores))
+
+    # per-object dicts, built on first use. Assigning replaces them (e.g. with tracked objects)
+    @property
+    def objects(self):
+        if self._objects is None:
+            keys = {'face': ('score', 'joy', 'x', 'y', 'width', 'height'),
+                    'object': ('class_name', 'score', 'x', 'y', 'width', 'height'),
+                    'class': ('class_name', 'score')}[self.kind]
+            self._objects = []
+            for row in self._rows():
+                item = {'name': self.kind}
+                item.update(zip(keys, row))
+                self._objects.append(item)
+        return self._objects
+
+    @objects.setter
+    def objects(self, objects):
+        self._objects = objects
+        self.numObjects = len(objects)
+
+    # (class name, score, box) per detection for filtering; faces are class "face" and
+    # classification results have no box
+    def detections(self):
+        if self._objects is not None:
+            return [(item.get('class_name', item['name']), item['score'],
+                     (item['x'], item['y'], item['width'], item['height']) if 'x' in item else None)
+                    for item in self._objects]
+        labels = self.labels if self.labels is not None else [self.kind] * self.numObjects
+        boxes = self.boxes if self.boxes is not None else [None] * self.numObjects
+        return list(zip(labels, self.scores, boxes))
+
+    # copy with only the detections at indexes, sharing the frame's seq and timing
+    def select(self, indexes):
+        if self._objects is not None:
+            result = InferenceResult(self.kind, [], threshold=self.threshold)
+            result.objects = [self._objects[i] for i in indexes]
+        else:
+            def pick(column):
+                return [column[i] for i in indexes] if column is not None else None
+            result = InferenceResult(self.kind, pick(self.scores), pick(self.boxes),
+                                     pick(self.joy), pick(self.labels), self.threshold)
+        result.seq = self.seq
+        result.timeStamp = self.timeStamp
+        result.inferenceTime = self.inferenceTime
+        result.model = self.model
+        return result
+
+    def to_json(self):
+        if self._objects is not None:
+            objects = json.dumps(self._objects)
+        elif self.kind == 'face':
+            objects = '[' + ', '.join(_FACE % row for row in self._rows()) + ']'
+        elif self.kind == 'object':
+            objects = '[' + ', '.join(_OBJECT % ((_quote(row[0]),) + row[1:]) for row in self._rows()) + ']'
+        else:
+            objects = '[' + ', '.join(_CLASS % (_quote(label), score) for label, score in self._rows()) + ']'
+
+        parts = [_ENVELOPE, str(self.numObjects), ', "objects": ', objects]
+        if self.model is not None:
+            parts.append(', "model": ' + _quote(self.model))
+        for key in _TRAILER:
+            value = getattr(self, key)
+            if value is not None:
+                parts.append(', "%s": %r' % (key, value))
+        parts.append('}')
+        return ''.join(parts)
+
+
+# Model specific converters from detections to an InferenceResult. They take DecodedResult
+# detections or the AIY result objects themselves, which have the same fields apart from object
+# labels. Plain Python normalizes the few boxes in a frame faster than a NumPy array would.
+def _convert_faces(detections, size, threshold, label=None):
+    width, height = size
+    scores = [face.face_score for face in detections]
+    joy = [face.joy_score for face in detections]
+    boxes = [(x / width, y / height, w / width, h / height) for x, y, w, h in (face.bounding_box for face in detections)]
+    return InferenceResult('face', scores, boxes, joy=joy)
+
+
+def _convert_objects(detections, size, threshold, label=None):
+    width, height = size
+    scores = [obj.score for obj in detections]
+    labels = [obj.label for obj in detections] if label is None else [label(obj) for obj in detections]
+    boxes = [(x / width, y / height, w / width, h / height) for x, y, w, h in (obj.bounding_box for obj in detections)]
+    return InferenceResult('object', scores, boxes, labels=labels, threshold=threshold)
+
+
+def _convert_classes(detections, size, threshold, label=None):
+    kept = [(obj, prob) for (obj, prob) in detections if prob > threshold]
+    return InferenceResult('class', [prob for _, prob in kept], labels=[obj for obj, _ in kept], threshold=threshold)
+
+
+converters = {
+    "face": _convert_faces,
+    "object": _convert_objects,
+    "class": _convert_classes
+}
+
+
+# AIY objects carry a label index rather than the name
+def _aiy_label(obj):
+    return obj._LABELS[obj.kind]
+
+
+# Convert a raw AIY result without building DecodedResult namedtuples first
+def _aiy_converter(model, size, threshold):
+    module = importlib.import_module('aiy.vision.models.' + model_modules[model])
     if model == "object":
-        output.threshold = 0.3
-        objects = object_detection.get_objects(result, output.threshold)
-
-        for obj in objects:
-            # print(object)
-            item = {
-                'name': 'object',
-                'class_name': obj._LABELS[obj.kind],
-                'score': obj.score,
-                'x': obj.bounding_box[0] / params['width'],
-                'y': obj.bounding_box[1] / params['height'],
-                'width': obj.bounding_box[2] / params['width'],
-                'height': obj.bounding_box[3] / params['height']
-            }
-
-            output.numObjects += 1
-            output.objects.append(item)
-
-    # handler for the AIY Vision face detection model
+        return lambda result: _convert_objects(module.get_objects(result, threshold), size, threshold, _aiy_label)
     elif model == "face":
-        faces = face_detection.get_faces(result)
-
-        for face in faces:
-            # print(face)
-            item = {
-                'name': 'face',
-                'score': face.face_score,
-                'joy': face.joy_score,
-                'x': face.bounding_box[0] / params['width'],
-                'y': face.bounding_box[1] / params['height'],
-                'width': face.bounding_box[2] / params['width'],
-                'height': face.bounding_box[3] / params['height']
-            }
-
-            output.numObjects += 1
-            output.objects.append(item)
+        return lambda result: _convert_faces(module.get_faces(result), size, threshold)
+    return lambda result: _convert_classes(module.get_classes(result), size, threshold)
 
-    elif model == "class":
-        output.threshold = 0.3
-        classes = image_classification.get_classes(result)
 
-        s = ""
+# Resolve the conversion for a model once, when the model is chosen.
+# Returns a function taking a decoded (or raw AIY) result and returning an InferenceResult
+def get_converter(model, params, threshold=0.3):
+    if model not in converters:
+        raise ValueError("No tensorflow model or invalid model specified: %s" % model)
 
-        for (obj, prob) in classes:
-            if prob > output.threshold:
-                s += '%s=%1.2f\t|\t' % (obj, prob)
+    convert = converters[model]
+    size = (float(params['width']), float(params['height']))
+    convert_raw = []    # the AIY modules are only imported once a raw result shows up
 
-                item = {
-                    'name': 'class',
-                    'class_name': obj,
-                    'score': prob
-                }
+    def converter(result):
+        if isinstance(result, DecodedResult):
+            return convert(result.detections, size, threshold)
+        if not convert_raw:
+            convert_raw.append(_aiy_converter(model, size, threshold))
+        return convert_raw[0](result)
 
-                output.numObjects += 1
-                output.objects.append(item)
+    return converter
 
-        # print('%s\r' % s)
 
-    return output
+def process_inference(model, result, params):
+    return get_converter(model, params)(result)
@@ -0,0 +1,142 @@
+# Fan-out of detection results to HTTP Server-Sent Events subscribers
+#
+# Each result is framed as an SSE event once and shared by every subscriber. Subscribers have a
+# bounded drop-oldest queue; one that keeps falling behind is evicted, and the number of
+# subscribers is capped so HTTP clients can't pile work onto the inference thread.
+# Subscribers with a subscription filter (see subscriptions.py) get their view of each result,
+# framed once per distinct filter.
+
+from collections import deque
+from threading import Condition
+from time import monotonic
+
+import metrics
+
+events_dropped = metrics.counter('stream_events_dropped_total', 'Events dropped for slow SSE subscribers')
+evictions = metrics.counter('stream_evictions_total', 'SSE subscribers evicted for falling behind')
+
+
+class Subscriber(object):
+    def __init__(self, broadcaster, subscriber_id, max_queue, subscription=None):
+        self.broadcaster = broadcaster
+        self.id = subscriber_id
+        self.subscription = subscription    # key in the broadcaster's Subscriptions, None for everything
+        self.queue = deque(maxlen=max_queue)
+        self.sent = 0
+        self.dropped = 0
+        self.behind = 0         # consecutive publishes that overflowed the queue
+        self.evicted = False
+
+    def stats(self):
+        return {'id': self.id, 'sent': self.sent, 'dropped': self.dropped, 'queued': len(self.queue)}
+
+    # Generator of SSE bytes for a streaming HTTP response. Closing it unsubscribes.
+    def events(self, keepalive=15):
+        b = self.broadcaster
+        last_write = monotonic()
+        try:
+            yield b'retry: 2000\n\n'
+            while not self.evicted and not b.closed:
+                with b.condition:
+                    if not self.queue:
+                        b.condition.wait(timeout=keepalive)
+                    pending = list(self.queue)
+                    self.queue.clear()
+                    self.behind = 0
+
+                if pending:
+                    self.sent += len(pending)
+                    last_write = monotonic()
+                    yield b''.join(pending)
+                elif monotonic() - last_write >= keepalive:
+                    last_write = monotonic()
+                    yield b': keepalive\n\n'    # detects clients that went away
+
+            if self.evicted:
+                yield b'event: evicted\ndata: {"reason": "too slow"}\n\n'
+        finally:
+            b.unsubscribe(self)
+
+
+class Broadcaster(object):
+    def __init__(self, max_subscribers=4, max_queue=8, evict_after=32, subscriptions=None):
+        self.subscriptions = subscriptions
+        self.max_subscribers = max_subscribers
+        self.max_queue = max_queue
+        self.evict_after = evict_after  # overflowing publishes in a row before a subscriber is dropped
+        self.condition = Condition()
+        self.subscribers = []
+        self.evictions = 0
+        self.closed = False
+        self._next_id = 0
+
+    # Returns a Subscriber, or None if the subscriber limit has been reached.
+    # subscription is an optional Subscription filter; it needs a broadcaster with a registry
+    def subscribe(self, subscription=None):
+        with self.condition:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None
+            self._next_id += 1
+            key = self.subscriptions.add(subscription) if subscription is not None else None
+            subscriber = Subscriber(self, self._next_id, self.max_queue, key)
+            self.subscribers.append(subscriber)
+        print("stream subscriber %d connected (%d total)" % (subscriber.id, len(self.subscribers)))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.condition:
+            if subscriber not in self.subscribers:
+                return
+            self.subscribers.remove(subscriber)
+            if subscriber.subscription is not None:
+                self.subscriptions.release(subscriber.subscription)
+        print("stream subscriber %d disconnected%s: sent %d, dropped %d" %
+              (subscriber.id, " (evicted)" if subscriber.evicted else "", subscriber.sent, subscriber.dropped))
+
+    # Queue a JSON message for every subscriber. event names an SSE event type, None for the default.
+    # views is the result of Subscriptions.apply() for the result the message was made from
+    def publish(self, message, event=None, views=None):
+        if not self.subscribers:
+            return False
+
+        frames = {None: self._frame(message, event)}
+        with self.condition:
+            for subscriber in self.subscribers:
+                frame = frames[None]
+                if views is not None and subscriber.subscription is not None:
+                    view = views.get(subscriber.subscription)
+                    if view is None:
+                        continue
+                    if view is not views[None]:
+                        frame = frames.get(subscriber.subscription)
+                        if frame is None:
+                            frame = frames[subscriber.subscription] = self._frame(view.to_json(), event)
+
+                if len(subscriber.queue) == subscriber.queue.maxlen:
+                    subscriber.dropped += 1
+                    subscriber.behind += 1
+                    events_dropped.inc()
+                    if subscriber.behind >= self.evict_after and not subscriber.evicted:
+                        subscriber.evicted = True
+                        self.evictions += 1
+                        evictions.inc()
+                subscriber.queue.append(frame)
+            self.condition.notify_all()
+        return True
+
+    @staticmethod
+    def _frame(message, event):
+        frame = 'data: %s\n\n' % message
+        if event is not None:
+            frame = 'event: %s\n' % event + frame
+        return frame.encode()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {'subscribers': [s.stats() for s in self.subscribers],
+                    'max_subscribers': self.max_subscribers, 'evictions': self.evictions}
@@ -0,0 +1,132 @@
+# Keyframe + delta encoding of the detection stream
+#
+# Instead of a full result on every frame with objects, the stream sends:
+#   key        every keyframe_interval seconds - the complete scene with object ids
+#   delta      objects added, removed, or moved more than epsilon since they were last sent
+#   empty      once, as soon as the scene has no objects
+#   heartbeat  when nothing else has been sent for heartbeat_interval seconds
+# so mostly static scenes cost almost nothing and clients can clear boxes deterministically.
+
+import json
+
+BOX_KEYS = ('x', 'y', 'width', 'height')
+
+
+# A stream message; quacks like ApiObject for the publisher
+class StreamMessage(object):
+    def __init__(self, msg_type, seq, time_stamp, **fields):
+        self.type = msg_type
+        self.seq = seq
+        self.timeStamp = time_stamp
+        self.__dict__.update(fields)
+
+    def to_json(self):
+        return json.dumps(self.__dict__)
+
+
+def _center(item):
+    return item.get('x', 0) + item.get('width', 0) / 2, item.get('y', 0) + item.get('height', 0) / 2
+
+
+def _same_kind(a, b):
+    return a['name'] == b['name'] and a.get('class_name') == b.get('class_name')
+
+
+class DeltaEncoder(object):
+    def __init__(self, keyframe_interval=5.0, epsilon=0.01, heartbeat_interval=1.0, match_distance=0.2):
+        self.keyframe_interval = keyframe_interval
+        self.epsilon = epsilon
+        self.heartbeat_interval = heartbeat_interval
+        self.match_distance = match_distance
+        self.next_id = 0
+        self.sent = {}              # object id -> item as the clients last saw it
+        self.last_keyframe = None
+        self.last_send = 0
+        self.empty_sent = False
+
+    # Give each object an id, reusing the id of the nearest unclaimed object of the same kind.
+    # Objects that already carry an 'id' (e.g. from a tracker) keep it.
+    def _identify(self, objects):
+        unclaimed = dict(self.sent)
+        identified = {}
+
+        for item in objects:
+            if 'id' in item:
+                unclaimed.pop(item['id'], None)
+                identified[item['id']] = item
+                continue
+
+            best, best_distance = None, self.match_distance
+            cx, cy = _center(item)
+            for obj_id, previous in unclaimed.items():
+                if not _same_kind(item, previous):
+                    continue
+                px, py = _center(previous)
+                distance = max(abs(cx - px), abs(cy - py))
+                if distance <= best_distance:
+                    best, best_distance = obj_id, distance
+
+            if best is None:
+                self.next_id += 1
+                best = self.next_id
+            else:
+                del unclaimed[best]
+
+            identified[best] = dict(item, id=best)
+
+        return identified
+
+    # send a full keyframe on the next frame, e.g. when a new client joins
+    def force_keyframe(self):
+        self.last_keyframe = None
+
+    def _moved(self, item, previous):
+        for key in BOX_KEYS:
+            if key in item and abs(item[key] - previous.get(key, 0)) > self.epsilon:
+                return True
+        return False
+
+    # Feed every frame's output, with or without objects. Returns a StreamMessage to send, or None
+    def encode(self, output, now):
+        seq = getattr(output, 'seq', 0)
+        current = self._identify(output.objects)
+
+        if not current:
+            self.sent = {}
+            if not self.empty_sent:
+                self.empty_sent = True
+                self.last_send = now
+                return StreamMessage('empty', seq, now)
+            if now - self.last_send >= self.heartbeat_interval:
+                self.last_send = now
+                return StreamMessage('heartbeat', seq, now, numObjects=0)
+            return None
+
+        self.empty_sent = False
+
+        if self.last_keyframe is None or now - self.last_keyframe >= self.keyframe_interval:
+            self.sent = current
+            self.last_keyframe = self.last_send = now
+            return StreamMessage('key', seq, now, numObjects=len(current), objects=list(current.values()))
+
+        added = [item for obj_id, item in current.items() if obj_id not in self.sent]
+        removed = [obj_id for obj_id in self.sent if obj_id not in current]
+        moved = [item for obj_id, item in current.items()
+                 if obj_id in self.sent and self._moved(item, self.sent[obj_id])]
+
+        # remember what the clients have; objects that didn't move keep their last sent position
+        sent = {obj_id: self.sent.get(obj_id, item) for obj_id, item in current.items()}
+        for item in moved:
+            sent[item['id']] = item
+        self.sent = sent
+
+        if added or removed or moved:
+            self.last_send = now
+            return StreamMessage('delta', seq, now, numObjects=len(current),
+                                 added=added, removed=removed, moved=moved)
+
+        if now - self.last_send >= self.heartbeat_interval:
+            self.last_send = now
+            return StreamMessage('heartbeat', seq, now, numObjects=len(current))
+
+        return None
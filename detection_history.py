@@ -0,0 +1,142 @@
+# Recent detections kept in memory as NumPy columns
+#
+# A fixed-size ring of time, class id, score and normalized box, allocated once at start-up so memory
+# stays constant however long the server runs. Every detection from run_inference() is written here;
+# the oldest are overwritten once the ring is full. Class ids come from the history's own label table,
+# so "face" and other names never end up in the wire format hello; classification results have no
+# box and store NaN.
+#
+# Rows are written in time order, so the ring is at most two sorted runs and time ranges are found
+# with a binary search instead of a scan. Filtering, downsampling and aggregation are vectorized.
+
+from threading import Lock
+
+import numpy as np
+
+import metrics
+from wire_format import LabelTable
+
+stored = metrics.counter('history_detections_total', 'Detections written to the in-memory history')
+rows = metrics.gauge('history_rows', 'Detections held in the in-memory history')
+
+
+class DetectionHistory(object):
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.time = np.zeros(capacity, dtype=np.float64)
+        self.class_id = np.zeros(capacity, dtype=np.int16)
+        self.score = np.zeros(capacity, dtype=np.float32)
+        self.box = np.zeros((capacity, 4), dtype=np.float32)
+        self.position = 0       # next row to write
+        self.size = 0
+        self.labels = LabelTable()
+        self._lock = Lock()
+
+    # store every detection in an InferenceResult
+    def add(self, output, now):
+        detections = output.detections()
+        if not detections:
+            return
+        count = min(len(detections), self.capacity)
+        detections = detections[-count:]
+        class_ids = [self.labels.id(class_name) for class_name, _, _ in detections]
+        scores = [score for _, score, _ in detections]
+        boxes = [box if box is not None else (np.nan,) * 4 for _, _, box in detections]
+
+        with self._lock:
+            index = (self.position + np.arange(count)) % self.capacity
+            self.time[index] = now
+            self.class_id[index] = class_ids
+            self.score[index] = scores
+            self.box[index] = boxes
+            self.position = (self.position + count) % self.capacity
+            self.size = min(self.size + count, self.capacity)
+        stored.inc(count)
+        rows.set(self.size)
+
+    # row indexes with since <= time < until, oldest first
+    def _range(self, since, until):
+        if self.size < self.capacity:
+            runs = [(0, self.size)]
+        else:
+            runs = [(self.position, self.capacity), (0, self.position)]
+        parts = []
+        for start, end in runs:
+            times = self.time[start:end]
+            first = start + np.searchsorted(times, since, side='left') if since is not None else start
+            last = start + np.searchsorted(times, until, side='left') if until is not None else end
+            if last > first:
+                parts.append(np.arange(first, last))
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    # copies of the columns for a time range, filtered by class and score
+    def _select(self, since, until, class_name, min_score):
+        with self._lock:
+            index = self._range(since, until)
+            time = self.time[index]
+            class_id = self.class_id[index]
+            score = self.score[index]
+            box = self.box[index]
+
+        keep = np.ones(len(index), dtype=bool)
+        if class_name is not None:
+            keep &= class_id == self.labels.ids.get(class_name, -1)
+        if min_score is not None:
+            keep &= score >= min_score
+        return time[keep], class_id[keep], score[keep], box[keep]
+
+    # Detections in a time range. With more than max_points matches they are downsampled to the
+    # highest scoring detection of each class in max_points equal time buckets.
+    def query(self, since=None, until=None, class_name=None, min_score=None, max_points=1000):
+        time, class_id, score, box = self._select(since, until, class_name, min_score)
+        total = len(time)
+        bucket_seconds = None
+
+        if total > max_points > 0:
+            start, end = time[0], time[-1]
+            bucket_seconds = (end - start) / max_points or 1.0
+            bucket = np.minimum(((time - start) / bucket_seconds).astype(np.int64), max_points - 1)
+            # best score per (bucket, class): sort by group then score and keep each group's last row
+            group = bucket * (len(self.labels.labels) + 1) + class_id
+            order = np.lexsort((score, group))
+            last = np.ones(total, dtype=bool)
+            last[:-1] = group[order][1:] != group[order][:-1]
+            picked = np.sort(order[last])
+            if len(picked) > max_points:
+                picked = picked[np.argsort(-score[picked], kind='stable')[:max_points]]
+                picked.sort()
+            time, class_id, score, box = time[picked], class_id[picked], score[picked], box[picked]
+
+        names = self.labels.labels
+        boxes = np.where(np.isnan(box), None, np.round(box.astype(np.float64), 4).astype(object))
+        return {'since': since, 'until': until, 'total': total, 'returned': len(time),
+                'bucket_seconds': bucket_seconds,
+                'time': np.round(time, 3).tolist(), 'class': [names[i] for i in class_id.tolist()],
+                'score': np.round(score.astype(np.float64), 3).tolist(),
+                'x': boxes[:, 0].tolist(), 'y': boxes[:, 1].tolist(),
+                'width': boxes[:, 2].tolist(), 'height': boxes[:, 3].tolist()}
+
+    # Detection counts and the highest score per class in fixed intervals from since to until
+    def aggregate(self, since, until, interval, class_name=None, min_score=None):
+        time, class_id, score, _ = self._select(since, until, class_name, min_score)
+        buckets = max(int(np.ceil((until - since) / interval)), 1)
+        bucket = np.minimum(((time - since) / interval).astype(np.int64), buckets - 1)
+
+        counts = {}
+        max_score = {}
+        names = self.labels.labels
+        for cid in np.unique(class_id).tolist():
+            mine = class_id == cid
+            counts[names[cid]] = np.bincount(bucket[mine], minlength=buckets).tolist()
+            best = np.zeros(buckets)
+            np.maximum.at(best, bucket[mine], score[mine])
+            max_score[names[cid]] = np.round(best, 3).tolist()
+        return {'since': since, 'until': until, 'interval': interval, 'total': len(time),
+                'start': np.round(since + interval * np.arange(buckets), 3).tolist(),
+                'counts': counts, 'max_score': max_score}
+
+    def stats(self):
+        with self._lock:
+            oldest = float(self.time[self.position if self.size == self.capacity else 0]) if self.size else None
+        return {'capacity': self.capacity, 'rows': self.size, 'oldest': oldest,
+                'bytes': self.time.nbytes + self.class_id.nbytes + self.score.nbytes + self.box.nbytes}
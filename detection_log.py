@@ -0,0 +1,183 @@
+# Per-recording detection sidecar log
+#
+# Every result produced while a recording is open is appended to <id>_detections.bin as a length
+# prefixed wire_format frame (see wire_format.py), so it is keyed by the frame timeStamp and about
+# 30 bytes per object. Label ids in the frames belong to the process that wrote them, so the log
+# starts with a JSON {"labels": [...]} record, and another one follows whenever the label table
+# grows. When the recording closes a small seek index goes next to it in <id>_detections.json:
+#
+#   labels   the wire_format label table the frames were written with
+#   seek     [timeStamp, byte offset] about once a second, to start reading at a time
+#   classes  per class (or 'face'): count, max_score, first, last and spans of continuous presence
+#
+# The class summaries also go into the recording index so searches don't need to open any files.
+
+import os
+import json
+import struct
+from bisect import bisect_right
+
+import wire_format
+
+LENGTH = struct.Struct('<H')
+SPAN_GAP = 2.0      # seconds without a class before its span ends
+
+
+def sidecar_path(directory, recording_id):
+    return os.path.join(directory, '%d_detections.bin' % recording_id)
+
+
+def index_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def _labels_record(labels):
+    return json.dumps({'labels': labels}).encode()
+
+
+# Label records are JSON; wire_format frames start with the (binary) format version
+def _is_labels(record):
+    return record[:1] == b'{'
+
+
+def _class_name(item):
+    return item.get('class_name', item['name'])
+
+
+class SeekIndex(object):
+    def __init__(self, seek_interval=1.0):
+        self.seek_interval = seek_interval
+        self.seek = []
+        self.classes = {}
+        self.frames = 0
+        self._next_seek = None
+
+    def add(self, decoded, offset):
+        now = decoded['timeStamp']
+        self.frames += 1
+        if self._next_seek is None or now >= self._next_seek:
+            self.seek.append([now, offset])
+            self._next_seek = now + self.seek_interval
+
+        for item in decoded['objects']:
+            name = _class_name(item)
+            score = round(item['score'], 3)
+            stats = self.classes.get(name)
+            if stats is None:
+                stats = self.classes[name] = {'count': 0, 'max_score': 0, 'first': now, 'last': now, 'spans': []}
+            stats['count'] += 1
+            stats['max_score'] = max(stats['max_score'], score)
+            stats['last'] = now
+
+            spans = stats['spans']     # [start, end, max score]
+            if spans and now - spans[-1][1] <= SPAN_GAP:
+                spans[-1][1] = now
+                spans[-1][2] = max(spans[-1][2], score)
+            else:
+                spans.append([now, now, score])
+
+    def to_dict(self, labels):
+        return {'labels': list(labels), 'frames': self.frames, 'seek': self.seek, 'classes': self.classes}
+
+
+class DetectionLog(object):
+    def __init__(self, path, seek_interval=1.0):
+        self.path = path
+        self.file = open(path, 'ab', buffering=1 << 16)
+        self.offset = self.file.tell()
+        self.index = SeekIndex(seek_interval)
+        self.labels = []
+        self._write_labels()
+
+    def _write_labels(self):
+        self.labels = list(wire_format.labels.labels)
+        self._append(_labels_record(self.labels))
+
+    def _append(self, record):
+        self.file.write(LENGTH.pack(len(record)) + record)
+        self.offset += LENGTH.size + len(record)
+
+    # frame is a wire_format.encode() result
+    def write(self, frame):
+        if len(wire_format.labels.labels) > len(self.labels):
+            self._write_labels()
+        self.index.add(wire_format.decode(frame, self.labels), self.offset)
+        self._append(frame)
+
+    # Closes the sidecar and writes its seek index. Returns the per-class summary.
+    def close(self):
+        self.file.close()
+        partial = index_path(self.path) + '.part'
+        with open(partial, 'w') as f:
+            json.dump(self.index.to_dict(self.labels), f)
+        os.replace(partial, index_path(self.path))
+        return self.index.classes
+
+
+# (offset, record) pairs, up to a record cut short by a crash mid-write
+def _records(f):
+    while True:
+        header = f.read(LENGTH.size)
+        if len(header) < LENGTH.size:
+            return
+        offset = f.tell() - LENGTH.size
+        length = LENGTH.unpack(header)[0]
+        record = f.read(length)
+        if not record or len(record) < length:
+            return
+        yield offset, record
+
+
+# The seek index of a sidecar, rebuilt from the frames if the recording never closed cleanly
+def read_index(path):
+    try:
+        with open(index_path(path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    index = SeekIndex()
+    labels = None
+    with open(path, 'rb') as f:
+        for offset, record in _records(f):
+            if _is_labels(record):
+                labels = json.loads(record.decode())['labels']
+            elif labels is not None:
+                index.add(wire_format.decode(record, labels), offset)
+    return index.to_dict(labels or [])
+
+
+# Decoded frames between start and end (epoch seconds), optionally only objects of one class.
+# Label tables only grow, so the last one (kept in the index) decodes every frame.
+def read_frames(path, start=None, end=None, class_name=None, min_score=0, limit=None, index=None):
+    if limit is not None and limit < 1:
+        raise ValueError("limit must be 1 or more")
+    index = read_index(path) if index is None else index
+    labels = index['labels']
+
+    offset = 0
+    if start is not None and index['seek']:
+        position = bisect_right([t for t, _ in index['seek']], start) - 1
+        offset = index['seek'][max(position, 0)][1]
+
+    frames = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for _, record in _records(f):
+            if _is_labels(record):
+                continue
+            decoded = wire_format.decode(record, labels)
+            if start is not None and decoded['timeStamp'] < start:
+                continue
+            if end is not None and decoded['timeStamp'] > end:
+                break
+            objects = [o for o in decoded['objects']
+                       if (class_name is None or _class_name(o) == class_name) and o['score'] >= min_score]
+            if not objects:
+                continue
+            decoded['objects'] = objects
+            decoded['numObjects'] = len(objects)
+            frames.append(decoded)
+            if limit is not None and len(frames) >= limit:
+                break
+    return frames
@@ -0,0 +1,137 @@
+# Where in the frame things are seen, per class
+#
+# Each detection adds 1 to the grid cells its normalized box covers, on a fixed resolution grid per
+# class, and older contributions fade with an exponential half-life. Adding a box is O(1) however
+# big it is: boxes go into a 2D difference array (four corner updates) that is integrated with
+# cumulative sums only when the grid is read. Decay is lazy too - new boxes are weighted up by
+# exp(t / tau) instead of every cell being multiplied down each frame, and the weights are folded
+# back in (an O(cells) rescale) only when they get large.
+#
+# Decay scales every cell alike, so the normalized grid and its PNG only change when boxes are
+# added. Renders are cached per class and format until then.
+
+import struct
+import zlib
+from math import exp, log
+from threading import Lock
+from time import time
+
+import numpy as np
+
+
+# 256 color palette from transparent-ish dark blue through red to yellow/white
+def _palette():
+    level = np.linspace(0, 1, 256)
+    red = np.clip(level * 3, 0, 1)
+    green = np.clip(level * 3 - 1, 0, 1)
+    blue = np.clip(level * 3 - 2, 0, 1) + np.clip(0.5 - level * 3, 0, 0.5)
+    return (np.stack([red, green, blue], axis=1) * 255).astype(np.uint8).tobytes()
+
+
+PALETTE = _palette()
+
+
+def _chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+# 8 bit palette PNG from a 2D array of palette indexes
+def png(pixels):
+    height, width = pixels.shape
+    rows = np.hstack([np.zeros((height, 1), dtype=np.uint8), pixels.astype(np.uint8)])     # filter 0 per row
+    return b''.join([b'\x89PNG\r\n\x1a\n',
+                     _chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)),
+                     _chunk(b'PLTE', PALETTE),
+                     _chunk(b'IDAT', zlib.compress(rows.tobytes(), 9)),
+                     _chunk(b'IEND', b'')])
+
+
+class Heatmap(object):
+    def __init__(self, width=64, height=36, half_life=600.0, rescale_after=30.0):
+        self.width = width
+        self.height = height
+        self.tau = half_life / log(2)
+        self.rescale_after = rescale_after    # largest exponent before weights are folded back in
+        self.origin = None                    # time the current weights are relative to
+        self.diffs = {}                       # class name -> (height + 1, width + 1) difference array
+        self.version = 0
+        self.started = int(time() * 1000)     # versions restart with the process, so ETags need this too
+        self._cache = {}                      # (class, format, scale) -> (version, rendered)
+        self._lock = Lock()
+
+    def add(self, output, now):
+        detections = [(class_name, box) for class_name, _, box in output.detections() if box is not None]
+        if not detections:
+            return
+        with self._lock:
+            if self.origin is None:
+                self.origin = now
+            exponent = (now - self.origin) / self.tau
+            if exponent > self.rescale_after:
+                factor = exp(-exponent)
+                for diff in self.diffs.values():
+                    diff *= factor
+                self.origin = now
+                exponent = 0.0
+            weight = exp(exponent)
+
+            for class_name, (x, y, w, h) in detections:
+                diff = self.diffs.get(class_name)
+                if diff is None:
+                    diff = self.diffs[class_name] = np.zeros((self.height + 1, self.width + 1))
+                left = min(max(int(x * self.width), 0), self.width - 1)
+                top = min(max(int(y * self.height), 0), self.height - 1)
+                right = min(max(int(np.ceil((x + w) * self.width)), left + 1), self.width)
+                bottom = min(max(int(np.ceil((y + h) * self.height)), top + 1), self.height)
+                diff[top, left] += weight
+                diff[top, right] -= weight
+                diff[bottom, left] -= weight
+                diff[bottom, right] += weight
+            self.version += 1
+
+    @property
+    def classes(self):
+        return sorted(self.diffs)
+
+    # Decayed grid for a class, or all classes with class_name None. Returns (grid, version)
+    def grid(self, class_name=None, now=None):
+        with self._lock:
+            if class_name is None:
+                diffs = list(self.diffs.values())
+            else:
+                diffs = [self.diffs[class_name]] if class_name in self.diffs else []
+            total = sum(diffs) if diffs else np.zeros((self.height + 1, self.width + 1))
+            grid = total.cumsum(axis=0).cumsum(axis=1)[:self.height, :self.width]
+            if now is not None and self.origin is not None:
+                grid = grid * exp(-(now - self.origin) / self.tau)
+            return np.maximum(grid, 0), self.version      # cumsum rounding can leave tiny negatives
+
+    def _cached(self, key, render):
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == self.version:
+            return cached
+        grid, version = self.grid(key[0])
+        cached = self._cache[key] = (version, render(grid))
+        return cached
+
+    # JSON ready dict: the grid normalized to its peak, plus the peak in decayed detection-frames
+    def to_dict(self, class_name=None, now=None):
+        def render(grid):
+            peak = grid.max()
+            return np.round(grid / peak, 3).tolist() if peak > 0 else grid.tolist()
+
+        version, cells = self._cached((class_name, 'json', 1), render)
+        peak = self.grid(class_name, now)[0].max() if now is not None else None
+        return {'class': class_name, 'classes': self.classes, 'width': self.width, 'height': self.height,
+                'half_life': self.tau * log(2), 'version': version, 'peak': peak, 'grid': cells}
+
+    # PNG bytes and version, each cell scale x scale pixels
+    def png(self, class_name=None, scale=1):
+        def render(grid):
+            peak = grid.max()
+            pixels = (grid / peak * 255).astype(np.uint8) if peak > 0 else grid.astype(np.uint8)
+            if scale > 1:
+                pixels = pixels.repeat(scale, axis=0).repeat(scale, axis=1)
+            return png(pixels)
+
+        return self._cached((class_name, 'png', scale), render)
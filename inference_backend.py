@@ -0,0 +1,301 @@
+# Camera / inference sources consumed by run_inference()
+#
+# AiyBackend is the real PiCamera + Vision Bonnet path. SyntheticBackend and ReplayBackend produce
+# DecodedResult objects without any hardware so the socket, recording and HTTP paths can be
+# benchmarked and load-tested on an ordinary Linux box.
+
+import json
+import random
+from threading import Condition
+from time import time, sleep, monotonic
+
+import startup
+from aiy_model_output import Face, Object, DecodedResult, model_selector, decode_result
+
+
+# Common interface: use as a context manager, then iterate run(model) for inference results. Each
+# backend implements run(model) as a generator. model may also be a ModelSchedule, in which case
+# run() picks the model for each frame and yields DecodedResults so the caller can tell which model
+# produced each one.
+class InferenceBackend(object):
+    camera = None   # a PiCamera when the backend has one - recording needs it
+
+    def __init__(self, hres=1640, vres=922, framerate=15):
+        self.hres = hres
+        self.vres = vres
+        self.framerate = framerate
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # open() does nothing if already open, so it can be run early, e.g. alongside other startup steps
+    def open(self):
+        pass
+
+    # import or build what run(model) will need, without touching the camera
+    def prepare(self, model):
+        pass
+
+    # change the frame rate of a running source
+    def set_framerate(self, framerate):
+        self.framerate = framerate
+
+    def close(self):
+        pass
+
+
+# PiCamera and the AIY Vision Bonnet
+class AiyBackend(InferenceBackend):
+    def __init__(self, hres=1640, vres=922, framerate=15, cam_mode=5):
+        super(AiyBackend, self).__init__(hres, vres, framerate)
+        self.cam_mode = cam_mode
+        self._privacy_led = None
+
+    def open(self):
+        if self.camera:
+            return
+        from picamera import PiCamera
+        from aiy.leds import Leds, PrivacyLed
+
+        self.camera = PiCamera()
+        self._privacy_led = PrivacyLed(Leds())
+        self._privacy_led.__enter__()
+
+        self.camera.sensor_mode = self.cam_mode
+        self.camera.resolution = (self.hres, self.vres)
+        self.camera.framerate = self.framerate
+        self.camera.video_stabilization = True
+
+    # The frame rate can't be changed while recording, but framerate_delta can - the camera
+    # runs at framerate + framerate_delta
+    def set_framerate(self, framerate):
+        self.camera.framerate_delta = framerate - float(self.camera.framerate)
+
+    # after the model is loaded so the preview doesn't delay the first result
+    def _start_preview(self):
+        if not self.camera.preview:
+            self.camera.start_preview()  # fullscreen=True)
+
+    def prepare(self, model):
+        import aiy.vision.inference     # noqa: F401 - the import is the slow part
+        for name in getattr(model, 'models', [model]):
+            model_selector(name)
+
+    def close(self):
+        if self.camera:
+            if self.camera.preview:
+                self.camera.stop_preview()
+            self.camera.close()
+            self.camera = None
+        if self._privacy_led:
+            self._privacy_led.__exit__(None, None, None)
+            self._privacy_led = None
+
+    def run(self, model):
+        if not isinstance(model, str):
+            yield from self._run_schedule(model)
+            return
+        from aiy.vision.inference import CameraInference
+
+        tf_model = model_selector(model)
+        if tf_model == "nothing":
+            raise ValueError("No tensorflow model or invalid model specified: %s" % model)
+
+        with CameraInference(tf_model) as inference:
+            print("%s model loaded" % model)
+            startup.timeline.mark('model loaded')
+            self._start_preview()
+            for result in inference.run():
+                yield result
+
+    # Several models on one camera: all of them stay loaded on the Vision Bonnet and each frame is
+    # captured from the video port and sent through image inference with the model the schedule
+    # picks. Slower per frame than CameraInference, which can only stream to one model.
+    def _run_schedule(self, schedule):
+        import io
+        from PIL import Image
+        from aiy.vision.inference import InferenceEngine
+
+        # rgb captures are padded to multiples of 32 x 16
+        padded = ((self.hres + 31) // 32 * 32, (self.vres + 15) // 16 * 16)
+        frame = io.BytesIO()
+
+        with InferenceEngine() as engine:
+            names = {model: engine.load_model(model_selector(model)) for model in schedule.models}
+            print("%s models loaded" % ", ".join(schedule.models))
+            startup.timeline.mark('model loaded')
+            self._start_preview()
+            try:
+                while True:
+                    model = schedule.next(time())
+                    frame.seek(0)
+                    self.camera.capture(frame, format='rgb', use_video_port=True)
+                    image = Image.frombytes('RGB', padded, frame.getvalue())
+                    if padded != (self.hres, self.vres):
+                        image = image.crop((0, 0, self.hres, self.vres))
+                    yield decode_result(model, engine.image_inference(names[model], image))
+            finally:
+                for name in names.values():
+                    engine.unload_model(name)
+
+
+# Randomly moving boxes at a fixed frame rate
+class SyntheticBackend(InferenceBackend):
+    labels = ['PERSON', 'CAT', 'DOG']  # what the AIY object detection model reports
+
+    def __init__(self, hres=1640, vres=922, framerate=15, objects=2, seed=None):
+        super(SyntheticBackend, self).__init__(hres, vres, framerate)
+        self.objects = objects
+        self.random = random.Random(seed)
+
+    def _new_box(self):
+        w = self.random.uniform(0.1, 0.3) * self.hres
+        h = self.random.uniform(0.1, 0.3) * self.vres
+        return [self.random.uniform(0, self.hres - w), self.random.uniform(0, self.vres - h), w, h]
+
+    def _move(self, box):
+        box[0] = min(max(box[0] + self.random.uniform(-10, 10), 0), self.hres - box[2])
+        box[1] = min(max(box[1] + self.random.uniform(-10, 10), 0), self.vres - box[3])
+
+    def _detections(self, model, boxes):
+        if model == "face":
+            return [Face(tuple(b), self.random.uniform(0.5, 1), self.random.uniform(0, 1)) for b in boxes]
+        elif model == "object":
+            return [Object(tuple(b), self.labels[i % len(self.labels)], self.random.uniform(0.3, 1))
+                    for i, b in enumerate(boxes)]
+        elif model == "class":
+            return [(self.labels[i % len(self.labels)], self.random.uniform(0.3, 1)) for i in range(len(boxes))]
+        return []
+
+    def run(self, model):
+        schedule = None if isinstance(model, str) else model
+        print("synthetic %s source: %d objects at %s fps" %
+              (schedule.spec if schedule else model, self.objects, self.framerate))
+        boxes = [self._new_box() for _ in range(self.objects)]
+        next_frame = time()
+
+        while True:
+            for box in boxes:
+                self._move(box)
+            if schedule:
+                model = schedule.next(time())
+            yield DecodedResult(model, self._detections(model, boxes))
+
+            next_frame += 1 / self.framerate
+            delay = next_frame - time()
+            if delay > 0:
+                sleep(delay)
+            else:
+                next_frame = time()  # fell behind - don't try to catch up
+
+
+# Play back a file written by ResultRecorder at the original or an accelerated speed
+class ReplayBackend(InferenceBackend):
+    def __init__(self, path, hres=1640, vres=922, framerate=15, speed=1.0, loop=False):
+        super(ReplayBackend, self).__init__(hres, vres, framerate)
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+
+    # with a ModelSchedule the recorded interleaving of its models is replayed as it was
+    def run(self, model):
+        print("replaying %s at %sx" % (self.path, self.speed))
+        models = [model] if isinstance(model, str) else model.models
+        skipped = 0
+        while True:
+            start = time()
+            first = None
+
+            with open(self.path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if entry['model'] not in models:
+                        skipped += 1
+                        continue
+                    if first is None:
+                        first = entry['time']
+
+                    # speed <= 0 plays back as fast as possible
+                    if self.speed > 0:
+                        delay = (entry['time'] - first) / self.speed - (time() - start)
+                        if delay > 0:
+                            sleep(delay)
+
+                    yield DecodedResult.from_dict(entry)
+
+            if skipped:
+                print("skipped %d replay results that were not from the %s model" % (skipped, ", ".join(models)))
+                skipped = 0
+            if not self.loop:
+                return
+
+
+# Hand-off for switching the model of a running run_inference() loop.
+# The loop leaves the current model's inference, keeps the backend (and camera) open,
+# and calls complete() when the first result from the new model arrives.
+class ModelSwitch(object):
+    def __init__(self, model):
+        self.model = model
+        self.requested = None
+        self.last_switch_time = None    # seconds from request to first result of the new model
+        self._requested_at = None
+        self._done = Condition()
+
+    def request(self, model):
+        with self._done:
+            self.requested = model
+            self._requested_at = monotonic()
+
+    # True if the loop should stop the current model
+    def pending(self, current):
+        return self.requested is not None and self.requested != current
+
+    def complete(self):
+        with self._done:
+            if self.requested is None:
+                return
+            self.model = self.requested
+            self.last_switch_time = monotonic() - self._requested_at
+            self.requested = None
+            self._done.notify_all()
+            print("switched to %s model in %.3f seconds" % (self.model, self.last_switch_time))
+
+    # block until the requested switch has finished; returns False on timeout
+    def wait(self, timeout=None):
+        with self._done:
+            return self._done.wait_for(lambda: self.requested is None, timeout)
+
+    # give up on a request that was never completed, e.g. after wait() timed out
+    def cancel(self):
+        with self._done:
+            self.requested = None
+            self._done.notify_all()
+
+    def status(self):
+        return {'model': self.model, 'requested': self.requested, 'last_switch_time': self.last_switch_time}
+
+
+# Save decoded results as JSON lines so ReplayBackend can play them back later
+class ResultRecorder(object):
+    def __init__(self, path):
+        self.file = open(path, 'a', buffering=1)  # line buffered so a crash keeps what was captured
+
+    def write(self, decoded, now=None):
+        entry = decoded.to_dict()
+        entry['time'] = time() if now is None else now
+        self.file.write(json.dumps(entry) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+def backend_from_args(args):
+    if args.source == 'synthetic':
+        return SyntheticBackend(args.hres, args.vres, args.framerate, objects=args.synthetic_objects)
+    elif args.source == 'replay':
+        return ReplayBackend(args.replay_file, args.hres, args.vres, args.framerate, speed=args.replay_speed)
+    return AiyBackend(args.hres, args.vres, args.framerate, args.cam_mode)
@@ -1,3 +1,4 @@
 #!/usr/bin/env bash
+# Stream-copies one recording into an mp4 - see video_maker.py to process them all
 framerate=${2:-15}
-ffmpeg -framerate $framerate -n -i "concat:./recordings/$1_before.h264|./recordings/$1_after.h264" ./recordings/$1.mp4
\ No newline at end of file
+ffmpeg -framerate $framerate -n -i "concat:./recordings/$1_before.h264|./recordings/$1_after.h264" -c copy ./recordings/$1.mp4
@@ -0,0 +1,199 @@
+# Low-overhead metrics for the inference, socket and recording code
+#
+# Counters, gauges, fixed-bucket histograms and fixed-size sample windows (reported as quantiles).
+# Everything is preallocated; recording a value is a few attribute updates, no allocation.
+# Exposed in the Prometheus text format by /metrics and as JSON by /metrics.json.
+#
+# Updates are not locked: each metric is normally written by a single thread, and a lost
+# increment under contention is an acceptable price for staying off the inference path's back.
+
+from bisect import bisect_left
+from time import monotonic
+
+# seconds - covers sub-millisecond serialization up to multi-second SD card writes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [(self.name, None, self.value)]
+
+    def summary(self):
+        return self.value
+
+
+class Gauge(object):
+    type = 'gauge'
+
+    def __init__(self, name, help_text, function=None):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self.function = function    # read the value when collected instead of pushing it
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.function() if self.function else self.value
+
+    def samples(self):
+        return [(self.name, None, self.get())]
+
+    def summary(self):
+        return self.get()
+
+
+class Histogram(object):
+    type = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)     # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # context manager timing a block
+    def time(self):
+        return _Timer(self)
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            samples.append((self.name + '_bucket', 'le="%s"' % bound, cumulative))
+        samples.append((self.name + '_sum', None, self.sum))
+        samples.append((self.name + '_count', None, self.count))
+        return samples
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.sum, 'mean': self.sum / self.count if self.count else None}
+
+
+class _Timer(object):
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(monotonic() - self.start)
+
+
+# The last `size` observations in a preallocated ring, reported as quantiles. _sum and _count cover
+# every observation, as Prometheus expects them to only go up.
+class Window(object):
+    type = 'summary'
+    quantiles = (0.5, 0.95, 0.99)
+
+    def __init__(self, name, help_text, size=1000):
+        self.name = name
+        self.help = help_text
+        self.values = [0.0] * size
+        self.index = 0
+        self.full = False
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.values[self.index] = value
+        self.index += 1
+        if self.index == len(self.values):
+            self.index = 0
+            self.full = True
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return self.values[:] if self.full else self.values[:self.index]
+
+    def __len__(self):
+        return len(self.values) if self.full else self.index
+
+    def mean(self):
+        values = self.snapshot()
+        return sum(values) / len(values) if values else None
+
+    def quantile(self, q, values=None):
+        values = sorted(self.snapshot()) if values is None else values
+        if not values:
+            return None
+        return values[min(int(round(q * (len(values) - 1))), len(values) - 1)]
+
+    def samples(self):
+        values = sorted(self.snapshot())
+        samples = [(self.name, 'quantile="%s"' % q, self.quantile(q, values)) for q in self.quantiles]
+        samples.append((self.name + '_sum', None, self.sum))
+        samples.append((self.name + '_count', None, self.count))
+        return [s for s in samples if s[2] is not None]
+
+    def summary(self):
+        values = sorted(self.snapshot())
+        summary = {'count': len(values), 'mean': sum(values) / len(values) if values else None}
+        for q in self.quantiles:
+            summary['p%d' % round(q * 100)] = self.quantile(q, values)
+        return summary
+
+
+class Registry(object):
+    def __init__(self, prefix='aiy_'):
+        self.prefix = prefix
+        self.metrics = {}
+
+    def _add(self, cls, name, *args, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(self.prefix + name, *args, **kwargs)
+        return metric
+
+    def counter(self, name, help_text):
+        return self._add(Counter, name, help_text)
+
+    def gauge(self, name, help_text, function=None):
+        return self._add(Gauge, name, help_text, function)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram, name, help_text, buckets)
+
+    def window(self, name, help_text, size=1000):
+        return self._add(Window, name, help_text, size)
+
+    def prometheus(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, '{%s}' % labels if labels else '', value))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        return {name: metric.summary() for name, metric in self.metrics.items()}
+
+
+registry = Registry()
+
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+window = registry.window
@@ -0,0 +1,97 @@
+# Time-multiplexed multi-model schedule
+#
+# A spec like "object:3,face:1,class:1s" runs object detection on 3 frames for every 1 face frame,
+# and image classification once a second on top of those. Frame ratios are interleaved with smooth
+# weighted round robin (object, face, object, object rather than object x3 then face), and periodic
+# models take the next frame once they are due. Achieved per-model rates are measured over the
+# last few seconds so the throughput cost of each model is visible.
+
+from collections import deque
+
+import metrics
+from aiy_model_output import converters
+
+
+class ModelSchedule(object):
+    def __init__(self, spec, rate_window=10.0, min_window=1.0):
+        self.spec = spec
+        self.weights = {}       # model -> frames per round
+        self.periods = {}       # model -> seconds between runs
+        for part in spec.split(','):
+            model, _, share = part.strip().partition(':')
+            if model not in converters:
+                raise ValueError("No tensorflow model or invalid model specified: %s" % model)
+            if model in self.weights or model in self.periods:
+                raise ValueError("%s is in the schedule twice" % model)
+            share = share or '1'
+            try:
+                if share.endswith('s'):
+                    self.periods[model] = float(share[:-1])
+                else:
+                    self.weights[model] = int(share)
+            except ValueError:
+                raise ValueError("bad share %r for %s - use a frame count like 3 or a period like 1s" % (share, model))
+        if not self.weights or min(self.weights.values()) < 1 or any(p <= 0 for p in self.periods.values()):
+            raise ValueError("schedule %r needs at least one model with a frame count of 1 or more" % spec)
+
+        self.models = list(self.weights) + list(self.periods)
+        self.sequence = self._interleave()
+        self.position = 0
+        self.next_due = {model: 0 for model in self.periods}
+        self.rate_window = rate_window
+        # rates over less than this are noise, e.g. 2 frames in a few ms; a periodic model needs one period
+        self.min_window = min(rate_window, max([min_window] + list(self.periods.values())))
+        self.started = None
+        self.times = {model: deque() for model in self.models}
+        self.frames = {model: metrics.counter('schedule_%s_frames_total' % model,
+                                              'Frames the schedule gave to the %s model' % model)
+                       for model in self.models}
+
+    # True for "face,object" style specs, False for a single model name
+    @staticmethod
+    def is_spec(model):
+        return model is not None and (',' in model or ':' in model)
+
+    def _interleave(self):
+        total = sum(self.weights.values())
+        current = dict.fromkeys(self.weights, 0)
+        sequence = []
+        for _ in range(total):
+            for model, weight in self.weights.items():
+                current[model] += weight
+            model = max(current, key=current.get)
+            current[model] -= total
+            sequence.append(model)
+        return sequence
+
+    # model for the next frame
+    def next(self, now):
+        for model, period in self.periods.items():
+            if now >= self.next_due[model]:
+                # keep the cadence, but after a stall (or on the first frame) count from now so a late
+                # model doesn't take several frames in a row to catch up
+                due = self.next_due[model] + period
+                self.next_due[model] = due if due > now else now + period
+                return model
+        model = self.sequence[self.position]
+        self.position = (self.position + 1) % len(self.sequence)
+        return model
+
+    # call with each result to measure achieved rates
+    def record(self, model, now):
+        if self.started is None:
+            self.started = now
+        times = self.times[model]
+        times.append(now)
+        while times and times[0] < now - self.rate_window:
+            times.popleft()
+        self.frames[model].inc()
+
+    # results per second for each model over the rate window, None until min_window has passed
+    def rates(self, now):
+        span = min(self.rate_window, now - self.started) if self.started is not None else 0
+        rates = {}
+        for model, times in self.times.items():
+            recent = [t for t in list(times) if t >= now - self.rate_window]     # copy - the loop appends
+            rates[model] = round(len(recent) / span, 2) if span >= self.min_window else None
+        return rates
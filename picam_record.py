@@ -1,21 +1,59 @@
 # modified from: https://picamera.readthedocs.io/en/release-1.2/recipes2.html#splitting-to-from-a-circular-stream
 # Output needs to be entered into ffmpeg -
 #   example: ffmpeg -framerate 15 -i "concat:1535935485_before.h264|1535935485_after.h264" 1535935485.mp4
+#
+# Splits and pre-roll writes run on a recording worker thread. detection() only posts a command,
+# so a slow SD card never stalls the inference loop. The pre-roll is a fixed-size keyframe indexed
+# ring (see preroll.py) sized from the encoder bitrate.
 
 import io
 import os
-from time import time
+import queue
+from threading import Thread
+from time import time, monotonic
 
-from picamera import PiCameraCircularIO
+import metrics
+import wire_format
+from recording_index import open_index
+from detection_log import DetectionLog, sidecar_path
+from preroll import PrerollBuffer, capacity_for
 
 is_recording = False
-
-
-def init(before_detection=5, timeout=5, max_length=30):
-    global record_time_before_detection, no_detection_timeout, max_recording_length
+index = None                # RecordingIndex, opened by init()
+peak_score = 0              # highest detection score in the current recording
+on_opened = None            # called with the recording id once it is in the index
+on_closed = None            # called with the recording id once its after file is closed
+recording_dir = './recordings'
+
+write_seconds = metrics.histogram('recording_write_seconds', 'Time to write the pre-detection buffer to disk')
+bytes_written = metrics.counter('recording_bytes_written_total', 'Pre-detection buffer bytes written to disk')
+recordings = metrics.counter('recordings_total', 'Recordings started')
+command_seconds = metrics.histogram('recording_command_seconds', 'Time from posting a recording command to done')
+metrics.gauge('recording_backlog', 'Recording commands waiting for the worker', lambda: commands.qsize())
+metrics.gauge('preroll_bytes', 'Video held in the pre-roll buffer', lambda: len(stream) if stream else 0)
+metrics.gauge('preroll_capacity_bytes', 'Size of the pre-roll buffer', lambda: stream.capacity if stream else 0)
+
+commands = queue.Queue()    # (name, args, posted at) for the worker
+worker = None
+detection_log = None        # DetectionLog of the open recording, only touched by the worker
+stream = None               # PrerollBuffer
+write_buffer_size = 1 << 20     # bytes - gather the pre-roll into large writes
+
+
+def init(before_detection=5, timeout=5, max_length=30, directory='./recordings', bitrate=17000000,
+         keyframe_interval=1.0, max_preroll_bytes=None):
+    global record_time_before_detection, no_detection_timeout, max_recording_length, index, recording_dir
+    global video_bitrate, video_keyframe_interval, preroll_capacity
+    recording_dir = directory
+    video_bitrate = bitrate
+    video_keyframe_interval = keyframe_interval     # seconds
+    preroll_capacity = capacity_for(bitrate, before_detection, keyframe_interval)
+    if max_preroll_bytes:
+        preroll_capacity = min(preroll_capacity, max_preroll_bytes)
     record_time_before_detection = before_detection
     no_detection_timeout = timeout
     max_recording_length = max_length
+    index = open_index(directory)
 
 
 # Start recording
@@ -25,41 +63,105 @@ def start(cam):
     global camera, stream
     camera = cam
 
-    stream = PiCameraCircularIO(camera, seconds=record_time_before_detection)
-    camera.start_recording(stream, format='h264')
+    stream = PrerollBuffer(preroll_capacity, seconds=record_time_before_detection)
+    camera.start_recording(stream, format='h264', bitrate=video_bitrate, inline_headers=True,
+                           intra_period=max(int(camera.framerate * video_keyframe_interval), 1))
+    print("pre-roll buffer: %.1f MB" % (preroll_capacity / 1e6))
 
-    camera.wait_recording(5)  # make sure recording is loaded
+    global worker
+    worker = Thread(target=_worker, name='recording')
+    worker.start()
     print("recording initialized")
 
 
+# Finish any queued writes, then stop recording
+def stop():
+    global worker, is_recording
+    if is_recording:
+        _post('stop', recording_start_time, time(), peak_score)
+        is_recording = False
+    if worker is not None:
+        commands.put(None)
+        worker.join()
+        worker = None
+    camera.stop_recording()
+
+
+def _post(name, *args):
+    commands.put((name, args, monotonic()))
+
+
+def _worker():
+    while True:
+        command = commands.get()
+        if command is None:
+            return
+
+        name, args, posted = command
+        if name == 'log':
+            _log(*args)
+            continue
+        try:
+            if name == 'start':
+                # start recording frames after the initial detection
+                recording_id, after, before = args
+                _open_log(recording_id)
+                camera.split_recording(after)
+                # Write the "before" detection part of the circular buffer
+                write_video(stream, before)
+                index.open_recording(recording_id, recording_id, before, after)
+                if on_opened:
+                    on_opened(recording_id)
+            elif name == 'stop':
+                # Split here: finish the after file and start capturing to the stream again
+                recording_id, end_time, score = args
+                camera.split_recording(stream)
+                index.close_recording(recording_id, end_time, score)
+                _close_log(recording_id)
+                if on_closed:
+                    on_closed(recording_id)
+        except Exception as err:
+            print("recording %s failed: %s" % (name, err))
+
+        command_seconds.observe(monotonic() - posted)
+
+
+def _open_log(recording_id):
+    global detection_log
+    detection_log = DetectionLog(sidecar_path(recording_dir, recording_id))
+
+
+def _log(frame):
+    if detection_log is not None:
+        try:
+            detection_log.write(frame)
+        except (OSError, ValueError) as err:
+            print("detection log write failed: %s" % err)
+
+
+def _close_log(recording_id):
+    global detection_log
+    if detection_log is not None:
+        log, detection_log = detection_log, None
+        index.set_detections(recording_id, log.close())
+
+
 def write_video(stream, file):
-    # Write the entire content of the circular buffer to disk. No need to
-    # lock the stream here as we're definitely not writing to it
-    # simultaneously
-    with io.open(file, 'wb') as output:
-        for frame in stream.frames:
-            if frame.header:
-                stream.seek(frame.position)
-                break
-        while True:
-            buf = stream.read1()
-            if not buf:
-                break
-            output.write(buf)
-
-        print("wrote %s" % file)
-    # Wipe the circular stream once we're done
-    stream.seek(0)
-    stream.truncate()
+    # Write the pre-roll from its first usable keyframe, which also empties it. The camera has
+    # already been split to the after file, so nothing is writing to the buffer meanwhile.
+    with write_seconds.time(), io.open(file, 'wb', buffering=write_buffer_size) as output:
+        written = stream.write_to(output)
+        bytes_written.inc(written)
+    print("wrote %s (%d bytes)" % (file, written))
 
 
 before_file = "error.h264"
 after_file = "error.h264"
 
 
-def detection(detected):
+def detection(detected, score=0):
     # Recording
-    global is_recording, recording_start_time, last_detection_time, before_file, after_file
+    global is_recording, recording_start_time, last_detection_time, before_file, after_file, peak_score
 
 
     now = time()
@@ -67,26 +169,30 @@ def detection(detected):
     if detected:
         if not is_recording:
             print("Detection started")
+            recordings.inc()
             is_recording = True
             recording_start_time = int(now)
-            before_file = (os.path.join('./recordings', '%d_before.h264' % recording_start_time))
-            after_file = (os.path.join('./recordings', '%d_after.h264' % recording_start_time))
-            # start recording frames after the initial detection
-            camera.split_recording(after_file)
-            # Write the 10 seconds "before" detection
-            write_video(stream, before_file)
+            before_file = (os.path.join(recording_dir, '%d_before.h264' % recording_start_time))
+            after_file = (os.path.join(recording_dir, '%d_after.h264' % recording_start_time))
+            peak_score = 0
+            _post('start', recording_start_time, after_file, before_file)
 
         # write to disk if max recording length exceeded
         elif int(now) - recording_start_time > max_recording_length - record_time_before_detection:
             print("Max recording length reached. Writing %s" % after_file)
-            # Split here: write to after_file, and start capturing to the stream again
-            camera.split_recording(stream)
+            _post('stop', recording_start_time, now, max(peak_score, score))
             is_recording = False
 
+        peak_score = max(peak_score, score)
         last_detection_time = now
     else:
         if is_recording and int(now)-last_detection_time > no_detection_timeout:
             print("No more detections, writing %s" % after_file)
-            # Split here: write to after_file, and start capturing to the stream again
-            camera.split_recording(stream)
+            _post('stop', recording_start_time, now, peak_score)
             is_recording = False
+
+
+# Add an inference result with detections to the open recording's detection log
+def log_result(output):
+    if is_recording and output.numObjects:
+        _post('log', wire_format.encode(output))
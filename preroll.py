@@ -0,0 +1,127 @@
+# Pre-roll buffer for the recorder
+#
+# A picamera custom output holding the most recent H.264 in a fixed-size ring. The byte cap is set
+# up front from the encoder bitrate, so memory use doesn't depend on the scene. Stream positions
+# are absolute byte counts; the ring holds [start, end).
+#
+# As data is written the SPS NAL units (sent before every keyframe with inline headers) are indexed
+# in a deque. Entries are dropped from the left once overwritten, or once a newer keyframe is
+# already old enough to cover the pre-roll, so the first entry is always the keyframe to flush
+# from - no scanning of the buffer when a detection starts.
+
+from collections import deque
+from threading import Lock
+from time import monotonic
+
+START_CODE = b'\x00\x00\x01'
+SPS = 7     # NAL unit type
+
+
+# bytes needed to hold `seconds` of video plus a couple of keyframe intervals of slack
+def capacity_for(bitrate, seconds, keyframe_interval=1.0):
+    return int(bitrate / 8 * (seconds + 2 * keyframe_interval))
+
+
+class PrerollBuffer(object):
+    def __init__(self, capacity, seconds=None, clock=monotonic):
+        self.capacity = capacity
+        self.seconds = seconds      # pre-roll wanted; None keeps as much as fits
+        self.clock = clock
+        self.buffer = bytearray(capacity)
+        self.start = 0
+        self.end = 0
+        self.keyframes = deque()    # (stream offset, time) of each SPS in the buffer, oldest first
+        self._tail = b''            # last bytes written, for start codes split across writes
+        self._lock = Lock()
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _index(self, data, now):
+        # start codes split across the previous write and this one. With a 4 byte tail the byte
+        # before them is always known, so 4 byte start codes are indexed from their first zero.
+        tail = self._tail
+        window = tail + bytes(data[:4])
+        i = window.find(START_CODE, max(len(tail) - 3, 0))
+        while 0 <= i < len(tail):
+            if i + 3 < len(window) and window[i + 3] & 0x1F == SPS:
+                zero = i > 0 and window[i - 1] == 0
+                self.keyframes.append((self.end - len(tail) + i - zero, now))
+            i = window.find(START_CODE, i + 1)
+
+        # start codes whose NAL header is in this write; emulation prevention means they only
+        # appear at NAL boundaries, so there are a handful per write at most
+        n = len(data)
+        i = data.find(START_CODE)
+        while 0 <= i < n - 3:
+            if data[i + 3] & 0x1F == SPS:
+                zero = data[i - 1] == 0 if i > 0 else tail[-1:] == b'\x00'
+                self.keyframes.append((self.end + i - zero, now))
+            i = data.find(START_CODE, i + 3)
+
+        self._tail = (tail + bytes(data[-4:]))[-4:]
+
+    # called by picamera's encoder thread
+    def write(self, data):
+        n = len(data)
+        with self._lock:
+            now = self.clock()
+            self._index(data, now)
+
+            if n > self.capacity:
+                self.end += n - self.capacity
+                data = data[n - self.capacity:]
+            size = len(data)
+            position = self.end % self.capacity
+            first = min(size, self.capacity - position)
+            self.buffer[position:position + first] = data[:first]
+            if size > first:
+                self.buffer[:size - first] = data[first:]
+            self.end += size
+            self.start = max(self.start, self.end - self.capacity)
+
+            keyframes = self.keyframes
+            while keyframes and keyframes[0][0] < self.start:
+                keyframes.popleft()
+            if self.seconds is not None:
+                cutoff = now - self.seconds
+                while len(keyframes) > 1 and keyframes[1][1] <= cutoff:
+                    keyframes.popleft()
+        return n
+
+    # offset and time of the keyframe a flush would start from, None if there isn't one
+    def keyframe(self):
+        with self._lock:
+            return self.keyframes[0] if self.keyframes else None
+
+    # Write from the first usable keyframe to the end of the buffer, then empty it.
+    # Call after the camera has been split to another output - the lock blocks the encoder meanwhile.
+    def write_to(self, output):
+        with self._lock:
+            written = 0
+            if self.keyframes:
+                offset = self.keyframes[0][0]
+                length = self.end - offset
+                position = offset % self.capacity
+                view = memoryview(self.buffer)
+                first = min(length, self.capacity - position)
+                output.write(view[position:position + first])
+                if length > first:
+                    output.write(view[:length - first])
+                written = length
+            self._clear()
+        return written
+
+    def _clear(self):
+        self.start = self.end
+        self.keyframes.clear()
+        self._tail = b''
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def stats(self):
+        with self._lock:
+            return {'bytes': self.end - self.start, 'capacity': self.capacity, 'keyframes': len(self.keyframes),
+                    'seconds': self.clock() - self.keyframes[0][1] if self.keyframes else 0}
@@ -0,0 +1,115 @@
+# Adaptive camera frame rate and publish rate
+#
+# full       the configured frame rate
+# idle       no detections for idle_after seconds: camera and publishing drop to the idle floor.
+#            The first detection goes straight back to full
+# throttled  consumers are falling behind: socket/SSE messages were dropped (publish rate halves)
+#            or results arrive much slower than the camera rate (camera rate halves). Rates double
+#            again after recover_after seconds of keeping up
+#
+# update() is called for every inference result but only re-evaluates once per check_interval,
+# apart from the immediate ramp up on a detection.
+
+import metrics
+
+MODES = ('full', 'throttled', 'idle')
+
+mode_gauge = metrics.gauge('framerate_mode', 'Frame rate mode: 0 full, 1 throttled, 2 idle')
+camera_rate_gauge = metrics.gauge('camera_framerate', 'Camera frame rate set by the rate controller')
+publish_rate_gauge = metrics.gauge('publish_rate', 'Maximum results published per second')
+transitions = {mode: metrics.counter('framerate_mode_%s_total' % mode, 'Switches to the %s frame rate mode' % mode)
+               for mode in MODES}
+
+
+class RateController(object):
+    def __init__(self, full_rate, idle_rate=2.0, idle_after=30.0, min_rate=1.0, check_interval=1.0,
+                 recover_after=5.0, behind_factor=2.0, now=0.0):
+        self.full_rate = float(full_rate)
+        self.idle_rate = min(float(idle_rate), self.full_rate)
+        self.idle_after = idle_after
+        self.min_rate = min(min_rate, self.idle_rate)
+        self.check_interval = check_interval
+        self.recover_after = recover_after
+        self.behind_factor = behind_factor      # result interval / camera interval that counts as behind
+        self.mode = None
+        self.last_detection = now
+        self.last_behind = now
+        self.last_publish = None
+        self.interval = None        # smoothed time between results
+        self._dropped = 0
+        self._enter('full', now)
+
+    def _enter(self, mode, now):
+        if mode == 'full':
+            self.camera_rate = self.publish_rate = self.full_rate
+        elif mode == 'idle':
+            self.camera_rate = self.publish_rate = self.idle_rate
+        if mode != self.mode:
+            if self.mode is not None:
+                transitions[mode].inc()
+                print("frame rate mode %s: camera %.1f fps, publish %.1f/s" % (mode, self.camera_rate, self.publish_rate))
+            self.mode = mode
+            mode_gauge.set(MODES.index(mode))
+        camera_rate_gauge.set(self.camera_rate)
+        publish_rate_gauge.set(self.publish_rate)
+        self.interval = None
+        self._next_check = now + self.check_interval     # let the new rate settle before judging it
+        return True
+
+    # Returns True when the camera rate changed. dropped is the running total of messages dropped
+    # for slow consumers.
+    def update(self, now, detected, interval=None, dropped=0):
+        if interval is not None:
+            self.interval = interval if self.interval is None else 0.8 * self.interval + 0.2 * interval
+
+        if detected:
+            self.last_detection = now
+            if self.mode == 'idle':
+                self._enter('full', now)
+                return True
+
+        if now < self._next_check:
+            return False
+        self._next_check = now + self.check_interval
+
+        new_drops = dropped - self._dropped
+        self._dropped = dropped
+
+        if self.mode != 'idle' and now - self.last_detection >= self.idle_after:
+            return self._enter('idle', now)
+        if self.mode == 'idle':
+            return False
+
+        camera_rate = self.camera_rate
+        behind = self.interval is not None and self.interval > self.behind_factor / self.camera_rate
+        if new_drops or behind:
+            self.last_behind = now
+            if new_drops:
+                self.publish_rate = max(self.publish_rate / 2, self.min_rate)
+            if behind:
+                self.camera_rate = max(self.camera_rate / 2, self.min_rate)
+                self.publish_rate = min(self.publish_rate, self.camera_rate)
+            self._enter('throttled', now)
+        elif self.mode == 'throttled' and now - self.last_behind >= self.recover_after and \
+                (self.interval is None or self.interval < 1.2 / self.camera_rate):
+            self.camera_rate = min(self.camera_rate * 2, self.full_rate)
+            self.publish_rate = min(self.publish_rate * 2, self.camera_rate)
+            self.last_behind = now
+            if self.camera_rate == self.publish_rate == self.full_rate:
+                self._enter('full', now)
+            else:
+                self._enter('throttled', now)
+        return self.camera_rate != camera_rate
+
+    # True if a result at `now` should be published under the current publish rate
+    def should_publish(self, now):
+        if self.publish_rate >= self.camera_rate:
+            return True
+        if self.last_publish is not None and now - self.last_publish < 1 / self.publish_rate:
+            return False
+        self.last_publish = now
+        return True
+
+    def status(self):
+        return {'mode': self.mode, 'camera_rate': self.camera_rate, 'publish_rate': self.publish_rate,
+                'interval': self.interval}
@@ -0,0 +1,174 @@
+# Persistent index of recordings
+#
+# An SQLite table the recorder updates as it opens and closes segments, so listing recordings is a
+# single indexed query instead of a directory scan. Each row covers one <id>_before.h264 /
+# <id>_after.h264 pair, where id is the recording start time in epoch seconds.
+
+import os
+import re
+import sqlite3
+from threading import Lock
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (
+    id INTEGER PRIMARY KEY,
+    start_time REAL NOT NULL,
+    end_time REAL,
+    duration REAL,
+    size INTEGER DEFAULT 0,
+    mp4 TEXT DEFAULT 'none',
+    peak_score REAL DEFAULT 0,
+    before_file TEXT,
+    after_file TEXT,
+    thumbnail TEXT
+);
+CREATE INDEX IF NOT EXISTS recordings_start ON recordings (start_time);
+CREATE INDEX IF NOT EXISTS recordings_peak ON recordings (peak_score);
+CREATE INDEX IF NOT EXISTS recordings_mp4 ON recordings (mp4);
+CREATE TABLE IF NOT EXISTS detections (
+    recording_id INTEGER NOT NULL,
+    class_name TEXT NOT NULL,
+    count INTEGER,
+    max_score REAL,
+    first_time REAL,
+    last_time REAL,
+    PRIMARY KEY (recording_id, class_name)
+);
+CREATE INDEX IF NOT EXISTS detections_class ON detections (class_name, max_score);
+"""
+
+MP4_STATES = ('none', 'pending', 'done', 'failed')
+COLUMNS = ('id', 'start_time', 'end_time', 'duration', 'size', 'mp4', 'peak_score', 'before_file', 'after_file',
+           'thumbnail')
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class RecordingIndex(object):
+    def __init__(self, path='./recordings/index.sqlite'):
+        self.path = path
+        self._lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        # indexes made before thumbnails were added
+        if 'thumbnail' not in [row[1] for row in self.db.execute("PRAGMA table_info(recordings)")]:
+            self.db.execute("ALTER TABLE recordings ADD COLUMN thumbnail TEXT")
+
+    def _execute(self, sql, args=()):
+        with self._lock, self.db:
+            self.db.execute(sql, args)
+
+    def _fetch(self, sql, args=()):
+        with self._lock:
+            return self.db.execute(sql, args).fetchall()
+
+    # called by the recorder when the before file is written and the after file opened
+    def open_recording(self, recording_id, start_time, before_file, after_file):
+        self._execute("INSERT OR REPLACE INTO recordings (id, start_time, size, before_file, after_file) "
+                      "VALUES (?, ?, ?, ?, ?)",
+                      (recording_id, start_time, _size(before_file), before_file, after_file))
+
+    # called by the recorder when the after file is closed
+    def close_recording(self, recording_id, end_time, peak_score):
+        row = self.get(recording_id)
+        if row is None:
+            return
+        size = _size(row['before_file']) + _size(row['after_file'])
+        self._execute("UPDATE recordings SET end_time = ?, duration = ?, size = ?, "
+                      "peak_score = MAX(peak_score, ?) WHERE id = ?",
+                      (end_time, end_time - row['start_time'], size, peak_score, recording_id))
+
+    # per-class summary from the recording's detection log
+    def set_detections(self, recording_id, classes):
+        with self._lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO detections "
+                                "(recording_id, class_name, count, max_score, first_time, last_time) "
+                                "VALUES (?, ?, ?, ?, ?, ?)",
+                                [(recording_id, name, c['count'], c['max_score'], c['first'], c['last'])
+                                 for name, c in classes.items()])
+
+    def detections(self, recording_id):
+        rows = self._fetch("SELECT class_name, count, max_score, first_time, last_time FROM detections "
+                           "WHERE recording_id = ? ORDER BY max_score DESC", (recording_id,))
+        return {name: {'count': count, 'max_score': score, 'first': first, 'last': last}
+                for name, count, score, first, last in rows}
+
+    def set_thumbnail(self, recording_id, path):
+        self._execute("UPDATE recordings SET thumbnail = ? WHERE id = ?", (path, recording_id))
+
+    def set_mp4(self, recording_id, status):
+        if status not in MP4_STATES:
+            raise ValueError("unknown mp4 status %s" % status)
+        self._execute("UPDATE recordings SET mp4 = ? WHERE id = ?", (status, recording_id))
+
+    def get(self, recording_id):
+        rows = self._fetch("SELECT %s FROM recordings WHERE id = ?" % ', '.join(COLUMNS), (recording_id,))
+        return dict(zip(COLUMNS, rows[0])) if rows else None
+
+    # Newest first. `before` is a keyset cursor (an id from the previous page) which keeps deep pages
+    # as cheap as the first; `page` is the simple alternative for small offsets.
+    # With class_name, min_score applies to that class rather than to the recording's peak score.
+    def query(self, per_page=50, page=1, before=None, since=None, until=None, min_score=None, mp4=None,
+              class_name=None):
+        where, args = [], []
+        for clause, value in (("id < ?", before), ("start_time >= ?", since), ("start_time <= ?", until),
+                              ("peak_score >= ?", min_score if class_name is None else None), ("mp4 = ?", mp4)):
+            if value is not None:
+                where.append(clause)
+                args.append(value)
+        if class_name is not None:
+            where.append("id IN (SELECT recording_id FROM detections WHERE class_name = ? AND max_score >= ?)")
+            args += [class_name, min_score or 0]
+        where_sql = " WHERE " + " AND ".join(where) if where else ""
+
+        per_page = max(per_page, 1)
+        offset = 0 if before is not None else (max(page, 1) - 1) * per_page
+        rows = self._fetch("SELECT %s FROM recordings%s ORDER BY id DESC LIMIT ? OFFSET ?" %
+                           (', '.join(COLUMNS), where_sql), args + [per_page, offset])
+        recordings = [dict(zip(COLUMNS, row)) for row in rows]
+        return {
+            'recordings': recordings,
+            'next': recordings[-1]['id'] if len(recordings) == per_page else None
+        }
+
+    # Closed recordings still waiting for an mp4, oldest first. 'pending' ones were interrupted mid-job.
+    def mp4_jobs(self, limit=100, retry_failed=False):
+        states = ('none', 'pending', 'failed') if retry_failed else ('none', 'pending')
+        rows = self._fetch("SELECT %s FROM recordings WHERE end_time IS NOT NULL AND mp4 IN (%s) ORDER BY id LIMIT ?" %
+                           (', '.join(COLUMNS), ', '.join('?' * len(states))), states + (limit,))
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def count(self):
+        return self._fetch("SELECT COUNT(*) FROM recordings")[0][0]
+
+    # One-off import of recordings made before the index existed
+    def scan(self, directory='./recordings'):
+        ids = {}
+        for name in os.listdir(directory):
+            m = re.match(r"([0-9]{10,})(_before\.h264|_after\.h264|\.mp4)$", name)
+            if m:
+                ids.setdefault(int(m.group(1)), set()).add(m.group(2))
+
+        for recording_id, parts in ids.items():
+            before = os.path.join(directory, '%d_before.h264' % recording_id)
+            after = os.path.join(directory, '%d_after.h264' % recording_id)
+            end_time = os.path.getmtime(after) if '_after.h264' in parts else recording_id
+            self._execute("INSERT OR IGNORE INTO recordings "
+                          "(id, start_time, end_time, duration, size, mp4, before_file, after_file) "
+                          "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                          (recording_id, recording_id, end_time, end_time - recording_id,
+                           _size(before) + _size(after), 'done' if '.mp4' in parts else 'none', before, after))
+        print("indexed %d existing recordings in %s" % (len(ids), directory))
+
+
+def open_index(directory='./recordings'):
+    os.makedirs(directory, exist_ok=True)
+    index = RecordingIndex(os.path.join(directory, 'index.sqlite'))
+    if index.count() == 0:
+        index.scan(directory)
+    return index
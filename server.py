@@ -7,177 +7,209 @@
 # Walkthough and function details https://webrtchacks.com/aiy-vision-kit-uv4l-web-server/
 # Source repo: https://github.com/webrtcHacks/aiy_vision_web_server
 
-from threading import Thread, Event     # Multi-threading
-import queue                            # Multi-threading
-from time import time, sleep
+import startup                          # first, so the startup timeline covers the imports below
+from time import time
 from datetime import datetime           # Timing & stats output
-import socket                           # uv4l communication
 import os                               # help with connecting to the socket file
 import argparse                         # Commandline arguments
-import random                           # Used for performance testing
 
-from picamera import PiCamera           # PiCam hardware
-from flask import Flask, Response       # Web server
+from flask import Flask, Response, jsonify, request, send_file   # Web server
+from markupsafe import escape
+from werkzeug.http import http_date
 
-from aiy_model_output import model_selector, process_inference
+from aiy_model_output import decode_result, get_converter, converters
+from inference_backend import backend_from_args, ResultRecorder, ModelSwitch
 import picam_record as record
-
-# AIY requirements
-from aiy.leds import Leds
-from aiy.leds import PrivacyLed
-from aiy.vision.inference import CameraInference, ImageInference
-
-
-socket_connected = False
-q = queue.Queue(maxsize=1)  # we'll use this for inter-process communication
+from detection_log import sidecar_path, read_index, read_frames
+from socket_publisher import SocketPublisher, messages_dropped
+from tracing import Tracer
+from delta_stream import DeltaEncoder
+from broadcaster import Broadcaster, events_dropped
+from static_assets import AssetCache
+from supervisor import Supervisor
+from model_scheduler import ModelSchedule
+from subscriptions import Subscription, Subscriptions
+from detection_history import DetectionHistory
+from heatmap import Heatmap
+from snapshot import Snapshots
+import metrics
+import socket_load
+
+startup.timeline.add_phase('interpreter and imports', 0)
+
+tracer = Tracer()  # per-frame stage latencies
+
+
+def delivered(trace):
+    tracer.sent(trace)
+    startup.timeline.mark('first socket delivery')
+
+
+subscriptions = Subscriptions()  # client filters, evaluated once per frame for each distinct one
+publisher = SocketPublisher(on_sent=delivered, subscriptions=subscriptions)  # fans inference results out to the uv4l socket clients
+broadcaster = Broadcaster(subscriptions=subscriptions)  # and to HTTP Server-Sent Events subscribers
+
+frames = metrics.counter('inference_frames_total', 'Inference results processed')
+detections = metrics.counter('detections_total', 'Objects detected')
+inference_interval = metrics.window('inference_interval_seconds', 'Time between inference results', 100)
+metrics.gauge('socket_clients', 'Connected uv4l socket clients', lambda: len(publisher.client_stats()))
+metrics.gauge('stream_subscribers', 'Connected SSE subscribers', lambda: len(broadcaster.subscribers))
 # ToDo: remove these
 # capture_width = 1640        # The max horizontal resolution of PiCam v2
 # capture_height = 922        # Max vertical resolution on PiCam v2 with a 16:9 ratio
-time_log = []
-
-
-# Control connection to the linux socket and send messages to it
-def socket_data(run_event, send_rate=1/30):
-    socket_path = '/tmp/uv4l-raspidisp.socket'
-
-    # wait for a connection
-    def wait_to_connect():
-        global socket_connected
-
-        print('socket waiting for connection...')
-        while run_event.is_set():
-            try:
-                socket_connected = False
-                connection, client_address = s.accept()
-                print('socket connected')
-                socket_connected = True
-                send_data(connection)
-
-            except socket.timeout:
-                continue
-
-            except socket.error as err:
-                print("socket error: %s" % err)
-                break
-
-        print("closing socket")
-        s.close()
-        socket_connected = False
-
-    # continually send data as it comes in from the q
-    def send_data(connection):
-        while run_event.is_set():
-            try:
-                if q.qsize() > 0:
-                    message = q.get()
-                    connection.send(str(message).encode())
-
-                sleep(send_rate)
-            except socket.error as send_err:
-                print("connected socket error: %s" % send_err)
-                return
-
+model_switch = ModelSwitch(None)  # lets the web server change the model of the running inference loop
+active_schedule = None  # ModelSchedule when several models are interleaved
+delta_mode = False
+rate_control = None  # RateController with --adaptive-framerate
+history = None  # DetectionHistory of recent detections for /api/detections, made in main
+heatmap = None  # Heatmap of where detections are in the frame, made in main
+snapshots = None  # Snapshots from the camera, when the source has one
+supervisor = Supervisor()  # runs and restarts the worker threads
+
+
+# Serve detection results to every client connected to the uv4l socket
+def socket_data(run_event, heartbeat=None):
     try:
-        # Create the socket file if it does not exist
-        if not os.path.exists(socket_path):
-            f = open(socket_path, 'w')
-            f.close()
-
-        os.unlink(socket_path)
-        s = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
-        s.bind(socket_path)
-        s.listen(1)
-        s.settimeout(1)
-        wait_to_connect()
-    except socket.error as sock_err:
-        print("socket error: %s" % sock_err)
-        return
+        publisher.serve(run_event, heartbeat=heartbeat)
     except OSError:
-        if os.path.exists(socket_path):
-            print("Error accessing %s\nTry running 'sudo chown pi: %s'" % (socket_path, socket_path))
-            os._exit(0)
-            return
+        if os.path.exists(publisher.path):
+            print("Error accessing %s\nTry running 'sudo chown pi: %s'" % (publisher.path, publisher.path))
         else:
-            print("Socket file not found. Did you configure uv4l-raspidisp to use %s?" % socket_path)
-            raise
-
-
-# AIY Vision setup and inference
-def run_inference(run_event, model="face", framerate=15, cam_mode=5, hres=1640, vres=922, stats=False, recording=False):
-    # See the Raspicam documentation for mode and framerate limits:
-    # https://picamera.readthedocs.io/en/release-1.13/fov.html#sensor-modes
-    # Default to the highest resolution possible at 16:9 aspect ratio
+            print("Socket file not found. Did you configure uv4l-raspidisp to use %s?" % publisher.path)
+        raise   # the supervisor retries with backoff
 
-    global socket_connected, time_log
 
-    leds = Leds()
+# AIY Vision inference loop. The backend is opened by main() and stays open, with the camera and
+# any recording, if the supervisor has to restart this.
+def run_inference(run_event, backend, model="face", stats=False, recording=False, save_results=None,
+                  delta_encoder=None, tracker=None, heartbeat=None, rate_controller=None):
+    global active_schedule
 
-    with PiCamera() as camera, PrivacyLed(leds):
-        camera.sensor_mode = cam_mode
-        camera.resolution = (hres, vres)
-        camera.framerate = framerate
-        camera.video_stabilization = True
-        camera.start_preview()  # fullscreen=True)
+    recorder = ResultRecorder(save_results) if save_results else None
 
-        tf_model = model_selector(model)
+    try:
+        while run_event.is_set():
+            model_switch.model = model
+            try:
+                # a spec like "object:3,face:1" interleaves models; results then say which model they are from
+                schedule = active_schedule = ModelSchedule(model) if ModelSchedule.is_spec(model) else None
+                params = {'height': backend.vres, 'width': backend.hres}
+                converters_for = {m: get_converter(m, params) for m in (schedule.models if schedule else [model])}
+            except ValueError as err:
+                # unknown model - restarting won't help. Other errors go to the supervisor, which restarts
+                print("%s - stopping inference" % err)
+                return
+            current = model
+            last_time = time()  # measure inference time
+            last_trace_print = last_time
 
-        # this is not needed because the function defaults to "face"
-        if tf_model == "nothing":
-            print("No tensorflow model or invalid model specified - exiting..")
-            camera.stop_preview()
-            os._exit(0)
-            return
+            results = backend.run(schedule or model)
+            try:
+                for result in results:
+                    startup.timeline.mark('first inference result')
 
-        if recording:
-            record.start(camera)
+                    # exit on shutdown
+                    if not run_event.is_set():
+                        return
+                    if heartbeat:
+                        heartbeat()
 
-        try:
-            with CameraInference(tf_model) as inference:
-                print("%s model loaded" % model)
+                    # leave this model's inference; the backend and camera stay open
+                    if model_switch.requested is not None:
+                        if model_switch.pending(model):
+                            break
+                        model_switch.complete()     # first result from the new model
 
-                last_time = time()  # measure inference time
+                    trace = tracer.start()
 
-                for result in inference.run():
+                    if schedule:
+                        current = result.model
 
-                    # exit on shutdown
-                    if not run_event.is_set():
-                        camera.stop_preview()
-                        return
+                    if recorder:
+                        result = decode_result(current, result)
+                        recorder.write(result)
 
-                    output = process_inference(model, result, {'height':vres , 'width': hres})
+                    output = converters_for[current](result)
 
                     now = time()
+                    if schedule:
+                        output.model = current
+                        schedule.record(current, now)
+                    if tracker is not None:
+                        output.objects = tracker.update(output.objects, now)
+                    trace.mark('processed')
+
+                    output.seq = trace.seq
                     output.timeStamp = now
                     output.inferenceTime = (now - last_time)
                     last_time = now
 
+                    frames.inc()
+                    detections.inc(output.numObjects)
+                    inference_interval.observe(output.inferenceTime)
+
+                    # idle / burst / throttled frame rate
+                    publish = True
+                    if rate_controller is not None:
+                        if rate_controller.update(now, output.numObjects > 0, output.inferenceTime,
+                                                  messages_dropped.value + events_dropped.value):
+                            backend.set_framerate(rate_controller.camera_rate)
+                        publish = rate_controller.should_publish(now)
+
                     # Process detection
                     # No need to do anything else if there are no objects
                     if output.numObjects > 0:
+                        startup.timeline.mark('first detection')
+                        history.add(output, now)
+                        heatmap.add(output, now)
+                        if snapshots is not None:
+                            snapshots.detected()
 
                         # API Output
                         output_json = output.to_json()
+                        trace.mark('serialized')
                         print(output_json)
 
-                        # Send the json object if there is a socket connection
-                        if socket_connected is True:
-                            q.put(output_json)
+                        # Send the json object to any connected socket and HTTP stream clients
+                        if delta_encoder is None and publish:
+                            views = subscriptions.apply(output, now)
+                            publisher.publish(output, trace, {'json': output_json}, views)
+                            broadcaster.publish(output_json, views=views)
+
+                    # In delta mode every frame goes through the encoder, which decides what to send
+                    if delta_encoder is not None and publish:
+                        message = delta_encoder.encode(output, now)
+                        if message is not None:
+                            message_json = message.to_json()
+                            publisher.publish(message, trace, {'json': message_json})
+                            broadcaster.publish(message_json)
+
+                    tracer.finish(trace)
 
                     if recording:
-                        record.detection(output.numObjects > 0)
+                        record.detection(output.numObjects > 0, max(output.scores, default=0))
+                        record.log_result(output)
 
                     # Additional data to measure inference time
-                    if stats:
-                        time_log.append(output.inferenceTime)
-                        time_log = time_log[-10:]  # just keep the last 10 times
-                        print("Avg inference time: %s" % (sum(time_log)/len(time_log)))
-        finally:
-            camera.stop_preview()
-            if recording:
-                camera.stop_recording()
+                    if stats and now - last_trace_print > 10:
+                        print("Avg inference time: %s" % inference_interval.mean())
+                        tracer.print_summary()
+                        last_trace_print = now
+                else:
+                    return  # the source ran out
+            finally:
+                results.close()
+
+            model = model_switch.requested or model     # None if the request was cancelled meanwhile
+            if delta_encoder is not None:
+                delta_encoder.force_keyframe()
+    finally:
+        if recorder:
+            recorder.close()
 
 # Web server setup
-app = Flask(__name__)
+app = Flask(__name__, static_folder=None)   # static files come from the in-memory AssetCache
+assets = AssetCache('static')
 
 
 def flask_server():
@@ -186,32 +218,281 @@ def flask_server():
 
 @app.route('/')
 def index():
-    return Response(open('static/index.html').read(), mimetype="text/html")
+    return assets.get('index.html').response(request)
+
+
+@app.route('/static/<path:filename>')
+def static_file(filename):
+    asset = assets.get(filename)
+    if asset is None:
+        return Response("not found", status=404)
+    return asset.response(request)
 
 # Note: This won't be able to play the files without conversion.
 # Running ffmpeg while running inference & streaming will be too intensive for the Pi Zeros
 # Look to make this a user controlled process or do it in the browser
 @app.route('/recordings')
 def recordings():
-    # before_list = glob(os.getcwd() +  '/recordings/*_before.h264')
-    # after_list = glob(os.getcwd() + '/recordings/*_after.h264')
+    if record.index is None:
+        return Response("<HTML><TITLE>List of Recordings</TITLE><BODY><h2>Recording is not enabled</h2></BODY></HTML>")
 
-    # print(before_list)
-    # print(after_list)
+    try:
+        result = record.index.query(**recording_query_args())
+    except ValueError as err:
+        return Response("<HTML><TITLE>List of Recordings</TITLE><BODY><h2>%s</h2></BODY></HTML>" % escape(str(err)),
+                        status=400)
+
+    html_table = "<table><tr><th></th><th>Start</th><th>Duration</th><th>Size</th><th>Peak Score</th>" \
+                 "<th>Before Detection</th><th>After Detection</th><th>MP4</th></tr>"
+    for item in result['recordings']:
+        thumbnail = '<img src="/api/recordings/%d/thumbnail" width="160" loading="lazy">' % item['id'] \
+            if item['thumbnail'] else ""
+        html_table += "<tr><td>%s</td><td>%s</td><td>%s</td><td>%d</td><td>%.2f</td><td>%s</td><td>%s</td><td>%s</td></tr>" % (
+            thumbnail, datetime.fromtimestamp(item['start_time']).isoformat(sep=' '),
+            "%.1f s" % item['duration'] if item['duration'] is not None else "recording",
+            item['size'], item['peak_score'], escape(item['before_file']), escape(item['after_file']), item['mp4'])
+    html_table = html_table + "</table>"
 
-    files = [f for f in os.listdir('./recordings') if f.endswith(".h264")]
-    files.sort()
-    print(files)
+    more = '<a href="?before=%d">Older</a>' % result['next'] if result['next'] else ""
+    page = "<HTML><TITLE>List of Recordings</TITLE><BODY><h2>Recordings</h2>%s%s</BODY></HTML>" % (html_table, more)
+    return Response(page)
 
-    html_table = "<table><tr><th>Before Detection</th><th>After Detection</th></tr>"
-    # for i in range(len(before_list)):
-    #    html_table = html_table + "<tr><td>" + before_list[i] + "</td><td>" + after_list[i] + "</tr>"
 
-    html_table = html_table + "</table>"
-    print(html_table)
-    page = "<HTML><TITLE>List of Recordings</TITLE><BODY><h2>The list goes here</h2>%s</BODY></HTML>" % html_table
-    print(page)
-    return Response(page)
+# paginated, filterable recordings as JSON
+@app.route('/api/recordings')
+def recordings_api():
+    if record.index is None:
+        return jsonify(error="recording is not enabled"), 404
+    try:
+        return jsonify(record.index.query(**recording_query_args()))
+    except ValueError as err:
+        return jsonify(error=str(err)), 400
+
+
+# Raises ValueError for a page number below 1
+def recording_query_args():
+    args = request.args
+    page = args.get('page', 1, type=int)
+    if page < 1:
+        raise ValueError("page must be 1 or more")
+    return {
+        'per_page': max(1, min(args.get('per_page', 50, type=int), 500)),
+        'page': page,
+        'before': args.get('before', type=int),
+        'since': args.get('since', type=float),
+        'until': args.get('until', type=float),
+        'min_score': args.get('min_score', type=float),
+        'mp4': args.get('mp4'),
+        'class_name': args.get('class')
+    }
+
+
+# one recording with its per-class detection summary and spans
+@app.route('/api/recordings/<int:recording_id>')
+def recording_api(recording_id):
+    recording = record.index.get(recording_id) if record.index is not None else None
+    if recording is None:
+        return jsonify(error="no recording %d" % recording_id), 404
+
+    recording['detections'] = record.index.detections(recording_id)
+    path = sidecar_path(os.path.dirname(recording['after_file']), recording_id)
+    if os.path.exists(path):
+        classes = read_index(path)['classes']
+        for name, summary in recording['detections'].items():
+            summary['spans'] = classes.get(name, {}).get('spans', [])
+    return jsonify(recording)
+
+
+# small JPEG taken when the recording started
+@app.route('/api/recordings/<int:recording_id>/thumbnail')
+def recording_thumbnail(recording_id):
+    recording = record.index.get(recording_id) if record.index is not None else None
+    if recording is None or not recording['thumbnail'] or not os.path.exists(recording['thumbnail']):
+        return jsonify(error="no thumbnail for recording %d" % recording_id), 404
+    return send_file(os.path.abspath(recording['thumbnail']), mimetype='image/jpeg', max_age=3600)
+
+
+# detections logged during a recording, for searching inside it or drawing overlays at playback
+@app.route('/api/recordings/<int:recording_id>/detections')
+def recording_detections(recording_id):
+    recording = record.index.get(recording_id) if record.index is not None else None
+    if recording is None:
+        return jsonify(error="no recording %d" % recording_id), 404
+    path = sidecar_path(os.path.dirname(recording['after_file']), recording_id)
+    if not os.path.exists(path):
+        return jsonify(error="no detection log for recording %d" % recording_id), 404
+
+    args = request.args
+    limit = args.get('limit', 1000, type=int)
+    if limit < 1:
+        return jsonify(error="limit must be 1 or more"), 400
+    frames = read_frames(path, start=args.get('start', type=float), end=args.get('end', type=float),
+                         class_name=args.get('class'), min_score=args.get('min_score', 0, type=float),
+                         limit=min(limit, 10000))
+    return jsonify(id=recording_id, start_time=recording['start_time'], frames=frames)
+
+
+# Recent detections from the in-memory history, by default the last 10 minutes. since and until are
+# epoch seconds. With interval, counts and best scores per class in buckets of that many seconds
+@app.route('/api/detections')
+def detections_api():
+    args = request.args
+    until = args.get('until', time(), type=float)
+    since = args.get('since', until - 600, type=float)
+    if until <= since:
+        return jsonify(error="until must be after since"), 400
+    class_name = args.get('class')
+    min_score = args.get('min_score', type=float)
+
+    interval = args.get('interval', type=float)
+    if interval is not None:
+        if interval <= 0 or (until - since) / interval > 10000:
+            return jsonify(error="interval must be positive and give at most 10000 buckets"), 400
+        return jsonify(history.aggregate(since, until, interval, class_name, min_score))
+    max_points = max(1, min(args.get('max_points', 1000, type=int), 10000))
+    return jsonify(history.query(since, until, class_name, min_score, max_points))
+
+
+# Where detections have been in the frame. class picks one class; the default is all of them
+@app.route('/api/heatmap')
+def heatmap_json():
+    class_name = request.args.get('class')
+    if class_name is not None and class_name not in heatmap.classes:
+        return jsonify(error="nothing seen of class %s yet - seen %s" % (class_name, ", ".join(heatmap.classes))), 404
+    return jsonify(heatmap.to_dict(class_name, time()))
+
+
+# The same as a PNG, scale pixels per grid cell. Only re-rendered after new detections
+@app.route('/api/heatmap.png')
+def heatmap_png():
+    class_name = request.args.get('class')
+    scale = min(max(request.args.get('scale', 1, type=int), 1), 8)
+    version, image = heatmap.png(class_name, scale)
+    etag = 'heatmap-%d-%d-%s-%d' % (heatmap.started, version, class_name or 'all', scale)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(image, mimetype='image/png')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+# Prometheus scrape endpoint
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.registry.prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+# the same metrics plus per-client details as JSON
+@app.route('/metrics.json')
+def metrics_summary():
+    return jsonify(metrics=metrics.registry.summary(), socket_clients=publisher.client_stats(),
+                   stream=broadcaster.stats(), subscriptions=subscriptions.status(), history=history.stats())
+
+
+# per-stage pipeline latency percentiles
+@app.route('/api/trace')
+def trace_summary():
+    return jsonify(tracer.summary())
+
+
+# Server-Sent Events feed of detection results for dashboards and other services.
+# class, min_score, region and max_rate narrow it down, e.g. ?class=PERSON&min_score=0.7
+@app.route('/api/stream')
+def stream():
+    subscription = None
+    if request.args:
+        try:
+            subscription = Subscription.parse(request.args)
+        except ValueError as err:
+            return jsonify(error=str(err)), 400
+    subscriber = broadcaster.subscribe(subscription)
+    if subscriber is None:
+        return jsonify(error="too many stream subscribers"), 503
+
+    return Response(subscriber.events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# show or change the active model without restarting the camera
+@app.route('/api/model', methods=['GET', 'POST'])
+def active_model():
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        if data is None:
+            data = request.form
+        elif not isinstance(data, dict):
+            return jsonify(error="expected a JSON object like {\"model\": \"face\"}"), 400
+        model = data.get('model')
+        if not isinstance(model, str):
+            return jsonify(error="model must be a string - use one of %s" % ", ".join(converters)), 400
+        if ModelSchedule.is_spec(model):
+            try:
+                ModelSchedule(model)
+            except ValueError as err:
+                return jsonify(error=str(err)), 400
+            if delta_mode:
+                return jsonify(error="model schedules can't be used with the delta stream mode"), 400
+        elif model not in converters:
+            return jsonify(error="unknown model %s - use one of %s" % (model, ", ".join(converters))), 400
+
+        # only the running inference loop completes a switch, so don't wait on one that isn't there
+        worker = supervisor.workers.get('inference')
+        if worker is None or worker.state != 'running':
+            return jsonify(dict(model_switch.status(), error="inference is not running")), 503
+
+        model_switch.request(model)
+        if not model_switch.wait(timeout=10):
+            model_switch.cancel()
+            return jsonify(dict(model_switch.status(), error="model switch timed out")), 504
+
+    status = model_switch.status()
+    if active_schedule is not None and ModelSchedule.is_spec(model_switch.model):
+        status['rates'] = active_schedule.rates(time())
+    return jsonify(status)
+
+
+# startup phases and time to first result, detection and socket delivery
+@app.route('/api/startup')
+def startup_timeline():
+    return jsonify(startup.timeline.summary())
+
+
+# adaptive frame rate mode and current camera and publish rates
+@app.route('/api/framerate')
+def framerate():
+    if rate_control is None:
+        return jsonify(error="adaptive frame rate is off - start with --adaptive-framerate"), 404
+    return jsonify(rate_control.status())
+
+
+# worker thread states, restarts and mean time to recover
+@app.route('/api/workers')
+def workers():
+    return jsonify(supervisor.status())
+
+
+# Latest camera still. One taken within max_age seconds (default 5) is reused; otherwise a new one
+# is captured, shared by every request waiting for it
+@app.route('/snapshot')
+def snapshot():
+    if snapshots is None:
+        return jsonify(error="no camera to take snapshots with"), 404
+    try:
+        latest = snapshots.get(request.args.get('max_age', 5, type=float))
+    except Exception as err:
+        return jsonify(error="snapshot failed: %s" % err), 503
+    if latest is None:
+        return jsonify(error="snapshot failed"), 503
+    if request.if_none_match.contains(latest.etag):
+        response = Response(status=304)
+    else:
+        response = Response(latest.data, mimetype='image/jpeg')
+    response.set_etag(latest.etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Last-Modified'] = http_date(latest.taken)
+    return response
 
 
 # test route to verify the flask is working
@@ -222,27 +503,8 @@ def ping():
 
 @app.route('/socket-test')
 def socket_test():
-    return Response(open('static/socket-test.html').read(), mimetype="text/html")
-
-'''
-def socket_tester(rate):
-    output = ApiObject()
-    last_time = False
-    count = 0
-
-    while True:
-        if socket_connected is True:
-            count += 1
-            current_time = time()
-            output.time = (datetime.utcnow()-datetime.utcfromtimestamp(0)).total_seconds()*1000
-            output.data = ''.join(random.choice("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789") for _ in range(1000))
-            output.count = count
-            q.put(output.to_json())
-            print("count, timestamp, delta:     %s    %s    %s" % (output.count, current_time, current_time - last_time))
-            last_time = current_time
+    return assets.get('socket-test.html').response(request)
 
-        sleep(rate)
-'''
 
 
 # Main control logic to parse args and spawn threads
@@ -255,7 +517,8 @@ def main(webserver):
         '-m',
         dest='model',
         default='face',
-        help='Sets the model to use: "face", "object", or "class"')
+        help='Sets the model to use: "face", "object", or "class". Several models can share the camera with '
+             'a schedule like "object:3,face:1,class:1s" - frames per round, or seconds between runs')
     parser.add_argument(
         '--cam-mode',
         '-c',
@@ -288,68 +551,252 @@ def main(webserver):
         '--stats',
         '-s',
         action='store_true',
-        help='Show average inference timing statistics')
+        help='Print average inference time and pipeline latency percentiles every 10 seconds')
     parser.add_argument(
         '--perftest',
         '-t',
         dest='perftest',
         action='store_true',
-        help='Start socket performance test')
+        help='Load test the uv4l socket publisher instead of running inference. See the --perf-* options')
+    socket_load.add_arguments(parser, 'perf-')
     parser.add_argument(
         '--record',
         '-r',
         dest='record',
         action='store_true',
         help='Record')
+    parser.add_argument(
+        '--stream-mode',
+        dest='stream_mode',
+        default='full',
+        choices=['full', 'delta'],
+        help='Send a "full" result on every frame with detections, or "delta" keyframes and changes')
+    parser.add_argument(
+        '--keyframe-interval',
+        type=float,
+        dest='keyframe_interval',
+        default=5.0,
+        help='Seconds between full keyframes in delta stream mode. Default is 5')
+    parser.add_argument(
+        '--delta-epsilon',
+        type=float,
+        dest='delta_epsilon',
+        default=0.01,
+        help='Normalized box movement that counts as a change in delta stream mode. Default is 0.01')
+    parser.add_argument(
+        '--track',
+        dest='track',
+        action='store_true',
+        help='Track objects across frames and add stable ids, smoothed boxes and velocities')
+    parser.add_argument(
+        '--source',
+        dest='source',
+        default='camera',
+        choices=['camera', 'synthetic', 'replay'],
+        help='Inference source: the AIY "camera", "synthetic" detections, or "replay" of a results file')
+    parser.add_argument(
+        '--synthetic-objects',
+        type=int,
+        dest='synthetic_objects',
+        default=2,
+        help='Objects per frame for the synthetic source. Default is 2')
+    parser.add_argument(
+        '--replay-file',
+        dest='replay_file',
+        help='Results file to play back with --source replay')
+    parser.add_argument(
+        '--replay-speed',
+        type=float,
+        dest='replay_speed',
+        default=1.0,
+        help='Playback speed multiplier for --source replay, 0 for as fast as possible. Default is 1')
+    parser.add_argument(
+        '--save-results',
+        dest='save_results',
+        help='Append decoded inference results to this file for later replay')
+    parser.add_argument(
+        '--watch-static',
+        dest='watch_static',
+        default=False,
+        action='store_true',
+        help='Reload files in static/ when they change - for development')
+    parser.add_argument(
+        '--adaptive-framerate',
+        dest='adaptive_framerate',
+        default=False,
+        action='store_true',
+        help='Drop to --idle-framerate when nothing has been detected for a while, and throttle when '
+             'clients fall behind. Returns to --framerate on the first detection')
+    parser.add_argument(
+        '--idle-framerate',
+        type=float,
+        dest='idle_framerate',
+        default=2,
+        help='Camera frame rate while idle with --adaptive-framerate. Default is 2')
+    parser.add_argument(
+        '--idle-after',
+        type=float,
+        dest='idle_after',
+        default=30,
+        help='Seconds without detections before going idle with --adaptive-framerate. Default is 30')
+    parser.add_argument(
+        '--history-size',
+        type=int,
+        dest='history_size',
+        default=100000,
+        help='Detections kept in memory for /api/detections, about 30 bytes each. Default is 100000')
+    parser.add_argument(
+        '--heatmap-half-life',
+        type=float,
+        dest='heatmap_half_life',
+        default=600,
+        help='Seconds for a detection to fade to half weight in /api/heatmap. Default is 600')
+    parser.add_argument(
+        '--snapshot-interval',
+        type=float,
+        dest='snapshot_interval',
+        default=1,
+        help='Minimum seconds between snapshot captures for /snapshot. Default is 1')
+    parser.add_argument(
+        '--startup-report',
+        dest='startup_report',
+        default=False,
+        action='store_true',
+        help='Print the startup timeline once the first detection is made. Also at /api/startup')
+    parser.add_argument(
+        '--make-videos',
+        dest='make_videos',
+        default=False,
+        action='store_true',
+        help='Convert recordings to mp4 in the background while inference is keeping up. Requires --record')
+    parser.add_argument(
+        '--ffmpeg',
+        dest='ffmpeg',
+        default='ffmpeg',
+        help='ffmpeg executable used by --make-videos. Default is ffmpeg')
     # ToDo: Add recorder parameters
     parser.epilog = 'For more info see the github repo: https://github.com/webrtcHacks/aiy_vision_web_server/' \
                     ' or the webrtcHacks blog post: https://webrtchacks.com/?p=2824'
     args = parser.parse_args()
 
-    is_running = Event()
-    is_running.set()
+    if args.source == 'replay' and not args.replay_file:
+        parser.error("--source replay requires --replay-file")
 
-    '''
-    if args.perftest:
-        print("Socket performance test mode")
+    model = args.model
+    if ModelSchedule.is_spec(args.model):
+        try:
+            model = ModelSchedule(args.model)
+        except ValueError as err:
+            parser.error(str(err))
+        if args.stream_mode == 'delta':
+            parser.error("model schedules can't be used with --stream-mode delta")
+    elif args.model not in converters:
+        parser.error("unknown model %s - use one of %s" % (args.model, ", ".join(converters)))
 
-        # run this independent of a flask connection so we can test it with the uv4l console
-        socket_thread = Thread(target=socket_data, args=(is_running, 1/1000,))
-        socket_thread.start()
+    if args.startup_report:
+        startup.timeline.report_on('first detection')
 
-        socket_test_thread = Thread(target=socket_tester,
-                              args=(0.250,))
-        socket_test_thread.start()
+    if args.perftest:
+        # only the socket layer: no camera, inference or web server
+        publisher.max_clients = max(publisher.max_clients, args.perf_clients)
+        supervisor.add('socket', socket_data, heartbeat_timeout=10)
+        supervisor.start()
+        try:
+            socket_load.run_from_args(publisher, args)
+        finally:
+            supervisor.stop(5)
+        return
 
-    else:
-    '''
+    if args.watch_static:
+        assets.watch()
 
+    # The camera, model imports and recording index don't depend on each other - set them up
+    # at the same time. The backend stays open; an inference restart reuses it.
+    backend = backend_from_args(args)
+    steps = [('camera init', backend.open), ('model prefetch', lambda: backend.prepare(model))]
     if args.record:
-        record.init(before_detection=5, timeout=5, max_length=30)
+        steps.append(('recording index', lambda: record.init(before_detection=5, timeout=5, max_length=30)))
+    startup.run_concurrently(steps)
+
+    if args.make_videos and args.record:
+        from video_maker import VideoMaker
+
+        # hold off while results arrive noticeably slower than the best rate seen for the active model
+        best_interval = {}
+
+        def inference_busy():
+            interval = inference_interval.quantile(0.5)
+            if interval is None:
+                return False
+            best = best_interval[model_switch.model] = min(best_interval.get(model_switch.model, interval), interval)
+            return interval > 1.5 * best
+
+        video_maker = VideoMaker(record.index, workers=1, framerate=args.framerate, ffmpeg=args.ffmpeg,
+                                 throttle=inference_busy)
+        record.on_closed = video_maker.notify
+        supervisor.add('video-maker', video_maker.serve)
 
     # run this independent of a flask connection so we can test it with the uv4l console
-    socket_thread = Thread(target=socket_data, args=(is_running, 1 / args.framerate,))
-    socket_thread.start()
+    supervisor.add('socket', socket_data, heartbeat_timeout=10)
 
     # thread for running AIY Tensorflow inference
-    detection_thread = Thread(target=run_inference,
-                              args=(is_running, args.model, args.framerate, args.cam_mode,
-                                    args.hres, args.vres, args.stats, args.record))
-    detection_thread.start()
-
-    # run Flask in the main thread
-    webserver.run(debug=False, host='0.0.0.0')
-
-    # close threads when flask is done
-    print("exiting...")
-    is_running.clear()
-    '''
-    if args.perftest:
-        socket_test_thread.join(0)
-    else:
-        detection_thread.join(0)
-    '''
-    socket_thread.join(0)
+    global delta_mode, rate_control, history, heatmap, snapshots
+    history = DetectionHistory(args.history_size)
+    heatmap = Heatmap(half_life=args.heatmap_half_life)
+    delta_encoder = None
+    delta_mode = args.stream_mode == 'delta'
+    if delta_mode:
+        delta_encoder = DeltaEncoder(keyframe_interval=args.keyframe_interval, epsilon=args.delta_epsilon)
+        publisher.on_connect = delta_encoder.force_keyframe  # new clients need the whole scene
+
+    tracker = None
+    if args.track:
+        from tracker import Tracker     # needs numpy
+        tracker = Tracker()
+
+    # an inference restart resumes with whichever model was active
+    with backend:
+        recording = args.record
+        if recording and backend.camera is None:
+            print("%s has no camera to record from - recording disabled" % type(backend).__name__)
+            recording = False
+        if recording:
+            record.start(backend.camera)
+
+        if backend.camera is not None:
+            snapshots = Snapshots(backend.camera, args.snapshot_interval)
+            supervisor.add('snapshot', snapshots.serve)
+
+            # each recording gets a thumbnail from when it started
+            def recording_opened(recording_id):
+                path = os.path.join(record.recording_dir, '%d_thumb.jpg' % recording_id)
+                snapshots.thumbnail(path, lambda: record.index.set_thumbnail(recording_id, path))
+            record.on_opened = recording_opened
+
+        if args.adaptive_framerate:
+            from rate_controller import RateController
+            rate_control = RateController(args.framerate, args.idle_framerate, args.idle_after, now=time())
+
+        def inference(run_event, heartbeat):
+            run_inference(run_event, backend, model_switch.model or args.model, args.stats, recording,
+                          args.save_results, delta_encoder, tracker, heartbeat=heartbeat,
+                          rate_controller=rate_control)
+
+        supervisor.add('inference', inference, heartbeat_timeout=30)
+        supervisor.start()
+
+        try:
+            # run Flask in the main thread
+            startup.timeline.mark('web server starting')
+            webserver.run(debug=False, host='0.0.0.0')
+        finally:
+            # stop the workers when flask is done, then drain what they left queued
+            print("exiting...")
+            broadcaster.close()
+            supervisor.stop(timeout=5)
+            if recording:
+                record.stop()     # finishes queued recording writes
+            print("mean time to recover: %s" % supervisor.status()['mttr'])
 
 
 if __name__ == '__main__':
@@ -4,7 +4,7 @@ import subprocess
 
 socket_path = '/tmp/uv4l-raspidisp.socket'
 
-REQUIRED_PACKAGES = ['Flask', 'argparse', 'picamera']
+REQUIRED_PACKAGES = ['Flask', 'argparse', 'picamera', 'numpy']
 
 setup(
     name='aiy_vision_web_server',
@@ -0,0 +1,126 @@
+# Still JPEG snapshots from the running camera
+#
+# Captures come from the video port on their own splitter port, so they don't disturb recording
+# or inference. The latest snapshot is kept in memory for /snapshot. New captures happen:
+#   - on detection frames, at most once per min_interval, in the snapshot worker thread so the
+#     inference loop never waits for the camera
+#   - on demand when a request wants something newer than the latest one. Concurrent requests
+#     share a single capture, and min_interval still bounds the capture rate
+# The worker also writes a small thumbnail for each recording when it starts.
+
+import io
+import queue
+from threading import Condition, Event
+from time import time
+
+import metrics
+
+captures = metrics.counter('snapshot_captures_total', 'Snapshot JPEGs captured from the camera')
+shared = metrics.counter('snapshot_requests_shared_total', 'Snapshot requests served by a capture already in progress')
+capture_seconds = metrics.histogram('snapshot_capture_seconds', 'Time to capture a snapshot JPEG')
+
+
+class Snapshot(object):
+    def __init__(self, data, taken, number):
+        self.data = data
+        self.taken = taken      # epoch seconds
+        self.etag = 'snapshot-%d-%d' % (int(taken), number)
+
+    def age(self):
+        return time() - self.taken
+
+
+class Snapshots(object):
+    def __init__(self, camera, min_interval=1.0, quality=85, thumbnail_size=(320, 180), splitter_port=3):
+        self.camera = camera
+        self.min_interval = min_interval
+        self.quality = quality
+        self.thumbnail_size = thumbnail_size
+        self.splitter_port = splitter_port
+        self.latest = None
+        self.number = 0
+        self._capturing = False
+        self._done = Condition()
+        self._wanted = Event()      # a detection frame asked for a capture
+        self._thumbnails = queue.Queue()
+
+    def _capture(self, resize=None):
+        output = io.BytesIO()
+        with capture_seconds.time():
+            self.camera.capture(output, format='jpeg', use_video_port=True, resize=resize,
+                                quality=self.quality, splitter_port=self.splitter_port)
+        captures.inc()
+        return output.getvalue()
+
+    # The latest snapshot if it is at most max_age seconds old, otherwise a new one. Callers arriving
+    # while a capture is running get that capture's result; none are taken within min_interval.
+    # Only one capture (snapshot or thumbnail) uses the splitter port at a time.
+    def get(self, max_age=None):
+        with self._done:
+            limit = max(max_age if max_age is not None else 0, self.min_interval)
+            waited = False
+            while True:
+                if self.latest is not None and self.latest.age() <= limit:
+                    return self.latest
+                if not self._capturing:
+                    break
+                if not waited:
+                    shared.inc()
+                    waited = True
+                self._done.wait()   # a thumbnail or failed capture leaves nothing new, so check again
+            self._capturing = True
+
+        snapshot = None
+        try:
+            snapshot = Snapshot(self._capture(), time(), self.number + 1)
+        finally:
+            with self._done:
+                if snapshot is not None:
+                    self.latest = snapshot
+                    self.number += 1
+                self._capturing = False
+                self._done.notify_all()
+        return snapshot
+
+    # Call for every detection frame; never blocks. The worker captures if the latest is old enough.
+    def detected(self):
+        if self.latest is None or self.latest.age() >= self.min_interval:
+            self._wanted.set()
+
+    # Write a thumbnail to path from the worker, then call done()
+    def thumbnail(self, path, done=None):
+        self._thumbnails.put((path, done))
+        self._wanted.set()
+
+    def _write_thumbnail(self, path, done):
+        with self._done:
+            self._done.wait_for(lambda: not self._capturing)
+            self._capturing = True
+        try:
+            data = self._capture(resize=self.thumbnail_size)
+        finally:
+            with self._done:
+                self._capturing = False
+                self._done.notify_all()
+        with open(path, 'wb') as f:
+            f.write(data)
+        if done:
+            done()
+
+    # Worker: handles detection captures and thumbnails until run_event is cleared
+    def serve(self, run_event, poll_interval=1.0):
+        while run_event.is_set():
+            if not self._wanted.wait(poll_interval):
+                continue
+            self._wanted.clear()
+            try:
+                while not self._thumbnails.empty():
+                    self._write_thumbnail(*self._thumbnails.get())
+                self.get()
+            except Exception as err:
+                print("snapshot capture failed: %s" % err)
+
+    def status(self):
+        latest = self.latest
+        return {'captures': self.number, 'age': latest.age() if latest else None,
+                'bytes': len(latest.data) if latest else None, 'min_interval': self.min_interval}
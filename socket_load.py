@@ -0,0 +1,336 @@
+# Socket load and soak test
+#
+# Publishes messages of a given size at a given rate through the real SocketPublisher to any number
+# of reader processes (separate processes, so they don't compete with the publisher for the GIL)
+# and reports, every few seconds and at the end:
+#   throughput    messages and MB per second published and received
+#   latency       publish() to recv() percentiles - readers stamp with the same monotonic clock
+#   drops         messages the publisher dropped for slow readers and sequence gaps readers saw
+#   memory        resident set size of the publishing process and its growth since the first report
+#
+# server.py --perftest runs this against socket_data() under the supervisor; run this file directly
+# to test SocketPublisher on its own, or with --print to dump what a running server sends.
+#
+# Messages are JSON so the /socket-test page can show them too:
+#   {"name": "socket test", "count": 1, "sent": <monotonic s>, "time": <epoch ms>, "data": "xxx..."}
+
+import argparse
+import json
+import multiprocessing
+import queue
+import random
+import socket
+from threading import Thread, Event
+from time import monotonic, time, sleep
+
+import numpy as np
+
+import socket_publisher
+from socket_publisher import SocketPublisher
+
+RESERVOIR = 100000      # latency samples kept for the overall percentiles, so a soak uses fixed memory
+
+
+def rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+# Publishes size-byte messages rate times a second until run_event is cleared; rate 0 is flat out
+class LoadGenerator(object):
+    def __init__(self, publisher, size=1000, rate=30.0):
+        self.publisher = publisher
+        self.rate = rate
+        self.count = 0
+        self.bytes = 0
+        header = len(self._message(0, 0.0))
+        self.padding = ''.join(random.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in range(max(size - header, 0)))
+
+    def _message(self, count, sent, padding=''):
+        return '{"name": "socket test", "count": %d, "sent": %.6f, "time": %.3f, "data": "%s"}' % \
+               (count, sent, time() * 1000, padding)
+
+    def run(self, run_event):
+        next_send = monotonic()
+        while run_event.is_set():
+            self.count += 1
+            message = self._message(self.count, monotonic(), self.padding).encode()
+            if self.publisher.publish(message):
+                self.bytes += len(message)
+            else:
+                self.count -= 1     # no readers yet
+
+            if self.rate > 0:
+                next_send += 1 / self.rate
+                delay = next_send - monotonic()
+                if delay > 0:
+                    sleep(delay)
+                else:
+                    next_send = monotonic()     # fell behind - don't try to catch up
+            elif self.count % 100 == 0:
+                sleep(0)    # let the serving thread run
+
+
+# Reader process: receives until stop is set, sending a stats dict to results every interval.
+# delay sleeps after each message to simulate a slow reader.
+def read_messages(client_id, path, size, delay, interval, results, stop):
+    connection = None
+    deadline = monotonic() + 10
+    while connection is None:
+        try:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            connection.connect(path)
+        except OSError:
+            connection.close()
+            connection = None
+            if monotonic() > deadline or stop.is_set():
+                results.put({'id': client_id, 'error': "could not connect to %s" % path})
+                return
+            sleep(0.1)
+    connection.settimeout(0.2)
+
+    received = gaps = received_bytes = 0
+    latencies = []
+    last_count = None
+    next_report = monotonic() + interval
+    while not stop.is_set():
+        try:
+            data = connection.recv(size + 4096)
+        except socket.timeout:
+            data = None
+        except OSError as err:
+            results.put({'id': client_id, 'error': str(err)})
+            return
+        now = monotonic()
+        if data == b'':
+            results.put({'id': client_id, 'error': "disconnected"})
+            return
+
+        if data:
+            received += 1
+            received_bytes += len(data)
+            message = json.loads(data.decode())
+            if 'sent' in message:
+                latencies.append(now - message['sent'])
+            count = message.get('count')
+            if count is not None:
+                if last_count is not None and count > last_count + 1:
+                    gaps += count - last_count - 1
+                last_count = count
+            if delay:
+                sleep(delay)
+
+        if now >= next_report:
+            results.put({'id': client_id, 'received': received, 'bytes': received_bytes, 'gaps': gaps,
+                         'latencies': latencies})
+            received = gaps = received_bytes = 0
+            latencies = []
+            next_report += interval
+    results.put({'id': client_id, 'received': received, 'bytes': received_bytes, 'gaps': gaps,
+                 'latencies': latencies})
+    connection.close()
+
+
+def percentiles(samples):
+    if len(samples) == 0:
+        return None
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {'p50': p50 * 1000, 'p95': p95 * 1000, 'p99': p99 * 1000, 'max': float(np.max(samples)) * 1000}
+
+
+def _latency_text(latency):
+    if latency is None:
+        return "latency -"
+    return "latency p50 %.2f p95 %.2f p99 %.2f max %.2f ms" % (latency['p50'], latency['p95'], latency['p99'], latency['max'])
+
+
+# Reader reports from the results queue: totals, plus a uniform reservoir sample of every latency
+class _Collector(object):
+    def __init__(self, results):
+        self.results = results
+        self.totals = {'received': 0, 'bytes': 0, 'gaps': 0}
+        self.reservoir = np.zeros(RESERVOIR)
+        self.samples = 0
+        self.errors = []
+
+    # returns the stats and latencies reported since the last call
+    def collect(self):
+        period = dict.fromkeys(self.totals, 0)
+        latencies = []
+        while True:
+            try:
+                stats = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if 'error' in stats:
+                self.errors.append("client %d: %s" % (stats['id'], stats['error']))
+                print("socket client %d: %s" % (stats['id'], stats['error']))
+                continue
+            for key in period:
+                period[key] += stats[key]
+            latencies.extend(stats['latencies'])
+
+        for latency in latencies:
+            if self.samples < RESERVOIR:
+                self.reservoir[self.samples] = latency
+            else:
+                slot = random.randrange(self.samples + 1)
+                if slot < RESERVOIR:
+                    self.reservoir[slot] = latency
+            self.samples += 1
+        for key in self.totals:
+            self.totals[key] += period[key]
+        return period, latencies
+
+
+# Drive publisher with a LoadGenerator and reader processes, printing a line every interval.
+# publisher must already be serving. duration 0 runs until interrupted. Returns the summary dict.
+def run(publisher, size=1000, rate=30.0, clients=1, duration=60.0, client_delay=0.0, interval=5.0):
+    print("socket load test: %d byte messages at %s/s to %d client%s for %s" %
+          (size, rate or "max", clients, "s" if clients != 1 else "",
+           "%d s" % duration if duration else "ever"))
+
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    stop = context.Event()
+    readers = [context.Process(target=read_messages, name='socket-reader-%d' % i,
+                               args=(i, publisher.path, size, client_delay, interval, results, stop), daemon=True)
+               for i in range(clients)]
+    for reader in readers:
+        reader.start()
+
+    generator = LoadGenerator(publisher, size, rate)
+    run_event = Event()
+    run_event.set()
+    generator_thread = Thread(target=generator.run, args=(run_event,), name='load-generator', daemon=True)
+    generator_thread.start()
+
+    collected = _Collector(results)
+    dropped_at_start = socket_publisher.messages_dropped.value
+    start = last = monotonic()
+    last_sent = 0
+    first_rss = None
+    try:
+        while not duration or monotonic() - start < duration:
+            sleep(max(0, min(interval, duration - (monotonic() - start))) if duration else interval)
+            period, latencies = collected.collect()
+
+            now = monotonic()
+            elapsed = now - last
+            memory = rss()
+            if first_rss is None:
+                first_rss = memory
+            print("%7.1f s  sent %6.0f/s  recv %6.0f/s %6.2f MB/s  %s  dropped %d gaps %d  rss %.1f MB (%+.1f)" %
+                  (now - start, (generator.count - last_sent) / elapsed, period['received'] / elapsed,
+                   period['bytes'] / elapsed / 1e6, _latency_text(percentiles(latencies)),
+                   socket_publisher.messages_dropped.value - dropped_at_start, period['gaps'],
+                   (memory or 0) / 1e6, ((memory or 0) - (first_rss or 0)) / 1e6))
+            last, last_sent = now, generator.count
+    except KeyboardInterrupt:
+        pass
+    finally:
+        run_event.clear()
+        stop.set()
+        generator_thread.join(1)
+        for reader in readers:
+            reader.join(2)
+            if reader.is_alive():
+                reader.terminate()
+    collected.collect()     # what the readers received since their last report
+
+    elapsed = monotonic() - start
+    memory = rss()
+    summary = {'size': size, 'rate': rate, 'clients': clients, 'client_delay': client_delay,
+               'seconds': round(elapsed, 1), 'sent': generator.count, 'received': collected.totals['received'],
+               'sent_per_second': generator.count / elapsed,
+               'received_per_second': collected.totals['received'] / elapsed,
+               'received_mb_per_second': collected.totals['bytes'] / elapsed / 1e6,
+               'latency_ms': percentiles(collected.reservoir[:min(collected.samples, RESERVOIR)]),
+               'dropped': socket_publisher.messages_dropped.value - dropped_at_start, 'gaps': collected.totals['gaps'],
+               'rss_mb': memory / 1e6 if memory else None,
+               'rss_growth_mb': (memory - first_rss) / 1e6 if memory and first_rss else None,
+               'errors': collected.errors}
+    print("socket load test: %d sent (%.0f/s), %d received by %d clients (%.0f/s, %.2f MB/s), %s, "
+          "%d dropped, %d gaps, rss growth %s MB" %
+          (summary['sent'], summary['sent_per_second'], summary['received'], clients,
+           summary['received_per_second'], summary['received_mb_per_second'],
+           _latency_text(summary['latency_ms']), summary['dropped'], summary['gaps'],
+           "%.1f" % summary['rss_growth_mb'] if summary['rss_growth_mb'] is not None else "-"))
+    return summary
+
+
+def add_arguments(parser, prefix=''):
+    parser.add_argument('--%ssize' % prefix, type=int, dest='perf_size', default=1000,
+                        help='Message size in bytes. Default is 1000')
+    parser.add_argument('--%srate' % prefix, type=float, dest='perf_rate', default=30,
+                        help='Messages per second, 0 for as fast as possible. Default is 30')
+    parser.add_argument('--%sclients' % prefix, type=int, dest='perf_clients', default=1,
+                        help='Concurrent reader processes. Default is 1')
+    parser.add_argument('--%sduration' % prefix, type=float, dest='perf_duration', default=60,
+                        help='Seconds to run, 0 to run until interrupted. Default is 60')
+    parser.add_argument('--%sclient-delay' % prefix, type=float, dest='perf_client_delay', default=0,
+                        help='Seconds each reader sleeps per message, to simulate slow readers')
+    parser.add_argument('--%sreport-interval' % prefix, type=float, dest='perf_interval', default=5,
+                        help='Seconds between report lines. Default is 5')
+    parser.add_argument('--%soutput' % prefix, dest='perf_output',
+                        help='Append the summary as a JSON line to this file, for comparing runs')
+
+
+def run_from_args(publisher, args):
+    summary = run(publisher, args.perf_size, args.perf_rate, args.perf_clients, args.perf_duration,
+                  args.perf_client_delay, args.perf_interval)
+    if args.perf_output:
+        with open(args.perf_output, 'a') as f:
+            f.write(json.dumps(dict(summary, time=time())) + "\n")
+    return summary
+
+
+# Print whatever a running server sends on the socket
+def print_messages(path):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    connection.connect(path)
+    try:
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                print("server closed the socket")
+                return
+            print(data.decode(errors='replace') if data[:1] == b'{' else repr(data))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test SocketPublisher on its own')
+    parser.add_argument('--path', default=socket_publisher.socket_path, help='Socket path')
+    parser.add_argument('--print', dest='print_only', action='store_true',
+                        help="Don't publish - connect to a running server and print what it sends")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.print_only:
+        print_messages(args.path)
+        return
+
+    publisher = SocketPublisher(args.path, max_clients=max(args.perf_clients, 8))
+    run_event = Event()
+    run_event.set()
+    serving = Thread(target=publisher.serve, args=(run_event,), name='socket', daemon=True)
+    serving.start()
+    try:
+        run_from_args(publisher, args)
+    finally:
+        run_event.clear()
+        serving.join(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+# Event-driven publisher for the uv4l data channel socket
+#
+# Accepts any number of SEQPACKET clients on the uv4l socket path. Each client gets its own bounded
+# ring buffer: when a reader stalls the oldest message is dropped and counted instead of blocking
+# the inference thread. The serving thread sleeps in select() and is woken as soon as something is published.
+#
+# Clients pick their encoding by sending {"encoding": "json"} or {"encoding": "binary"} over the socket.
+# Each published result is encoded once per encoding in use, no matter how many clients share it.
+#
+# They can also send {"subscribe": {...}} to only receive some of the detections (see subscriptions.py),
+# or {"subscribe": null} to go back to everything.
+
+import json
+import os
+import selectors
+import socket
+from collections import deque
+from threading import Lock
+
+import metrics
+import wire_format
+from subscriptions import Subscription
+
+socket_path = '/tmp/uv4l-raspidisp.socket'
+
+messages_sent = metrics.counter('socket_messages_sent_total', 'Messages written to uv4l socket clients')
+messages_dropped = metrics.counter('socket_messages_dropped_total', 'Messages dropped for slow socket clients')
+send_errors = metrics.counter('socket_send_errors_total', 'Socket clients lost to send or receive errors')
+connections = metrics.counter('socket_connections_total', 'Socket clients accepted')
+
+
+# A connected reader with its own drop-oldest queue
+class SocketClient(object):
+    def __init__(self, connection, client_id, max_queue=4):
+        self.connection = connection
+        self.id = client_id
+        self.queue = deque(maxlen=max_queue)
+        self.sent = 0
+        self.dropped = 0
+        self.encoding = 'json'
+        self.subscription = None    # key in the publisher's Subscriptions, None for everything
+        self.writable_wait = False  # True while registered for EVENT_WRITE
+
+    def push(self, message):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+            messages_dropped.inc()
+        self.queue.append(message)
+
+    def stats(self):
+        return {'id': self.id, 'encoding': self.encoding, 'sent': self.sent, 'dropped': self.dropped,
+                'queued': len(self.queue), 'subscribed': self.subscription is not None}
+
+
+# encoding name -> function turning a published result into bytes
+encoders = {
+    'json': lambda output: output.to_json().encode(),
+    'binary': wire_format.encode
+}
+
+# encoding name -> greeting sent to a client when it switches to that encoding
+hellos = {
+    'binary': wire_format.hello
+}
+
+
+class SocketPublisher(object):
+    def __init__(self, path=socket_path, max_clients=8, client_queue=4, on_sent=None, subscriptions=None):
+        self.path = path
+        self.subscriptions = subscriptions  # Subscriptions registry; clients can't subscribe without one
+        self.on_sent = on_sent  # called with the publish() trace after each successful client write
+        self.on_connect = None  # called with no arguments when a client connects
+        self.max_clients = max_clients
+        self.client_queue = client_queue
+        self._clients = {}
+        self._next_id = 0
+        self._lock = Lock()
+        self._selector = None
+        self._server = None
+        # self-pipe so publish() can interrupt select() from another thread
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+
+    @property
+    def connected(self):
+        return len(self._clients) > 0
+
+    def client_stats(self):
+        with self._lock:
+            return [client.stats() for client in self._clients.values()]
+
+    # Queue a message for every connected client. Never blocks on a slow reader.
+    # message is either str/bytes sent to everyone as-is, or a result object that is encoded once
+    # per client encoding. encoded can carry already serialized forms, e.g. {'json': output_json}
+    # views is the result of Subscriptions.apply() for the message; subscribed clients get their view
+    # and nothing if it is None. Each view is encoded once per encoding, like the message itself
+    def publish(self, message, trace=None, encoded=None, views=None):
+        if not self._clients:
+            return False
+
+        raw = None
+        if isinstance(message, str):
+            raw = message.encode()
+        elif isinstance(message, bytes):
+            raw = message
+
+        entries = {}
+        if encoded:
+            for encoding, data in encoded.items():
+                entries[encoding] = (data.encode() if isinstance(data, str) else data, trace)
+
+        with self._lock:
+            if trace is not None:
+                trace.mark('enqueued')
+
+            for client in self._clients.values():
+                if raw is not None:
+                    entry = entries.setdefault(None, (raw, trace))
+                else:
+                    view = message
+                    if views is not None and client.subscription is not None:
+                        view = views.get(client.subscription)
+                        if view is None:
+                            continue
+                    cache_key = client.encoding if view is message else (client.subscription, client.encoding)
+                    entry = entries.get(cache_key)
+                    if entry is None:
+                        entry = entries[cache_key] = (encoders[client.encoding](view), trace)
+                client.push(entry)
+
+        self._wake()
+        return True
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass    # a wake-up is already pending
+
+    def _bind(self):
+        # Create the socket file if it does not exist so permission problems surface here
+        if not os.path.exists(self.path):
+            f = open(self.path, 'w')
+            f.close()
+
+        os.unlink(self.path)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        s.bind(self.path)
+        s.listen(self.max_clients)
+        s.setblocking(False)
+        return s
+
+    def _accept(self):
+        try:
+            connection, client_address = self._server.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+
+        if len(self._clients) >= self.max_clients:
+            print("socket client limit of %d reached - rejecting connection" % self.max_clients)
+            connection.close()
+            return
+
+        connection.setblocking(False)
+        with self._lock:
+            self._next_id += 1
+            client = SocketClient(connection, self._next_id, self.client_queue)
+            self._clients[connection.fileno()] = client
+        self._selector.register(connection, selectors.EVENT_READ, client)
+        connections.inc()
+        print("socket client %d connected (%d total)" % (client.id, len(self._clients)))
+        if self.on_connect:
+            self.on_connect()
+
+    def _remove(self, client, reason=None):
+        with self._lock:
+            self._clients.pop(client.connection.fileno(), None)
+            if client.subscription is not None:
+                self.subscriptions.release(client.subscription)
+                client.subscription = None
+        try:
+            self._selector.unregister(client.connection)
+        except (KeyError, ValueError):
+            pass
+        client.connection.close()
+        print("socket client %d disconnected%s: sent %d, dropped %d" %
+              (client.id, " (%s)" % reason if reason else "", client.sent, client.dropped))
+
+    # Handle anything the client sends us; an empty read means it hung up
+    def _read(self, client):
+        try:
+            data = client.connection.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as err:
+            send_errors.inc()
+            self._remove(client, err)
+            return
+
+        if not data:
+            self._remove(client)
+            return
+
+        self._control(client, data)
+
+    # Parse a control message from a client, e.g. {"encoding": "binary"}
+    def _control(self, client, data):
+        try:
+            request = json.loads(data.decode())
+        except ValueError:
+            print("socket client %d sent an unknown message: %r" % (client.id, data[:64]))
+            return
+        if not isinstance(request, dict):
+            return
+
+        encoding = request.get('encoding')
+        if encoding is not None:
+            if encoding not in encoders:
+                print("socket client %d requested unsupported encoding %s" % (client.id, encoding))
+                return
+            with self._lock:
+                client.encoding = encoding
+                if encoding in hellos:
+                    client.push((hellos[encoding](), None))
+            print("socket client %d using %s encoding" % (client.id, encoding))
+
+        if 'subscribe' in request:
+            self._subscribe(client, request['subscribe'])
+
+    def _subscribe(self, client, data):
+        if self.subscriptions is None:
+            print("socket client %d asked for a subscription but they are not enabled" % client.id)
+            return
+        subscription = None
+        if data is not None:
+            try:
+                if not isinstance(data, dict):
+                    raise ValueError("subscribe needs an object like {\"classes\": [\"PERSON\"]}")
+                subscription = Subscription.parse(data)
+            except ValueError as err:
+                print("socket client %d sent a bad subscription: %s" % (client.id, err))
+                return
+
+        with self._lock:
+            if client.subscription is not None:
+                self.subscriptions.release(client.subscription)
+            client.subscription = self.subscriptions.add(subscription) if subscription else None
+        print("socket client %d subscribed to %s" %
+              (client.id, subscription.to_dict() if subscription else "everything"))
+
+    # Send as much of the client's queue as the kernel will take without blocking
+    def _flush(self, client):
+        while True:
+            with self._lock:
+                if not client.queue:
+                    break
+                entry = client.queue[0]
+            try:
+                client.connection.send(entry[0])
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as err:
+                send_errors.inc()
+                self._remove(client, err)
+                return
+
+            with self._lock:
+                # the ring may have rotated while we were sending
+                if client.queue and client.queue[0] is entry:
+                    client.queue.popleft()
+            client.sent += 1
+            messages_sent.inc()
+            if self.on_sent:
+                self.on_sent(entry[1])
+
+        # only ask for write readiness while there is a backlog
+        want_write = len(client.queue) > 0
+        if want_write != client.writable_wait:
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if want_write else 0)
+            self._selector.modify(client.connection, events, client)
+            client.writable_wait = want_write
+
+    # Run the accept / send loop until run_event is cleared
+    def serve(self, run_event, poll_interval=1, heartbeat=None):
+        self._server = self._bind()
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._server, selectors.EVENT_READ, 'accept')
+        self._selector.register(self._wake_r, selectors.EVENT_READ, 'wake')
+
+        print('socket waiting for connection...')
+        try:
+            while run_event.is_set():
+                if heartbeat:
+                    heartbeat()
+                for key, mask in self._selector.select(timeout=poll_interval):
+                    if key.data == 'accept':
+                        self._accept()
+                    elif key.data == 'wake':
+                        try:
+                            while self._wake_r.recv(1024):
+                                pass
+                        except (BlockingIOError, InterruptedError):
+                            pass
+                    elif mask & selectors.EVENT_READ:
+                        self._read(key.data)
+
+                for client in list(self._clients.values()):
+                    if client.queue:
+                        self._flush(client)
+        finally:
+            print("closing socket")
+            for client in list(self._clients.values()):
+                self._flush(client)     # whatever the socket buffer still takes
+                if client.connection.fileno() != -1:
+                    self._remove(client, "shutdown")
+            self._selector.close()
+            self._server.close()
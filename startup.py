@@ -0,0 +1,117 @@
+# Startup timeline
+#
+# Seconds since the process was started for each startup phase (imports, camera init, model load)
+# and for the first inference result, detection and socket delivery. Served by /api/startup so
+# boot-to-first-detection on field units can be measured and compared between changes.
+#
+# Import this before anything heavy so the import phase is measured from interpreter start.
+
+import os
+from threading import Thread, Lock
+from time import monotonic
+
+
+# Seconds between the process starting and now, from /proc - so interpreter start-up is included
+def _process_age():
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return max(uptime - start_ticks / os.sysconf('SC_CLK_TCK'), 0.0), uptime
+    except (OSError, ValueError, IndexError):
+        return 0.0, None
+
+
+class Timeline(object):
+    def __init__(self):
+        age, uptime = _process_age()
+        self.origin = monotonic() - age
+        self.boot_offset = uptime - age if uptime is not None else None     # seconds from boot to process start
+        self.phases = []        # [name, start, end]
+        self.marks = {}         # name -> seconds, first occurrence only
+        self._lock = Lock()
+        self._report_on = None
+
+    def now(self):
+        return monotonic() - self.origin
+
+    # record a one-off event; only the first call for each name counts
+    def mark(self, name):
+        if name in self.marks:
+            return
+        with self._lock:
+            if name in self.marks:
+                return
+            self.marks[name] = self.now()
+        if name == self._report_on:
+            self.print_summary()
+
+    def add_phase(self, name, start, end=None):
+        with self._lock:
+            self.phases.append([name, start, self.now() if end is None else end])
+
+    # context manager timing a phase
+    def phase(self, name):
+        return _Phase(self, name)
+
+    # print the timeline once the named mark is reached
+    def report_on(self, name):
+        self._report_on = name
+        if name in self.marks:
+            self.print_summary()
+
+    def summary(self):
+        with self._lock:
+            phases = [{'name': name, 'start': round(start, 4), 'end': round(end, 4),
+                       'duration': round(end - start, 4)} for name, start, end in self.phases]
+            marks = {name: round(t, 4) for name, t in self.marks.items()}
+        return {'boot_offset': round(self.boot_offset, 3) if self.boot_offset is not None else None,
+                'uptime': round(self.now(), 3), 'phases': phases, 'marks': marks}
+
+    def print_summary(self):
+        summary = self.summary()
+        print("startup timeline (s since process start%s):" %
+              (", started %.1f s after boot" % summary['boot_offset'] if summary['boot_offset'] is not None else ""))
+        events = [(p['start'], "%-22s %7.3f - %7.3f (%.3f)" % (p['name'], p['start'], p['end'], p['duration']))
+                  for p in summary['phases']]
+        events += [(t, "%-22s %7.3f" % (name, t)) for name, t in summary['marks'].items()]
+        for _, line in sorted(events):
+            print("  " + line)
+
+
+class _Phase(object):
+    def __init__(self, timeline, name):
+        self.timeline = timeline
+        self.name = name
+
+    def __enter__(self):
+        self.start = self.timeline.now()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timeline.add_phase(self.name, self.start)
+
+
+timeline = Timeline()
+
+
+# Run independent initialization steps at the same time, each timed as a phase.
+# steps is a list of (name, function); raises the first error once they have all finished.
+def run_concurrently(steps):
+    errors = []
+
+    def run(name, function):
+        try:
+            with timeline.phase(name):
+                function()
+        except Exception as err:
+            errors.append(err)
+
+    threads = [Thread(target=run, args=step, name='init-' + step[0]) for step in steps]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
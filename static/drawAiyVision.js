@@ -4,7 +4,7 @@
  * Written for webrtcHacks - https://webrtchacks.com
  */
 
-/*exported processAiyData*/
+/*exported processAiyData, aiyEncoding, aiySubscription, aiyBinaryHello, decodeAiyBinary*/
 
 
 //Video element selector
@@ -23,11 +23,113 @@ let drawCtx = drawCanvas.getContext("2d");
 
 let lastSighting = null;
 
+//Wire encoding to ask the server for - add ?encoding=binary to the page URL for the compact format
+const aiyEncoding = new URLSearchParams(location.search).get("encoding") || "json";
+
+//Only ask for what gets drawn - e.g. ?class=PERSON&min_score=0.7&region=0,0,0.5,1&max_rate=5
+const aiySubscription = (() => {
+    const params = new URLSearchParams(location.search);
+    let subscription = {};
+    if (params.has("class"))
+        subscription.classes = params.get("class").split(",");
+    if (params.has("region"))
+        subscription.region = params.get("region").split(",").map(Number);
+    for (const key of ["min_score", "max_rate"])
+        if (params.has(key))
+            subscription[key] = Number(params.get(key));
+    return Object.keys(subscription).length ? subscription : null;
+})();
+
+//Binary format details from the server's hello message
+const aiyBinaryVersion = 1;
+let aiyLabels = [];
+let aiyHelloPending = false;
+
+//Handle the server's reply to an encoding request
+function aiyBinaryHello(hello) {
+    if (hello.version !== aiyBinaryVersion)
+        console.error("Unsupported AIY binary version " + hello.version);
+    aiyLabels = hello.labels;
+    aiyHelloPending = false;
+}
+
+//Decode a binary detection frame - see wire_format.py for the layout
+function decodeAiyBinary(buffer, requestHello) {
+    let view = new DataView(buffer);
+    let version = view.getUint8(0),
+        type = view.getUint8(1);
+
+    if (version !== aiyBinaryVersion || type !== 0) {
+        console.error("Unsupported AIY binary message version " + version + " type " + type);
+        return null;
+    }
+
+    let result = {
+        numObjects: view.getUint16(2, true),
+        seq: view.getUint32(4, true),
+        timeStamp: view.getFloat64(8, true),
+        inferenceTime: view.getFloat32(16, true),
+        objects: []
+    };
+
+    let label = (id) => {
+        //a label we have not seen yet - ask for a new label table
+        if (id >= aiyLabels.length && !aiyHelloPending && requestHello) {
+            aiyHelloPending = true;
+            requestHello();
+        }
+        return aiyLabels[id] || "#" + id;
+    };
+    let box = (item, offset) => {
+        item.x = view.getUint16(offset, true) / 65535;
+        item.y = view.getUint16(offset + 2, true) / 65535;
+        item.width = view.getUint16(offset + 4, true) / 65535;
+        item.height = view.getUint16(offset + 6, true) / 65535;
+        return item;
+    };
+
+    let offset = 20;
+    for (let i = 0; i < result.numObjects; i++) {
+        switch (view.getUint8(offset)) {
+            case 0:
+                result.objects.push(box({
+                    name: "face",
+                    score: view.getUint8(offset + 1) / 255,
+                    joy: view.getUint8(offset + 2) / 255
+                }, offset + 3));
+                offset += 11;
+                break;
+            case 1:
+                result.objects.push(box({
+                    name: "object",
+                    class_name: label(view.getUint16(offset + 1, true)),
+                    score: view.getUint8(offset + 3) / 255
+                }, offset + 4));
+                offset += 12;
+                break;
+            case 2:
+                result.objects.push({
+                    name: "class",
+                    class_name: label(view.getUint16(offset + 1, true)),
+                    score: view.getUint8(offset + 3) / 255
+                });
+                offset += 4;
+                break;
+            default:
+                console.error("Unknown AIY object kind " + view.getUint8(offset));
+                return result;
+        }
+    }
+
+    return result;
+}
+
 //Convert RGB color integer values to hex
 function toHex(n) {
     if (n < 256) {
         return Math.abs(n)
-            .toString(16);
+            .toString(16)
+            .padStart(2, "0");
     }
     return 0;
 }
@@ -35,13 +137,13 @@ function toHex(n) {
 //draw boxes and labels on each detected object
 function drawBox(x, y, width, height, label, color) {
 
-    if (color)
-        drawCtx.strokeStyle = drawCtx.fillStyle = '#' + toHex(color.r) + toHex(color.g) + toHex(color.b);
+    drawCtx.strokeStyle = drawCtx.fillStyle = color ?
+        '#' + toHex(color.r) + toHex(color.g) + toHex(color.b) : "cyan";
 
     let cx = x * drawCanvas.width;
     let cy = y * drawCanvas.height;
-    let cWidth = (width * drawCanvas.width) - x;
-    let cHeight = (height * drawCanvas.height) - y;
+    let cWidth = width * drawCanvas.width;
+    let cHeight = height * drawCanvas.height;
 
     drawCtx.fillText(label, cx + 5, cy - 10);
     drawCtx.strokeRect(cx, cy, cWidth, cHeight);
@@ -49,18 +151,97 @@ function drawBox(x, y, width, height, label, color) {
 }
 
 
-//Main function to export
-function processAiyData(result) {
-    console.log(result);
+//Objects currently in the scene by id when the server runs in delta stream mode
+let scene = new Map();
+let streamMode = false;
+
+//Apply a keyframe / delta / empty / heartbeat message to the scene
+function applyStreamMessage(message) {
+    switch (message.type) {
+        case "key":
+            scene.clear();
+            message.objects.forEach(item => scene.set(item.id, item));
+            break;
+        case "delta":
+            message.removed.forEach(id => scene.delete(id));
+            message.added.forEach(item => scene.set(item.id, item));
+            message.moved.forEach(item => scene.set(item.id, item));
+            break;
+        case "empty":
+            scene.clear();
+            break;
+        case "heartbeat":
+            return false;   //nothing to redraw
+        default:
+            debugLog("Unknown stream message type " + message.type);
+            return false;
+    }
+    return true;
+}
 
-    lastSighting = Date.now();
 
-    //clear the previous drawings
+//Logging of every message is only for debugging - add ?debug to the page URL
+const aiyDebug = new URLSearchParams(location.search).has("debug");
+const debugLog = aiyDebug ? console.log.bind(console) : () => {};
+
+//Move boxes between results - add ?interpolate to the page URL. Uses the vx/vy velocities from
+//--track, or the movement of each id between its last two results, and extrapolates at most this long
+const aiyInterpolate = new URLSearchParams(location.search).has("interpolate");
+const maxExtrapolation = 500;   //ms
+
+//Only the latest state is kept; messages arriving faster than the display refresh just replace it
+//and are drawn once on the next animation frame
+let latest = [];            //objects to draw
+let latestAt = 0;           //performance.now() when they arrived
+let lastSeen = new Map();   //id -> {x, y, timeStamp} for estimating velocity without --track
+let velocities = new Map(); //id -> {vx, vy} estimated from lastSeen
+let frameRequested = false;
+let staleTimer = null;
+
+function requestRender() {
+    if (!frameRequested) {
+        frameRequested = true;
+        requestAnimationFrame(render);
+    }
+}
+
+//Per second velocities for objects that don't carry their own, from their last position
+function estimateVelocity(objects, timeStamp) {
+    let seen = new Map();
+    velocities.clear();
+    objects.forEach(item => {
+        if (item.id === undefined || item.x === undefined || item.vx !== undefined)
+            return;
+        let previous = lastSeen.get(item.id);
+        if (previous && timeStamp > previous.timeStamp) {
+            velocities.set(item.id, {
+                vx: (item.x - previous.x) / (timeStamp - previous.timeStamp),
+                vy: (item.y - previous.y) / (timeStamp - previous.timeStamp)
+            });
+        }
+        seen.set(item.id, {x: item.x, y: item.y, timeStamp: timeStamp});
+    });
+    lastSeen = seen;
+}
+
+function render(now) {
+    frameRequested = false;
     drawCtx.clearRect(0, 0, drawCanvas.width, drawCanvas.height);
 
-    result.objects.forEach((item, itemNum) => {
+    let elapsed = Math.min(now - latestAt, maxExtrapolation) / 1000;
+    let moving = false;
+
+    latest.forEach((item, itemNum) => {
 
         let label;
+        let x = item.x,
+            y = item.y;
+        let velocity = item.vx !== undefined ? item : velocities.get(item.id);
+        if (aiyInterpolate && velocity && x !== undefined && elapsed > 0) {
+            x += velocity.vx * elapsed;
+            y += velocity.vy * elapsed;
+            moving = moving || velocity.vx !== 0 || velocity.vy !== 0;
+        }
 
         switch (item.name) {
             case "face": {
@@ -71,32 +252,79 @@ function processAiyData(result) {
                     b: Math.round((1 - item.joy) * 255)
                 };
 
-                drawBox(item.x, item.y, item.width, item.height, label, color);
+                drawBox(x, y, item.width, item.height, label, color);
                 break;
             }
             case "object": {
                 label = item.class_name + " - " + Math.round(item.score * 100) + "%";
-                drawBox(item.x, item.y, item.width, item.height, label);
+                drawBox(x, y, item.width, item.height, label);
                 break;
             }
             case "class": {
                 label = item.class_name + " - " + Math.round(item.score * 100) + "%";
+                drawCtx.fillStyle = "cyan";
                 drawCtx.fillText(label, 20, 20 * (itemNum + 1));
                 break;
             }
             default: {
-                console.log("I don't know what that AIY Vision server response was");
+                debugLog("I don't know what that AIY Vision server response was");
             }
         }
     });
 
+    //keep animating until the extrapolation limit is reached
+    if (moving && now - latestAt < maxExtrapolation)
+        requestRender();
+}
+
+//if no updates in the last second then clear the canvas
+//in stream mode the server sends explicit empty messages and heartbeats, so only clear if those stop
+//one timer at a time, re-armed for whatever is left when it fires early
+function checkStale() {
+    let limit = streamMode ? 3000 : 1000;
+    let idle = Date.now() - lastSighting;
+    if (idle < limit) {
+        staleTimer = setTimeout(checkStale, limit - idle);
+        return;
+    }
+    staleTimer = null;
+    scene.clear();
+    lastSeen.clear();
+    velocities.clear();
+    latest = [];
+    requestRender();
+}
+
+//Main function to export
+function processAiyData(result) {
+    debugLog(result);
+
+    lastSighting = Date.now();
+    if (staleTimer === null)
+        staleTimer = setTimeout(checkStale, streamMode ? 3000 : 1000);
+
+    if (result.type) {
+        streamMode = true;
+        if (!applyStreamMessage(result))
+            return;
+        result = {objects: Array.from(scene.values()), timeStamp: result.timeStamp};
+    }
+
+    if (aiyInterpolate)
+        estimateVelocity(result.objects, result.timeStamp);
+    latest = result.objects;
+    latestAt = performance.now();
+
+    //nothing to draw on until the video size is known
+    if (isPlaying && gotMetadata)
+        requestRender();
 }
 
 
 //Start object detection
 function setupCanvas() {
 
-    console.log("Ready to draw");
+    debugLog("Ready to draw");
 
     //Set canvas sizes based on input video
     drawCanvas.width = v.videoWidth;
@@ -108,19 +336,14 @@ function setupCanvas() {
     drawCtx.font = "20px Verdana";
     drawCtx.fillStyle = "cyan";
 
-    //if no updates in the last 2 seconds then clear the canvas
-    setInterval(() => {
-        if (Date.now() - lastSighting > 1000)
-            drawCtx.clearRect(0, 0, drawCanvas.width, drawCanvas.height);
-    }, 500)
-
+    requestRender();
 }
 
 //Starting events
 
 //check if metadata is ready - we need the video size
 v.onloadedmetadata = () => {
-    console.log("video metadata ready");
+    debugLog("video metadata ready");
     gotMetadata = true;
     if (isPlaying)
         setupCanvas();
@@ -128,7 +351,7 @@ v.onloadedmetadata = () => {
 
 //see if the video has started playing
 v.onplaying = () => {
-    console.log("video playing");
+    debugLog("video playing");
     isPlaying = true;
     if (gotMetadata) {
         setupCanvas();
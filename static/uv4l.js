@@ -3,7 +3,7 @@
  * Adaption of uv4l WebRTC samples to receive only
  */
 
-/*global processAiyData:false*/
+/*global processAiyData:false, aiyEncoding:false, aiySubscription:false, aiyBinaryHello:false, decodeAiyBinary:false*/
 
 const uv4lPort = 9080; //This is determined by the uv4l configuration. 9080 is default set by uv4l-raspidisp-extras
 const protocol = location.protocol === "https:" ? "wss:" : "ws:";
@@ -31,7 +31,41 @@ function gotRemoteStream(e) {
 function gotDataChannel(event) {
     console.log("Data Channel opened");
     let receiveChannel = event.channel;
-    receiveChannel.addEventListener('message', event => processAiyData(JSON.parse(event.data)));
+    receiveChannel.binaryType = 'arraybuffer';
+
+    //Ask the server for a non-default encoding if the page supports it
+    const useBinary = typeof aiyEncoding !== 'undefined' && aiyEncoding === "binary";
+    const requestEncoding = () => receiveChannel.send(JSON.stringify({encoding: aiyEncoding}));
+    if (useBinary) {
+        if (receiveChannel.readyState === "open")
+            requestEncoding();
+        else
+            receiveChannel.addEventListener('open', requestEncoding);
+    }
+
+    //and only the detections the page draws, if it asked for a subset
+    if (typeof aiySubscription !== 'undefined' && aiySubscription) {
+        const subscribe = () => receiveChannel.send(JSON.stringify({subscribe: aiySubscription}));
+        if (receiveChannel.readyState === "open")
+            subscribe();
+        else
+            receiveChannel.addEventListener('open', subscribe);
+    }
+
+    receiveChannel.addEventListener('message', event => {
+        if (typeof event.data !== "string") {
+            let result = decodeAiyBinary(event.data, requestEncoding);
+            if (result)
+                processAiyData(result);
+            return;
+        }
+
+        let message = JSON.parse(event.data);
+        if (message.encoding === "binary")
+            aiyBinaryHello(message);
+        else
+            processAiyData(message);
+    });
     receiveChannel.addEventListener('error', err => console.error("DataChannel Error:", err));
     receiveChannel.addEventListener('close', () => console.log("The DataChannel is closed"));
 }
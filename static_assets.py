@@ -0,0 +1,125 @@
+# In-memory static files for the web server
+#
+# Everything under static/ is read once at startup, fingerprinted and compressed (gzip, and brotli
+# if the brotli module is installed). Requests are answered from memory with ETag/Last-Modified,
+# and revalidations get a 304, so a page load costs almost no CPU or flash I/O on a Pi Zero.
+# watch() starts a background thread that reloads files that change on disk.
+
+import os
+import gzip
+import hashlib
+import mimetypes
+from threading import Thread
+from time import sleep
+
+from flask import Response
+
+import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+MIN_COMPRESS_SIZE = 256     # bytes - smaller files aren't worth a variant
+
+requests_served = metrics.counter('static_requests_total', 'Static file requests')
+not_modified = metrics.counter('static_not_modified_total', 'Static file requests answered with 304')
+
+
+class Asset(object):
+    def __init__(self, path, data, mtime):
+        self.path = path
+        self.mtime = mtime
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.fingerprint = hashlib.sha1(data).hexdigest()[:16]
+        self.last_modified = int(mtime)
+        self.variants = {None: data}    # content encoding -> body
+
+        if self.mimetype.startswith(COMPRESSIBLE) and len(data) >= MIN_COMPRESS_SIZE:
+            compressed = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                compressed['br'] = brotli.compress(data)
+            self.variants.update((k, v) for k, v in compressed.items() if len(v) < len(data))
+
+    def etag(self, encoding):
+        return self.fingerprint + ('-' + encoding if encoding else '')
+
+    # best encoding the client accepts
+    def encoding_for(self, accept_encoding):
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accept_encoding[encoding]:
+                return encoding
+        return None
+
+    def response(self, request, cache_control='no-cache'):
+        requests_served.inc()
+        encoding = self.encoding_for(request.accept_encodings)
+        etag = self.etag(encoding)
+
+        if request.if_none_match:
+            fresh = request.if_none_match.contains(etag)
+        else:
+            fresh = request.if_modified_since is not None and \
+                    request.if_modified_since.timestamp() >= self.last_modified
+
+        response = Response(b'' if fresh else self.variants[encoding], status=304 if fresh else 200,
+                            mimetype=self.mimetype)
+        response.set_etag(etag)
+        response.last_modified = self.last_modified
+        response.headers['Cache-Control'] = cache_control
+        response.vary.add('Accept-Encoding')
+        if fresh:
+            not_modified.inc()
+            response.headers.pop('Content-Type', None)
+        elif encoding:
+            response.content_encoding = encoding
+        return response
+
+
+class AssetCache(object):
+    def __init__(self, directory='static'):
+        self.directory = directory
+        self.assets = {}
+        self.load()
+
+    def _files(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                yield os.path.relpath(path, self.directory).replace(os.sep, '/'), path
+
+    def _load(self, name, path):
+        mtime = os.path.getmtime(path)
+        with open(path, 'rb') as f:
+            self.assets[name] = Asset(path, f.read(), mtime)
+
+    def load(self):
+        for name, path in self._files():
+            self._load(name, path)
+        print("loaded %d static files (%d bytes%s)" %
+              (len(self.assets), sum(len(a.variants[None]) for a in self.assets.values()),
+               "" if brotli else ", no brotli module"))
+
+    def watch(self, interval=2.0):
+        Thread(target=self._watch, args=(interval,), name='static-watch', daemon=True).start()
+
+    def _watch(self, interval):
+        while True:
+            sleep(interval)
+            seen = set()
+            for name, path in self._files():
+                seen.add(name)
+                try:
+                    asset = self.assets.get(name)
+                    if asset is None or os.path.getmtime(path) != asset.mtime:
+                        self._load(name, path)
+                        print("reloaded static/%s" % name)
+                except OSError:
+                    pass
+            for name in set(self.assets) - seen:
+                del self.assets[name]
+
+    def get(self, name):
+        return self.assets.get(name)
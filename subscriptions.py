@@ -0,0 +1,172 @@
+# Per-client subscription filters
+#
+# A client can ask for a subset of the results: a class allow-list, a minimum score, a normalized
+# region of interest [x, y, width, height] and a maximum message rate, e.g.
+#   {"subscribe": {"classes": ["PERSON"], "min_score": 0.7, "region": [0, 0, 0.5, 1], "max_rate": 5}}
+# over the uv4l socket, or /api/stream?class=PERSON&min_score=0.7 for Server-Sent Events.
+#
+# Clients asking for the same thing share one compiled filter. apply() evaluates every distinct
+# filter once per frame and the publishers pick the view for each client's filter, so the work
+# doesn't grow with the number of clients. Faces match the class "face"; an object matches a
+# region when the center of its box is inside it; classification results have no box and are
+# only filtered by class, score and rate. Scores below the model threshold (0.3) never arrive.
+
+from threading import Lock
+
+import metrics
+
+active = metrics.gauge('subscription_filters', 'Distinct subscription filters in use')
+suppressed = metrics.counter('subscription_views_suppressed_total',
+                             'Frames not sent to a subscription because nothing matched or it was rate limited')
+
+
+class Subscription(object):
+    def __init__(self, classes=None, min_score=None, region=None, max_rate=None):
+        self.classes = frozenset(c.upper() for c in classes) if classes else None
+        self.min_score = min_score or None
+        self.region = tuple(region) if region else None
+        self.max_rate = max_rate or None
+
+    # Build from a JSON request or query string arguments. Lists may also be comma separated
+    # strings. Raises ValueError for anything malformed.
+    @classmethod
+    def parse(cls, data):
+        def as_list(value):
+            return [v for v in value.split(',') if v] if isinstance(value, str) else value
+
+        known = ('classes', 'class', 'min_score', 'region', 'max_rate')
+        unknown = [key for key in data if key not in known]
+        if unknown:
+            raise ValueError("unknown subscription field %s - use %s" % (", ".join(unknown), ", ".join(known)))
+        try:
+            classes = as_list(data.get('classes', data.get('class')))
+            if classes is not None and not all(isinstance(c, str) for c in classes):
+                raise ValueError
+            min_score = data.get('min_score')
+            min_score = float(min_score) if min_score is not None else None
+            region = as_list(data.get('region'))
+            region = [float(v) for v in region] if region is not None else None
+            max_rate = data.get('max_rate')
+            max_rate = float(max_rate) if max_rate is not None else None
+        except (TypeError, ValueError):
+            raise ValueError("bad subscription %r" % (dict(data),))
+
+        if region is not None and (len(region) != 4 or region[2] <= 0 or region[3] <= 0):
+            raise ValueError("region must be [x, y, width, height] with a positive width and height")
+        if max_rate is not None and max_rate <= 0:
+            raise ValueError("max_rate must be positive")
+        return cls(classes, min_score, region, max_rate)
+
+    # identical subscriptions have equal keys and share a filter
+    @property
+    def key(self):
+        return (tuple(sorted(self.classes)) if self.classes else None, self.min_score, self.region, self.max_rate)
+
+    def to_dict(self):
+        return {'classes': sorted(self.classes) if self.classes else None, 'min_score': self.min_score,
+                'region': list(self.region) if self.region else None, 'max_rate': self.max_rate}
+
+    # A predicate(class_name, score, box) with only the checks this subscription needs
+    def compile(self):
+        checks = []
+        if self.classes is not None:
+            classes = self.classes
+            checks.append(lambda class_name, score, box: class_name.upper() in classes)
+        if self.min_score is not None:
+            min_score = self.min_score
+            checks.append(lambda class_name, score, box: score >= min_score)
+        if self.region is not None:
+            left, top, width, height = self.region
+            right, bottom = left + width, top + height
+
+            def in_region(class_name, score, box):
+                if box is None:
+                    return True
+                x = box[0] + box[2] / 2
+                y = box[1] + box[3] / 2
+                return left <= x <= right and top <= y <= bottom
+            checks.append(in_region)
+
+        if not checks:
+            return None
+        if len(checks) == 1:
+            return checks[0]
+        return lambda class_name, score, box: all(check(class_name, score, box) for check in checks)
+
+
+class _Filter(object):
+    def __init__(self, subscription):
+        self.subscription = subscription
+        self.predicate = subscription.compile()
+        self.min_interval = 1 / subscription.max_rate if subscription.max_rate else None
+        self.last_sent = None
+        self.users = 0
+
+
+class Subscriptions(object):
+    def __init__(self):
+        self._filters = {}      # key -> _Filter
+        self._lock = Lock()
+
+    # Register a client's subscription; returns the key to look its view up with and to release
+    def add(self, subscription):
+        key = subscription.key
+        with self._lock:
+            compiled = self._filters.get(key)
+            if compiled is None:
+                compiled = self._filters[key] = _Filter(subscription)
+            compiled.users += 1
+            active.set(len(self._filters))
+        return key
+
+    def release(self, key):
+        with self._lock:
+            compiled = self._filters.get(key)
+            if compiled is None:
+                return
+            compiled.users -= 1
+            if compiled.users <= 0:
+                del self._filters[key]
+            active.set(len(self._filters))
+
+    # Evaluate every distinct filter against a frame. Returns None if no client has a subscription,
+    # otherwise a dict of key -> result to send, or None to send nothing. The None key holds the
+    # unfiltered output, and a filter that keeps everything maps to that same object so publishers
+    # can reuse its encodings.
+    def apply(self, output, now):
+        if not self._filters:
+            return None
+        with self._lock:
+            filters = list(self._filters.items())
+
+        rows = output.detections()
+        views = {None: output}
+        for key, compiled in filters:
+            if compiled.min_interval is not None and compiled.last_sent is not None and \
+                    now - compiled.last_sent < compiled.min_interval:
+                views[key] = None
+                suppressed.inc()
+                continue
+
+            if compiled.predicate is None:
+                view = output
+            else:
+                indexes = [i for i, row in enumerate(rows) if compiled.predicate(*row)]
+                if not indexes:
+                    view = None
+                elif len(indexes) == len(rows):
+                    view = output
+                else:
+                    view = output.select(indexes)
+
+            if view is None:
+                suppressed.inc()
+            else:
+                compiled.last_sent = now
+            views[key] = view
+        return views
+
+    def status(self):
+        with self._lock:
+            return [dict(compiled.subscription.to_dict(), clients=compiled.users)
+                    for compiled in self._filters.values()]
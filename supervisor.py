@@ -0,0 +1,166 @@
+# Worker thread supervisor
+#
+# Owns the long running worker threads: starts them, restarts them with exponential backoff when
+# they crash or stop sending heartbeats, and stops them with a real timeout on shutdown.
+#
+# Each worker is called as target(run_event, *args), plus heartbeat=<function> if it has a
+# heartbeat timeout. Every (re)start gets a fresh run_event, so a stalled thread that eventually
+# wakes up sees its event cleared and exits instead of running next to its replacement. A worker
+# that returns on its own while the supervisor is running is done and isn't restarted.
+
+import traceback
+from threading import Thread, Event, Lock
+from time import monotonic
+
+import metrics
+
+restarts = metrics.counter('worker_restarts_total', 'Worker threads restarted after a crash or stall')
+recovery_seconds = metrics.window('worker_recovery_seconds', 'Time from a worker failing to it running again', 100)
+
+
+class Worker(object):
+    def __init__(self, name, target, args=(), heartbeat_timeout=None):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.heartbeat_timeout = heartbeat_timeout
+        self.thread = None
+        self.run_event = None
+        self.state = 'new'      # running, crashed, stalled, backoff, finished, stopped
+        self.started_at = None
+        self.last_heartbeat = None
+        self.last_error = None
+        self.failures = 0       # consecutive, for the backoff
+        self.restarts = 0
+        self.failed_at = None   # when the current outage started
+        self.restart_at = None
+        self.recoveries = []
+
+    def beat(self):
+        self.last_heartbeat = monotonic()
+        if self.failed_at is not None:
+            self._recovered()
+
+    def _recovered(self):
+        elapsed = monotonic() - self.failed_at
+        self.failed_at = None
+        self.recoveries.append(elapsed)
+        recovery_seconds.observe(elapsed)
+        print("worker %s recovered after %.2f s" % (self.name, elapsed))
+
+    def _run(self, run_event):
+        try:
+            if self.heartbeat_timeout:
+                self.target(run_event, *self.args, heartbeat=self.beat)
+            else:
+                self.target(run_event, *self.args)
+        except Exception as err:
+            self.last_error = "%s: %s" % (type(err).__name__, err)
+            print("worker %s crashed" % self.name)
+            traceback.print_exc()
+            if run_event.is_set():
+                self.state = 'crashed'
+            return
+        if run_event.is_set() and self.state == 'running':
+            self.state = 'finished'
+
+    def start(self):
+        self.run_event = Event()
+        self.run_event.set()
+        self.thread = Thread(target=self._run, args=(self.run_event,), name=self.name, daemon=True)
+        self.started_at = self.last_heartbeat = monotonic()
+        self.state = 'running'
+        self.thread.start()
+        # workers without heartbeats count as recovered once they are running again
+        if not self.heartbeat_timeout and self.failed_at is not None:
+            self._recovered()
+
+    def stalled(self, now):
+        return self.heartbeat_timeout is not None and now - self.last_heartbeat > self.heartbeat_timeout
+
+    def status(self):
+        return {'state': self.state, 'restarts': self.restarts, 'last_error': self.last_error,
+                'uptime': monotonic() - self.started_at if self.state == 'running' else None,
+                'since_heartbeat': monotonic() - self.last_heartbeat if self.last_heartbeat else None,
+                'mttr': sum(self.recoveries) / len(self.recoveries) if self.recoveries else None}
+
+
+class Supervisor(object):
+    def __init__(self, check_interval=1.0, backoff_initial=1.0, backoff_max=60.0, healthy_after=60.0):
+        self.check_interval = check_interval
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.healthy_after = healthy_after      # seconds running before the backoff resets
+        self.workers = {}
+        self.running = Event()
+        self._lock = Lock()
+        self._thread = None
+
+    def add(self, name, target, args=(), heartbeat_timeout=None):
+        worker = self.workers[name] = Worker(name, target, args, heartbeat_timeout)
+        if self.running.is_set():
+            worker.start()
+        return worker
+
+    def start(self):
+        self.running.set()
+        for worker in self.workers.values():
+            worker.start()
+        self._thread = Thread(target=self._monitor, name='supervisor', daemon=True)
+        self._thread.start()
+
+    def _monitor(self):
+        while self.running.wait(self.check_interval) and self.running.is_set():
+            with self._lock:
+                now = monotonic()
+                for worker in self.workers.values():
+                    self._check(worker, now)
+
+    def _check(self, worker, now):
+        if worker.state == 'running':
+            if worker.failures and now - worker.started_at > self.healthy_after:
+                worker.failures = 0
+            if not worker.thread.is_alive():
+                return      # _run sets crashed or finished
+            if worker.stalled(now):
+                worker.state = 'stalled'
+                worker.last_error = "no heartbeat for %.1f s" % (now - worker.last_heartbeat)
+                worker.run_event.clear()    # abandon it; it exits if it ever wakes up
+
+        if worker.state in ('crashed', 'stalled'):
+            worker.failures += 1
+            if worker.failed_at is None:
+                worker.failed_at = now
+            delay = min(self.backoff_initial * 2 ** (worker.failures - 1), self.backoff_max)
+            worker.restart_at = now + delay
+            worker.state = 'backoff'
+            print("worker %s failed (%s) - restarting in %.1f s" % (worker.name, worker.last_error, delay))
+        elif worker.state == 'backoff' and now >= worker.restart_at:
+            worker.restarts += 1
+            restarts.inc()
+            worker.start()
+
+    # Stop every worker, waiting up to timeout seconds in total. Returns the names that didn't stop.
+    def stop(self, timeout=5.0):
+        self.running.clear()
+        with self._lock:
+            for worker in self.workers.values():
+                if worker.run_event is not None:
+                    worker.run_event.clear()
+
+        deadline = monotonic() + timeout
+        stuck = []
+        for worker in self.workers.values():
+            if worker.thread is not None:
+                worker.thread.join(max(deadline - monotonic(), 0))
+                if worker.thread.is_alive():
+                    stuck.append(worker.name)
+            worker.state = 'stopped'
+        if stuck:
+            print("workers still running at exit: %s" % ", ".join(stuck))
+        return stuck
+
+    def status(self):
+        recoveries = [r for worker in self.workers.values() for r in worker.recoveries]
+        return {'workers': {name: worker.status() for name, worker in self.workers.items()},
+                'mttr': sum(recoveries) / len(recoveries) if recoveries else None}
@@ -0,0 +1,76 @@
+# Checks the multi-model schedule against simulated frame timestamps
+#
+# Frame counts must be interleaved in their ratio, and a periodic ("Ns") model must run about once per
+# period: never on two frames in a row, on the first frame or after a stall.
+
+import os
+import sys
+import argparse
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from model_scheduler import ModelSchedule
+
+
+def run(schedule, times):
+    return [schedule.next(now) for now in times]
+
+
+def assert_no_repeats(models, periodic):
+    for first, second in zip(models, models[1:]):
+        assert not (first == second == periodic), models
+
+
+def check_ratios(args):
+    schedule = ModelSchedule('object:3,face:1')
+    models = run(schedule, [i / args.fps for i in range(400)])
+    counts = Counter(models)
+    assert counts['object'] == 3 * counts['face'], counts
+    assert 'face,face' not in ','.join(models)
+    print("ratios: %s" % dict(counts))
+
+
+def check_periodic(args):
+    schedule = ModelSchedule('object:3,face:1,class:1s')
+    start = 1700000000.0
+    seconds = 20
+    times = [start + i / args.fps for i in range(int(seconds * args.fps))]
+    models = run(schedule, times)
+    assert_no_repeats(models, 'class')
+    runs = models.count('class')
+    assert seconds - 1 <= runs <= seconds + 1, runs
+
+    # a stall of several periods: one run when it ends, then back to once a second
+    resumed = times[-1] + 5
+    after = run(schedule, [resumed + i / args.fps for i in range(int(3 * args.fps))])
+    assert after[0] == 'class', after
+    assert_no_repeats(after, 'class')
+    assert 3 <= after.count('class') <= 4, after.count('class')
+    print("periodic: %d class runs in %d s at %d fps, none back to back" % (runs, seconds, args.fps))
+
+
+def check_rates():
+    schedule = ModelSchedule('face:1,class:2s')
+    for i in range(40):
+        now = 100 + i * 0.1
+        schedule.record(schedule.next(now), now)
+    assert all(rate is None for rate in schedule.rates(100.5).values())
+    rates = schedule.rates(103.9)
+    assert 9 <= rates['face'] <= 10 and 0 < rates['class'] < 1, rates
+    print("rates: %s" % rates)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fps', type=int, default=15, help='Simulated frame rate')
+    args = parser.parse_args()
+
+    check_ratios(args)
+    check_periodic(args)
+    check_rates()
+    print("ok")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# Checks the pre-roll buffer against a synthetic H.264 NAL stream
+#
+# The stream has SPS/PPS/IDR at every keyframe and P slices in between, with emulation prevention
+# style payloads (no 00 00 01 inside a NAL). It is fed in uneven chunks that split start codes,
+# then each flush is compared with the bytes the buffer should hold. Also times locating the
+# keyframe against the linear scan the old PiCameraCircularIO code did.
+
+import os
+import sys
+import random
+import argparse
+from io import BytesIO
+from timeit import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from preroll import PrerollBuffer, capacity_for, START_CODE
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def nal(nal_type, size, rng):
+    payload = bytes(rng.randrange(1, 256) for _ in range(size))     # no zero bytes, so no start codes
+    return b'\x00\x00\x00\x01' + bytes([0x60 | nal_type]) + payload
+
+
+# list of (time, frame bytes, is keyframe)
+def make_stream(seconds, framerate, gop, bitrate, rng):
+    frame_size = bitrate // 8 // framerate
+    frames = []
+    for n in range(int(seconds * framerate)):
+        if n % gop == 0:
+            data = nal(7, 10, rng) + nal(8, 4, rng) + nal(5, frame_size * 4, rng)
+        else:
+            data = nal(1, frame_size, rng)
+        frames.append((n / framerate, data, n % gop == 0))
+    return frames
+
+
+def chunks(data, rng):
+    i = 0
+    while i < len(data):
+        size = rng.choice((1, 2, 3, 5, 64, 4096))
+        yield data[i:i + size]
+        i += size
+
+
+def check(args):
+    rng = random.Random(1)
+    clock = Clock()
+    stream = make_stream(args.seconds, args.framerate, args.gop, args.bitrate, rng)
+    capacity = capacity_for(args.bitrate * 2, args.preroll, args.gop / args.framerate)
+    buffer = PrerollBuffer(capacity, seconds=args.preroll, clock=clock)
+    history = b''
+    keyframes = []      # (offset, time) of every SPS written
+
+    flushes = 0
+    for n, (t, frame, key) in enumerate(stream):
+        clock.now = t
+        if key:
+            keyframes.append((len(history), t))
+        for chunk in chunks(frame, rng):
+            buffer.write(chunk)
+        history += frame
+        assert len(buffer) <= capacity
+
+        if n % (args.framerate * 7) == args.framerate * 7 - 1:
+            # expected: latest keyframe at least `preroll` seconds old that hasn't been overwritten
+            start = len(history) - len(buffer)
+            usable = [k for k in keyframes if k[0] >= start]
+            old_enough = [k for k in usable if k[1] <= t - args.preroll]
+            expected = (old_enough[-1] if old_enough else usable[0]) if usable else None
+            assert buffer.keyframe() == expected, (buffer.keyframe(), expected)
+
+            output = BytesIO()
+            written = buffer.write_to(output)
+            if expected is not None:
+                assert output.getvalue() == history[expected[0]:]
+                assert output.getvalue()[:4] == b'\x00\x00\x00\x01' and output.getvalue()[4] & 0x1F == 7
+                assert written == len(history) - expected[0]
+            assert len(buffer) == 0 and buffer.keyframe() is None
+            keyframes = []
+            flushes += 1
+
+    print("%d flushes matched, capacity %.1f MB for %.1f s of pre-roll at %.1f Mbps" %
+          (flushes, capacity / 1e6, args.preroll, args.bitrate / 1e6))
+    return buffer, history
+
+
+def benchmark(args):
+    rng = random.Random(2)
+    clock = Clock()
+    stream = make_stream(args.preroll * 3, args.framerate, args.gop, args.bitrate, rng)
+    buffer = PrerollBuffer(capacity_for(args.bitrate * 2, args.preroll, args.gop / args.framerate),
+                           seconds=args.preroll, clock=clock)
+    for t, frame, _ in stream:
+        clock.now = t
+        buffer.write(frame)
+    contents = b''.join(frame for _, frame, _ in stream)[-len(buffer):]
+
+    # the old approach: walk the buffer from the start for the first SPS
+    def scan():
+        i = contents.find(START_CODE)
+        while contents[i + 3] & 0x1F != 7:
+            i = contents.find(START_CODE, i + 3)
+        return i
+
+    n = 1000
+    indexed = timeit(buffer.keyframe, number=n) / n
+    scanned = timeit(scan, number=n) / n
+    print("locate keyframe in %.1f MB: indexed %.2f us, linear scan %.2f us" %
+          (len(buffer) / 1e6, indexed * 1e6, scanned * 1e6))
+
+    data = stream[1][1]
+    n = 2000
+    per_write = timeit(lambda: buffer.write(data), number=n) / n
+    print("write of a %d byte frame: %.2f us" % (len(data), per_write * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=60, help='length of the synthetic stream')
+    parser.add_argument('--framerate', type=int, default=15)
+    parser.add_argument('--gop', type=int, default=15, help='frames between keyframes')
+    parser.add_argument('--bitrate', type=int, default=500000, help='bits per second of the synthetic stream')
+    parser.add_argument('--preroll', type=float, default=5)
+    args = parser.parse_args()
+
+    check(args)
+    benchmark(args)
+    print("ok")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import io
+import os
+import sys
+import types
+import argparse
+from contextlib import redirect_stdout
+from timeit import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from aiy_model_output import ApiObject, get_converter
+from inference_backend import SyntheticBackend
+
+
+# The per-object dict conversion process_inference() used before the columnar rewrite
+def reference_process_inference(model, result, params):
+    output = ApiObject()
+
+    if model == "object":
+        output.threshold = 0.3
+        for obj in result.detections:
+            output.numObjects += 1
+            output.objects.append({
+                'name': 'object',
+                'class_name': obj.label,
+                'score': obj.score,
+                'x': obj.bounding_box[0] / params['width'],
+                'y': obj.bounding_box[1] / params['height'],
+                'width': obj.bounding_box[2] / params['width'],
+                'height': obj.bounding_box[3] / params['height']
+            })
+    elif model == "face":
+        for face in result.detections:
+            output.numObjects += 1
+            output.objects.append({
+                'name': 'face',
+                'score': face.face_score,
+                'joy': face.joy_score,
+                'x': face.bounding_box[0] / params['width'],
+                'y': face.bounding_box[1] / params['height'],
+                'width': face.bounding_box[2] / params['width'],
+                'height': face.bounding_box[3] / params['height']
+            })
+    elif model == "class":
+        output.threshold = 0.3
+        for (obj, prob) in result.detections:
+            if prob > output.threshold:
+                output.numObjects += 1
+                output.objects.append({'name': 'class', 'class_name': obj, 'score': prob})
+
+    return output
+
+
+def make_results(model, objects, frames):
+    backend = SyntheticBackend(objects=objects, seed=1)
+    backend.framerate = 1e9     # don't pace the generator
+    results = backend.run(model)
+    with redirect_stdout(io.StringIO()):    # the backend announces itself on the first frame
+        return [next(results) for _ in range(frames)], {'height': backend.vres, 'width': backend.hres}
+
+
+# Stand-ins for the AIY model modules, returning objects shaped like the AIY ones, so the raw
+# result path of the converter runs without a Vision Kit. A "raw result" is the DecodedResult.
+class AiyObject(object):
+    _LABELS = ['BACKGROUND', 'PERSON', 'CAT', 'DOG']
+
+    def __init__(self, obj):
+        self.bounding_box = obj.bounding_box
+        self.kind = self._LABELS.index(obj.label)
+        self.score = obj.score
+
+
+class RawResult(object):
+    def __init__(self, decoded):
+        self.decoded = decoded
+
+
+def install_fake_aiy():
+    models = {
+        'face_detection': {'get_faces': lambda result: result.decoded.detections},
+        'object_detection': {'get_objects': lambda result, threshold=0.3:
+                             [AiyObject(obj) for obj in result.decoded.detections]},
+        'image_classification': {'get_classes': lambda result: result.decoded.detections}
+    }
+    for name in ('aiy', 'aiy.vision', 'aiy.vision.models'):
+        sys.modules.setdefault(name, types.ModuleType(name))
+    for name, functions in models.items():
+        module = types.ModuleType('aiy.vision.models.' + name)
+        module.__dict__.update(functions)
+        sys.modules[module.__name__] = module
+
+
+def stamp(output, i):
+    output.seq = i
+    output.timeStamp = 1535935485.0 + i / 15
+    output.inferenceTime = 1 / 15
+    return output
+
+
+def bench(model, objects, frames, repeat):
+    results, params = make_results(model, objects, frames)
+    convert = get_converter(model, params)
+
+    # both paths, and the raw AIY path, must produce byte-identical messages
+    for i, result in enumerate(results):
+        old = stamp(reference_process_inference(model, result, params), i).to_json()
+        new = stamp(convert(result), i).to_json()
+        raw = stamp(convert(RawResult(result)), i).to_json()
+        assert old == new == raw, (old, new, raw)
+
+    def run_reference():
+        for i, result in enumerate(results):
+            stamp(reference_process_inference(model, result, params), i).to_json()
+
+    def run_columnar():
+        for i, result in enumerate(results):
+            stamp(convert(result), i).to_json()
+
+    reference = timeit(run_reference, number=repeat) / (frames * repeat)
+    columnar = timeit(run_columnar, number=repeat) / (frames * repeat)
+
+    print("%-6s %2d objects | convert + to_json us/frame: dict %6.1f  columnar %6.1f  (%+.0f%%)" %
+          (model, objects, reference * 1e6, columnar * 1e6, 100 * (columnar - reference) / reference))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-frame result conversion cost")
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    install_fake_aiy()
+    for model in ('face', 'object', 'class'):
+        for objects in (1, 3, 8):
+            bench(model, objects, args.frames, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+# Checks the snapshot subsystem and the /snapshot route against a fake camera
+#
+# The fake camera's capture() takes a while and counts calls, so it shows whether concurrent
+# requests share one capture, whether min_interval bounds the capture rate, whether detection
+# frames are captured off the inference thread, and whether recordings get a thumbnail without
+# ever overlapping another capture.
+
+import os
+import sys
+import shutil
+import tempfile
+import argparse
+from threading import Thread, Event, Lock
+from time import sleep, monotonic
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import server
+from recording_index import open_index
+from snapshot import Snapshots
+
+
+# Stands in for PiCamera.capture(): writes a fake JPEG after `delay` seconds
+class FakeCamera(object):
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = Lock()
+
+    def capture(self, output, format='jpeg', use_video_port=False, resize=None, quality=85, splitter_port=0):
+        assert format == 'jpeg' and use_video_port
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            number = len(self.calls) + 1
+            self.calls.append(resize)
+        sleep(self.delay)
+        output.write(b'\xff\xd8fake jpeg %d %s\xff\xd9' % (number, str(resize).encode()))
+        with self._lock:
+            self.active -= 1
+
+
+def concurrent_gets(snapshots, count, max_age=0):
+    results = [None] * count
+
+    def get(i):
+        results[i] = snapshots.get(max_age)
+    threads = [Thread(target=get, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def check_single_flight(args):
+    camera = FakeCamera(args.delay)
+    snapshots = Snapshots(camera, min_interval=args.interval)
+    results = concurrent_gets(snapshots, args.clients)
+    assert len(camera.calls) == 1, camera.calls
+    assert all(result is results[0] for result in results)
+    assert results[0].data.startswith(b'\xff\xd8')
+
+    # within min_interval even max_age=0 gets the same picture
+    assert snapshots.get(0) is results[0] and len(camera.calls) == 1
+    sleep(args.interval)
+    assert snapshots.get(0) is not results[0] and len(camera.calls) == 2
+    print("single flight: %d concurrent requests, %d capture" % (args.clients, 1))
+
+
+def check_detections(args):
+    camera = FakeCamera(args.delay)
+    snapshots = Snapshots(camera, min_interval=args.interval)
+    run_event = Event()
+    run_event.set()
+    worker = Thread(target=snapshots.serve, args=(run_event, 0.05))
+    worker.start()
+
+    # 15 fps of detections for a few intervals: detected() must not block, captures stay bounded
+    frames = int(15 * args.interval * 3)
+    slowest = 0
+    for _ in range(frames):
+        start = monotonic()
+        snapshots.detected()
+        slowest = max(slowest, monotonic() - start)
+        sleep(1 / 15)
+    run_event.clear()
+    worker.join()
+
+    assert slowest < 0.01, slowest
+    assert 2 <= len(camera.calls) <= 4, camera.calls
+    print("detections: %d frames, %d captures, slowest detected() %.3f ms" %
+          (frames, len(camera.calls), slowest * 1000))
+
+
+def check_thumbnails(args, directory):
+    camera = FakeCamera(args.delay)
+    snapshots = Snapshots(camera, min_interval=args.interval)
+    index = open_index(directory)
+    run_event = Event()
+    run_event.set()
+    worker = Thread(target=snapshots.serve, args=(run_event, 0.05))
+    worker.start()
+
+    recording_id = 1700000000
+    path = os.path.join(directory, '%d_thumb.jpg' % recording_id)
+    index.open_recording(recording_id, recording_id, 'before.h264', 'after.h264')
+    done = Event()
+
+    def saved():
+        index.set_thumbnail(recording_id, path)
+        done.set()
+    snapshots.thumbnail(path, saved)
+    sleep(args.delay / 2)
+    results = concurrent_gets(snapshots, args.clients)   # overlaps the thumbnail capture
+    assert done.wait(5)
+    run_event.clear()
+    worker.join()
+
+    assert index.get(recording_id)['thumbnail'] == path
+    assert snapshots.thumbnail_size in camera.calls
+    assert camera.max_active == 1, camera.max_active      # never two captures on the splitter port
+    assert all(result is results[0] and result.data.startswith(b'\xff\xd8') for result in results)
+    with open(path, 'rb') as f:
+        assert f.read().startswith(b'\xff\xd8')
+    return index, recording_id
+
+
+def check_routes(args, index, recording_id):
+    camera = FakeCamera(args.delay)
+    server.snapshots = Snapshots(camera, min_interval=args.interval)
+    server.record.index = index
+    client = server.app.test_client()
+
+    responses = [None] * args.clients
+
+    def request(i):
+        responses[i] = client.get('/snapshot?max_age=0')
+    threads = [Thread(target=request, args=(i,)) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(r.status_code == 200 and r.mimetype == 'image/jpeg' for r in responses)
+    assert len({r.headers['ETag'] for r in responses}) == 1 and len(camera.calls) == 1
+
+    etag = responses[0].headers['ETag']
+    assert client.get('/snapshot', headers={'If-None-Match': etag}).status_code == 304
+
+    thumbnail = client.get('/api/recordings/%d/thumbnail' % recording_id)
+    assert thumbnail.status_code == 200 and thumbnail.data.startswith(b'\xff\xd8')
+    thumbnail.close()
+    assert client.get('/api/recordings/1/thumbnail').status_code == 404
+    assert b'/thumbnail' in client.get('/recordings').data
+
+    server.snapshots = None
+    assert client.get('/snapshot').status_code == 404
+    print("routes: %d concurrent /snapshot requests, 1 capture, 304 on a matching ETag, thumbnail served" %
+          args.clients)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent snapshot requests')
+    parser.add_argument('--delay', type=float, default=0.2, help='Seconds the fake camera takes per capture')
+    parser.add_argument('--interval', type=float, default=0.5, help='Minimum seconds between captures')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        check_single_flight(args)
+        check_detections(args)
+        index, recording_id = check_thumbnails(args, directory)
+        check_routes(args, index, recording_id)
+    finally:
+        shutil.rmtree(directory)
+    print("ok")
+
+
+if __name__ == '__main__':
+    main()
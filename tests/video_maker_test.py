@@ -0,0 +1,101 @@
+# Exercises the video_maker job queue against a stub ffmpeg
+#
+# Creates fake recordings in a temporary directory, interrupts a run part way, then checks a second
+# run resumes and finishes every job. The stub just concatenates its inputs after a short delay, so
+# the reported throughput is about the queue, not about ffmpeg.
+
+import os
+import sys
+import stat
+import argparse
+import tempfile
+from threading import Thread, Event
+from time import sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from recording_index import open_index
+from video_maker import VideoMaker
+
+STUB = """#!%s
+import sys, time
+args = sys.argv[1:]
+inputs = args[args.index('-i') + 1][len('concat:'):].split('|')
+if any('fail' in name for name in inputs):
+    sys.exit("stub ffmpeg: refusing %%s" %% inputs)
+time.sleep(%f)
+with open(args[-1], 'wb') as output:
+    for name in inputs:
+        output.write(open(name, 'rb').read())
+"""
+
+
+def make_recordings(directory, count, size):
+    for n in range(count):
+        recording_id = 1600000000 + n * 60
+        for part in ('before', 'after'):
+            with open(os.path.join(directory, '%d_%s.h264' % (recording_id, part)), 'wb') as f:
+                f.write(os.urandom(size))
+    # one recording with a missing after file still makes an mp4 from its before file
+    os.remove(os.path.join(directory, '%d_after.h264' % 1600000000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--recordings', type=int, default=20)
+    parser.add_argument('--size', type=int, default=256 * 1024, help='bytes per h264 file')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--delay', type=float, default=0.05, help='seconds the stub ffmpeg takes per job')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        stub = os.path.join(directory, 'ffmpeg')
+        with open(stub, 'w') as f:
+            f.write(STUB % (sys.executable, args.delay))
+        os.chmod(stub, os.stat(stub).st_mode | stat.S_IEXEC)
+
+        make_recordings(directory, args.recordings, args.size)
+        index = open_index(directory)
+        assert index.count() == args.recordings
+
+        # first run: stop part way through, as if the server was restarted
+        maker = VideoMaker(index, workers=args.workers, ffmpeg=stub, niceness=0, poll_interval=0.1)
+        running = Event()
+        running.set()
+        Thread(target=maker.serve, args=(running,), daemon=True).start()
+        while maker.done < args.recordings // 2:
+            sleep(0.01)
+        running.clear()
+        sleep(1)     # let jobs already handed to ffmpeg finish
+        print("interrupted after %d of %d" % (maker.done, args.recordings))
+
+        # second run resumes from the index
+        index = open_index(directory)
+        remaining = len(index.mp4_jobs())
+        maker = VideoMaker(index, workers=args.workers, ffmpeg=stub, niceness=0)
+        summary = maker.run_once()
+        print("resumed %d jobs: %d done, %d failed in %.2f s - %.1f videos/s, %.1f MB/s with %d workers" %
+              (remaining, summary['done'], summary['failed'], summary['elapsed_seconds'],
+               summary['videos_per_second'], summary['mb_per_second'], args.workers))
+
+        assert summary['done'] == remaining and summary['failed'] == 0
+        assert not index.mp4_jobs()
+        for recording in index.query(per_page=args.recordings)['recordings']:
+            assert recording['mp4'] == 'done'
+            assert os.path.exists(os.path.join(directory, '%d.mp4' % recording['id']))
+        assert not [name for name in os.listdir(directory) if name.endswith('.part')]
+
+        # a failing job is marked and skipped unless retried
+        index.open_recording(1700000000, 1700000000, os.path.join(directory, 'fail_before.h264'),
+                             os.path.join(directory, 'fail_after.h264'))
+        open(os.path.join(directory, 'fail_before.h264'), 'wb').close()
+        index.close_recording(1700000000, 1700000010, 0.9)
+        summary = VideoMaker(index, ffmpeg=stub, niceness=0).run_once()
+        assert summary['failed'] == 1 and index.get(1700000000)['mp4'] == 'failed'
+        assert not index.mp4_jobs() and index.mp4_jobs(retry_failed=True)
+
+    print("ok")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import json
+import os
+import sys
+import argparse
+from timeit import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import wire_format
+from aiy_model_output import process_inference
+from inference_backend import SyntheticBackend
+
+
+# Build a batch of API outputs from the synthetic source
+def make_outputs(model, objects, frames):
+    backend = SyntheticBackend(objects=objects, seed=1)
+    params = {'height': backend.vres, 'width': backend.hres}
+    results = backend.run(model)
+    backend.framerate = 1e9     # don't pace the generator
+
+    outputs = []
+    for i in range(frames):
+        output = process_inference(model, next(results), params)
+        output.seq = i
+        output.timeStamp = 1535935485.0 + i / 15
+        output.inferenceTime = 1 / 15
+        outputs.append(output)
+    return outputs
+
+
+def bench(model, objects, frames, repeat):
+    outputs = make_outputs(model, objects, frames)
+
+    json_msgs = [o.to_json().encode() for o in outputs]
+    binary_msgs = [wire_format.encode(o) for o in outputs]
+
+    # make sure the binary form survives a round trip
+    for output, msg in zip(outputs, binary_msgs):
+        decoded = wire_format.decode(msg)
+        assert decoded['numObjects'] == output.numObjects
+        for a, b in zip(decoded['objects'], output.objects):
+            assert abs(a['score'] - b['score']) < 0.01
+            if 'x' in a:
+                assert abs(a['x'] - b['x']) < 0.0001
+
+    json_enc = timeit(lambda: [o.to_json().encode() for o in outputs], number=repeat) / (frames * repeat)
+    bin_enc = timeit(lambda: [wire_format.encode(o) for o in outputs], number=repeat) / (frames * repeat)
+    json_dec = timeit(lambda: [json.loads(m) for m in json_msgs], number=repeat) / (frames * repeat)
+    bin_dec = timeit(lambda: [wire_format.decode(m) for m in binary_msgs], number=repeat) / (frames * repeat)
+
+    json_size = sum(len(m) for m in json_msgs) / frames
+    bin_size = sum(len(m) for m in binary_msgs) / frames
+
+    print("%-6s %2d objects | bytes/frame json %6.1f binary %5.1f (%4.1f%%) | "
+          "encode us json %6.1f binary %6.1f | decode us json %6.1f binary %6.1f" %
+          (model, objects, json_size, bin_size, 100 * bin_size / json_size,
+           json_enc * 1e6, bin_enc * 1e6, json_dec * 1e6, bin_dec * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare JSON and binary detection message encodings")
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    for model in ('face', 'object', 'class'):
+        for objects in (1, 3, 8):
+            bench(model, objects, args.frames, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
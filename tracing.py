@@ -0,0 +1,80 @@
+# Per-frame pipeline tracing
+#
+# Every inference result gets a sequence number and monotonic timestamps as it moves through the
+# pipeline. Stage latencies are kept in fixed-size metrics windows and summarized as p50/p95/p99.
+
+from time import monotonic
+
+import metrics
+
+# pipeline checkpoints in order
+STAGES = ('received', 'processed', 'serialized', 'enqueued', 'sent')
+
+# latency name -> (from checkpoint, to checkpoint)
+LATENCIES = (
+    ('process', 'received', 'processed'),
+    ('serialize', 'processed', 'serialized'),
+    ('enqueue', 'serialized', 'enqueued'),
+    ('send', 'enqueued', 'sent'),
+    ('total', 'received', 'sent'),
+)
+
+
+class FrameTrace(object):
+    __slots__ = ('seq', 'stamps')
+
+    def __init__(self, seq):
+        self.seq = seq
+        self.stamps = {'received': monotonic()}
+
+    def mark(self, stage):
+        self.stamps[stage] = monotonic()
+
+
+class Tracer(object):
+    def __init__(self, window=1000):
+        self.seq = 0
+        self.samples = {name: metrics.window('pipeline_%s_seconds' % name,
+                                             'Per-frame %s latency (%s to %s)' % (name, begin, end), window)
+                        for name, begin, end in LATENCIES}
+
+    # call when an inference result arrives
+    def start(self):
+        self.seq += 1
+        return FrameTrace(self.seq)
+
+    def _record(self, stamps, names):
+        for name, begin, end in LATENCIES:
+            if name in names and begin in stamps and end in stamps:
+                self.samples[name].observe(stamps[end] - stamps[begin])
+
+    # call once the inference thread is done with the frame
+    def finish(self, trace):
+        self._record(trace.stamps, ('process', 'serialize', 'enqueue'))
+
+    # call from the socket thread each time the frame is written to a client
+    def sent(self, trace):
+        if trace is None:
+            return
+        stamps = dict(trace.stamps, sent=monotonic())
+        self._record(stamps, ('send', 'total'))
+
+    # p50/p95/p99 per stage in milliseconds
+    def summary(self):
+        summary = {}
+        for name, _, _ in LATENCIES:
+            stats = self.samples[name].summary()
+            summary[name] = {'count': stats['count']}
+            for pct in (50, 95, 99):
+                value = stats['p%d' % pct]
+                summary[name]['p%d' % pct] = round(value * 1000, 3) if value is not None else None
+        summary['frames'] = self.seq
+        return summary
+
+    def print_summary(self):
+        summary = self.summary()
+        print("trace after %d frames (ms):" % summary['frames'])
+        for name, _, _ in LATENCIES:
+            stage = summary[name]
+            print("  %-10s n=%-5d p50=%s p95=%s p99=%s" %
+                  (name, stage['count'], stage['p50'], stage['p95'], stage['p99']))
@@ -0,0 +1,127 @@
+# Multi-object tracker that runs between process_inference() and publishing
+#
+# Detections are matched to existing tracks by IoU, computed for all track/detection pairs at once
+# with NumPy. Each track keeps a stable id plus an alpha-beta smoothed box and velocity
+# (normalized units per second) so clients can interpolate between inference results.
+
+import numpy as np
+
+
+# IoU of every box in a (N, 4) array against every box in a (M, 4) array of x, y, width, height
+def iou_matrix(a, b):
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros((len(a), len(b)))
+
+    a_x2 = a[:, 0] + a[:, 2]
+    a_y2 = a[:, 1] + a[:, 3]
+    b_x2 = b[:, 0] + b[:, 2]
+    b_y2 = b[:, 1] + b[:, 3]
+
+    inter_w = np.minimum(a_x2[:, None], b_x2[None, :]) - np.maximum(a[:, 0, None], b[None, :, 0])
+    inter_h = np.minimum(a_y2[:, None], b_y2[None, :]) - np.maximum(a[:, 1, None], b[None, :, 1])
+    inter = np.clip(inter_w, 0, None) * np.clip(inter_h, 0, None)
+
+    union = (a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-12), 0)
+
+
+class Tracker(object):
+    def __init__(self, min_iou=0.2, max_age=1.0, alpha=0.6, beta=0.2):
+        self.min_iou = min_iou
+        self.max_age = max_age      # seconds a track survives without a matching detection
+        self.alpha = alpha          # position smoothing gain
+        self.beta = beta            # velocity smoothing gain
+        self.next_id = 0
+
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.boxes = np.zeros((0, 4))
+        self.velocity = np.zeros((0, 4))
+        self.last_seen = np.zeros(0)
+        self.kinds = np.zeros(0, dtype=np.int64)  # integer code per (name, class_name)
+        self.kind_codes = {}
+        self.last_time = None
+
+    def _kind(self, item):
+        return self.kind_codes.setdefault((item['name'], item.get('class_name')), len(self.kind_codes))
+
+    def _match(self, predicted, detections, kinds):
+        cost = 1 - iou_matrix(predicted, detections)
+
+        # only objects of the same kind can match
+        cost[self.kinds[:, None] != kinds[None, :]] = np.inf
+
+        # greedy assignment, cheapest pairs first
+        matches = []
+        if cost.size:
+            used_tracks = np.zeros(cost.shape[0], dtype=bool)
+            used_detections = np.zeros(cost.shape[1], dtype=bool)
+            for flat in np.argsort(cost, axis=None):
+                t, d = divmod(int(flat), cost.shape[1])
+                if cost[t, d] > 1 - self.min_iou:
+                    break
+                if used_tracks[t] or used_detections[d]:
+                    continue
+                used_tracks[t] = used_detections[d] = True
+                matches.append((t, d))
+        return matches
+
+    # Returns the objects with 'id', smoothed box and 'vx'/'vy' added. Items without a box
+    # (image classification results) pass through untouched.
+    def update(self, objects, now):
+        boxed = [item for item in objects if 'x' in item]
+        passthrough = [item for item in objects if 'x' not in item]
+
+        dt = 0 if self.last_time is None else now - self.last_time
+        self.last_time = now
+
+        predicted = self.boxes + self.velocity * dt
+        detections = np.array([[item['x'], item['y'], item['width'], item['height']] for item in boxed],
+                              dtype=float).reshape(-1, 4)
+        kinds = np.array([self._kind(item) for item in boxed], dtype=np.int64)
+
+        matches = self._match(predicted, detections, kinds)
+        matched_tracks = [t for t, _ in matches]
+        matched_detections = [d for _, d in matches]
+
+        # alpha-beta update of the matched tracks, all at once
+        boxes = predicted.copy()
+        velocity = self.velocity.copy()
+        if matches:
+            residual = detections[matched_detections] - predicted[matched_tracks]
+            boxes[matched_tracks] = predicted[matched_tracks] + self.alpha * residual
+            if dt > 0:
+                velocity[matched_tracks] += self.beta * residual / dt
+            self.last_seen[matched_tracks] = now
+
+        # start tracks for the unmatched detections
+        new = sorted(set(range(len(boxed))) - set(matched_detections))
+        new_ids = np.arange(self.next_id + 1, self.next_id + 1 + len(new))
+        self.next_id += len(new)
+
+        self.ids = np.concatenate([self.ids, new_ids])
+        self.boxes = np.concatenate([boxes, detections[new]])
+        self.velocity = np.concatenate([velocity, np.zeros((len(new), 4))])
+        self.last_seen = np.concatenate([self.last_seen, np.full(len(new), now)])
+        self.kinds = np.concatenate([self.kinds, kinds[new]])
+
+        # output in detection order
+        track_of = {d: t for t, d in matches}
+        track_of.update((d, len(boxes) + i) for i, d in enumerate(new))
+
+        tracked = []
+        for d, item in enumerate(boxed):
+            t = track_of[d]
+            x, y, width, height = self.boxes[t].tolist()
+            vx, vy = self.velocity[t, :2].tolist()
+            tracked.append(dict(item, id=int(self.ids[t]), x=x, y=y, width=width, height=height, vx=vx, vy=vy))
+
+        # drop tracks that have not been seen for too long
+        keep = now - self.last_seen <= self.max_age
+        if not keep.all():
+            self.ids = self.ids[keep]
+            self.boxes = self.boxes[keep]
+            self.velocity = self.velocity[keep]
+            self.last_seen = self.last_seen[keep]
+            self.kinds = self.kinds[keep]
+
+        return tracked + passthrough
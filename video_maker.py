@@ -1,14 +1,204 @@
+# Turns recordings into playable mp4s
+#
+# Jobs come from the recording index: a closed recording whose mp4 is 'none' is queued, marked
+# 'pending' while ffmpeg runs and 'done' or 'failed' afterwards, so a restart resumes the 'pending'
+# and 'none' ones instead of rescanning the directory. The before/after H.264 pair is stream-copied
+# into the mp4 - no re-encoding - by a bounded pool of low priority ffmpeg processes.
+#
+# Run standalone to process the backlog, or inside server.py with --make-videos where it only works
+# while the inference loop is keeping up.
+
 import os
-from glob import glob
-import re
+import queue
 import subprocess
 import argparse
+from threading import Thread, Event, Lock
+from time import monotonic, sleep
+
+import metrics
+from recording_index import open_index
+
+job_seconds = metrics.histogram('video_job_seconds', 'Time to make one mp4')
+jobs_done = metrics.counter('video_jobs_total', 'Mp4s made')
+jobs_failed = metrics.counter('video_job_failures_total', 'Mp4 jobs that failed')
+video_bytes = metrics.counter('video_bytes_total', 'H.264 bytes muxed into mp4s')
+throttled_seconds = metrics.counter('video_throttled_seconds_total', 'Time mp4 jobs waited for inference load to drop')
+
+
+class VideoMaker(object):
+    def __init__(self, index, workers=1, framerate=15, ffmpeg='ffmpeg', niceness=10, throttle=None,
+                 retry_failed=False, poll_interval=30):
+        self.index = index
+        self.workers = workers
+        self.framerate = framerate
+        self.ffmpeg = ffmpeg
+        self.niceness = niceness            # added to the ffmpeg process priority
+        self.throttle = throttle            # returns True while jobs should wait
+        self.retry_failed = retry_failed
+        self.poll_interval = poll_interval
+        self.jobs = queue.Queue()
+        self.queued = set()
+        self.lock = Lock()
+        self.wake = Event()
+        self.stopping = False
+        self.done = 0
+        self.failed = 0
+        self.bytes = 0
+        self.busy_time = 0.0
+
+    # call when a recording closes to pick it up without waiting for the next poll
+    def notify(self, recording_id=None):
+        self.wake.set()
+
+    def _fill(self):
+        added = 0
+        for job in self.index.mp4_jobs(retry_failed=self.retry_failed):
+            with self.lock:
+                if job['id'] in self.queued:
+                    continue
+                self.queued.add(job['id'])
+            self.jobs.put(job)
+            added += 1
+        return added
+
+    def _start_workers(self):
+        threads = [Thread(target=self._worker, name='video-maker-%d' % n, daemon=True) for n in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def _stop_workers(self, threads):
+        for _ in threads:
+            self.jobs.put(None)
+        for thread in threads:
+            thread.join()
+
+    # Process everything waiting now, then return
+    def run_once(self):
+        start = monotonic()
+        self._fill()
+        self._stop_workers(self._start_workers())
+        return self.summary(monotonic() - start)
+
+    # Keep processing new recordings until run_event is cleared. Always stops its pool on the way out,
+    # so a supervisor restart after an error doesn't start a second one racing for the same jobs.
+    def serve(self, run_event):
+        self._reset()
+        threads = self._start_workers()
+        try:
+            while run_event.is_set():
+                self._fill()
+                self.wake.wait(self.poll_interval)
+                self.wake.clear()
+        finally:
+            # queued jobs are dropped and running ones finish; the index still has any left 'none' or
+            # 'pending', so the next serve() picks them up again
+            self.stopping = True
+            self._stop_workers(threads)
+
+    # forget jobs left queued by a previous serve()
+    def _reset(self):
+        self.stopping = False
+        while True:
+            try:
+                self.jobs.get_nowait()
+            except queue.Empty:
+                break
+        with self.lock:
+            self.queued.clear()
+
+    def _worker(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            waited = monotonic()
+            while self.throttle and self.throttle() and not self.stopping:
+                sleep(1)
+            throttled_seconds.inc(monotonic() - waited)
+            if self.stopping:
+                return
+            try:
+                self.make(job)
+            except Exception as err:     # one bad job mustn't take a pool thread with it
+                print("mp4 job for recording %d failed: %s" % (job['id'], err))
+                self._failed(job['id'])
+            finally:
+                with self.lock:
+                    self.queued.discard(job['id'])
+
+    def command(self, inputs, output):
+        return [self.ffmpeg, '-nostdin', '-loglevel', 'error', '-y', '-framerate', str(self.framerate),
+                '-i', 'concat:' + '|'.join(inputs), '-c', 'copy', '-f', 'mp4', output]
+
+    def make(self, job):
+        recording_id = job['id']
+        inputs = [f for f in (job['before_file'], job['after_file']) if f and os.path.exists(f)]
+        if not inputs:
+            print("no video files for recording %d" % recording_id)
+            self._failed(recording_id)
+            return False
 
-def make_videos(files_to_process):
+        output = os.path.join(os.path.dirname(inputs[0]), '%d.mp4' % recording_id)
+        partial = output + '.part'      # only renamed into place once ffmpeg has finished
+        size = sum(os.path.getsize(f) for f in inputs)
 
-    for id in files_to_process:
-        print("creating %s.mp4" % id)
-        subprocess.call('./join_videos.sh %s' % id, shell=True)
+        self.index.set_mp4(recording_id, 'pending')
+        start = monotonic()
+        try:
+            # no preexec_fn: forking a threaded server with one can deadlock the child
+            process = subprocess.Popen(self.command(inputs, partial), stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.PIPE)
+            self._lower_priority(process.pid)
+            _, stderr = process.communicate()
+            ok = process.returncode == 0 and os.path.exists(partial)
+            error = stderr.decode(errors='replace').strip() or "ffmpeg exited with %d" % process.returncode
+        except OSError as err:
+            ok, error = False, str(err)
+        elapsed = monotonic() - start
+
+        if ok:
+            os.replace(partial, output)
+            self.index.set_mp4(recording_id, 'done')
+            job_seconds.observe(elapsed)
+            jobs_done.inc()
+            video_bytes.inc(size)
+            with self.lock:
+                self.done += 1
+                self.bytes += size
+                self.busy_time += elapsed
+            print("created %s in %.2f s (%.1f MB/s)" % (output, elapsed, size / elapsed / 1e6 if elapsed else 0))
+        else:
+            if os.path.exists(partial):
+                os.remove(partial)
+            self._failed(recording_id)
+            print("failed to create %s: %s" % (output, error))
+        return ok
+
+    def _failed(self, recording_id):
+        jobs_failed.inc()
+        with self.lock:
+            self.failed += 1
+        try:
+            self.index.set_mp4(recording_id, 'failed')
+        except Exception as err:
+            print("could not mark recording %d failed: %s" % (recording_id, err))
+
+    def _lower_priority(self, pid):
+        if self.niceness:
+            try:
+                os.setpriority(os.PRIO_PROCESS, pid, os.getpriority(os.PRIO_PROCESS, pid) + self.niceness)
+            except OSError:
+                pass    # ffmpeg already exited
+
+    def summary(self, elapsed=None):
+        summary = {'done': self.done, 'failed': self.failed, 'bytes': self.bytes, 'busy_seconds': self.busy_time,
+                   'workers': self.workers}
+        if elapsed:
+            summary['elapsed_seconds'] = elapsed
+            summary['videos_per_second'] = self.done / elapsed
+            summary['mb_per_second'] = self.bytes / elapsed / 1e6
+        return summary
 
 
 def main():
@@ -29,39 +219,52 @@ def main():
         default=15,
         help='Sets the camera framerate. Default is 15')
 
+    parser.add_argument(
+        '--workers',
+        '-w',
+        type=int,
+        dest='workers',
+        default=os.cpu_count() or 1,
+        help='Number of ffmpeg processes to run at once. Default is the number of CPUs')
 
+    parser.add_argument(
+        '--ffmpeg',
+        dest='ffmpeg',
+        default='ffmpeg',
+        help='ffmpeg executable to use. Default is ffmpeg')
 
-    args = parser.parse_args()
-
-    path = "./recordings"
-    mp4_files = glob(os.path.join(path, "[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]*.mp4"))
-    h264_files = glob(os.path.join(path, "[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]*_*.h264"))
-
-    h264_ids = []
-    to_process = []
+    parser.add_argument(
+        '--retry-failed',
+        dest='retry_failed',
+        default=False,
+        action='store_true',
+        help="Also retry recordings that failed before")
 
-    for file in mp4_files:
-        m = re.search(r"([0-9]{10,})", file)
-        h264_ids.append(m.group(1))
+    parser.add_argument(
+        '--path',
+        dest='path',
+        default='./recordings',
+        help='Recordings directory. Default is ./recordings')
 
-    for file in h264_files:
-        m = re.search(r"([0-9]{10,})_(before|after)(\.h264)", file)
-        vid = m.group(1)
-        if vid not in h264_ids:
-            to_process.append(vid)
+    args = parser.parse_args()
 
-    to_process = list(set(to_process)) # dedupe
+    index = open_index(args.path)
 
     if args.view:
         print("Existing videos")
-        for file in mp4_files:
-            print(file)
+        for recording in index.query(per_page=1000, mp4='done')['recordings']:
+            print("%d.mp4" % recording['id'])
 
         print("Recordings without video")
-        for file in to_process:
-            print(file)
+        for recording in index.mp4_jobs(limit=1000, retry_failed=True):
+            print("%d (%s)" % (recording['id'], recording['mp4']))
     else:
-        make_videos(to_process)
+        maker = VideoMaker(index, workers=args.workers, framerate=args.framerate, ffmpeg=args.ffmpeg,
+                           niceness=0, retry_failed=args.retry_failed)
+        summary = maker.run_once()
+        print("%d videos made, %d failed in %.1f s with %d workers - %.2f videos/s, %.1f MB/s" %
+              (summary['done'], summary['failed'], summary['elapsed_seconds'], summary['workers'],
+               summary['videos_per_second'], summary['mb_per_second']))
 
 
 if __name__ == '__main__':
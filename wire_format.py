@@ -0,0 +1,119 @@
+# Compact binary encoding of detection messages
+#
+# An alternative to ApiObject.to_json() for bandwidth constrained data channels. Clients opt in by
+# sending {"encoding": "binary"} over the socket; the server answers with a JSON hello carrying the
+# format version and the label table, then sends frames as:
+#
+#   header  <BBHIdf   version, message type, object count, seq, timeStamp (s), inferenceTime (s)
+#   face    <BBBHHHH  kind 0, score, joy, x, y, width, height
+#   object  <BHBHHHH  kind 1, label id, score, x, y, width, height
+#   class   <BHB      kind 2, label id, score
+#
+# Scores are quantized to 0-255 and normalized box coordinates to 0-65535.
+
+import json
+import struct
+from threading import Lock
+
+VERSION = 1
+FRAME = 0   # message type
+
+HEADER = struct.Struct('<BBHIdf')
+FACE = struct.Struct('<BBBHHHH')
+OBJECT = struct.Struct('<BHBHHHH')
+CLASS = struct.Struct('<BHB')
+
+
+def _score(value):
+    return min(max(int(value * 255 + 0.5), 0), 255)
+
+
+def _coord(value):
+    return min(max(int(value * 65535 + 0.5), 0), 65535)
+
+
+# Label strings are sent once per client in the hello and referenced by id in frames.
+# New labels get the next id; a client seeing an id it doesn't know asks for a fresh hello.
+class LabelTable(object):
+    def __init__(self, labels=()):
+        self.labels = []
+        self.ids = {}
+        self._lock = Lock()
+        for label in labels:
+            self.id(label)
+
+    def id(self, label):
+        label_id = self.ids.get(label)
+        if label_id is None:
+            with self._lock:
+                label_id = self.ids.setdefault(label, len(self.labels))
+                if label_id == len(self.labels):
+                    self.labels.append(label)
+        return label_id
+
+
+# AIY object detection labels, so the common ids are stable across restarts
+labels = LabelTable(['BACKGROUND', 'PERSON', 'CAT', 'DOG'])
+
+
+def hello():
+    return json.dumps({'encoding': 'binary', 'version': VERSION, 'labels': labels.labels}).encode()
+
+
+def encode(output):
+    # keyframe/delta stream messages have no binary form and go out as JSON
+    if hasattr(output, 'type'):
+        return output.to_json().encode()
+
+    objects = output.objects
+    parts = [HEADER.pack(VERSION, FRAME, len(objects), getattr(output, 'seq', 0) & 0xFFFFFFFF,
+                         getattr(output, 'timeStamp', 0), getattr(output, 'inferenceTime', 0))]
+
+    for item in objects:
+        name = item['name']
+        if name == 'face':
+            parts.append(FACE.pack(0, _score(item['score']), _score(item['joy']),
+                                   _coord(item['x']), _coord(item['y']),
+                                   _coord(item['width']), _coord(item['height'])))
+        elif name == 'object':
+            parts.append(OBJECT.pack(1, labels.id(item['class_name']), _score(item['score']),
+                                     _coord(item['x']), _coord(item['y']),
+                                     _coord(item['width']), _coord(item['height'])))
+        elif name == 'class':
+            parts.append(CLASS.pack(2, labels.id(item['class_name']), _score(item['score'])))
+
+    return b''.join(parts)
+
+
+# Inverse of encode() - used by the benchmark and for debugging captures
+def decode(data, label_list=None):
+    label_list = labels.labels if label_list is None else label_list
+    version, msg_type, count, seq, time_stamp, inference_time = HEADER.unpack_from(data, 0)
+    if version != VERSION or msg_type != FRAME:
+        raise ValueError("unsupported message version %d type %d" % (version, msg_type))
+
+    objects = []
+    offset = HEADER.size
+    for _ in range(count):
+        kind = data[offset]
+        if kind == 0:
+            _, score, joy, x, y, w, h = FACE.unpack_from(data, offset)
+            item = {'name': 'face', 'score': score / 255, 'joy': joy / 255}
+            offset += FACE.size
+        elif kind == 1:
+            _, label, score, x, y, w, h = OBJECT.unpack_from(data, offset)
+            item = {'name': 'object', 'class_name': label_list[label], 'score': score / 255}
+            offset += OBJECT.size
+        elif kind == 2:
+            _, label, score = CLASS.unpack_from(data, offset)
+            objects.append({'name': 'class', 'class_name': label_list[label], 'score': score / 255})
+            offset += CLASS.size
+            continue
+        else:
+            raise ValueError("unknown object kind %d" % kind)
+
+        item.update(x=x / 65535, y=y / 65535, width=w / 65535, height=h / 65535)
+        objects.append(item)
+
+    return {'numObjects': count, 'objects': objects, 'seq': seq,
+            'timeStamp': time_stamp, 'inferenceTime': inference_time}